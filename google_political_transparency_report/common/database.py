@@ -0,0 +1,66 @@
+"""
+the database layer shared by the loaders and scrapers, for the SQL db specified as env var DATABASE_URL.
+
+each process gets one Database: a records.Database plus (as DB.engine) a SQLAlchemy engine of our own, for what records doesn't do.
+the two share one connection pool (sized by env var DATABASE_POOL_SIZE), instead of every component connecting on its own,
+and nothing here relies on records' internals.
+
+ - get_db() returns this process's Database
+ - raw_transaction(DB) yields a psycopg2 cursor, e.g. for COPY, inside a transaction that's committed if the block succeeds
+   and rolled back if it raises
+ - execute(DB, query, **params) runs a fixed write query (like the scrapers' per-row upserts), whose text() clause is
+   built once per query by cached_text(query), rather than for every row. (that's all it saves: psycopg2 has no
+   server-side prepared statements; the bulk loads COPY instead, see copy_rows.py.)
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import records
+from sqlalchemy import create_engine, text
+
+_databases = {} # pid -> Database, since a pool can't be shared across a fork
+_databases_lock = threading.Lock()
+
+
+class Database(records.Database):
+    def __init__(self, db_url, **kwargs):
+        self.engine = create_engine(db_url, **kwargs)
+        super().__init__(db_url, pool=self.engine.pool)
+
+
+def get_db():
+    pid = os.getpid()
+    with _databases_lock:
+        if pid not in _databases:
+            _databases[pid] = Database(os.environ['DATABASE_URL'], pool_size=int(os.environ.get("DATABASE_POOL_SIZE", 5)), pool_pre_ping=True)
+        return _databases[pid]
+
+
+@contextmanager
+def raw_transaction(DB):
+    """yields a psycopg2 cursor on a connection from DB's pool; commits if the block succeeds, rolls back if not"""
+    conn = DB.engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+@lru_cache(maxsize=None)
+def cached_text(query):
+    return text(query)
+
+
+def execute(DB, query, **params):
+    """runs a fixed write query; returns the number of rows it affected"""
+    with DB.engine.connect() as conn:
+        return conn.execute(cached_text(query), **params).rowcount
+
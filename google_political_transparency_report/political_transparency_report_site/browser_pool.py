@@ -0,0 +1,134 @@
+"""
+a pool of long-lived headless browsers that scrape jobs (e.g. advertisers) from a shared queue.
+
+each of SCRAPER_WORKERS (env var, default 4) threads starts a browser with new_driver(name), where name is the worker's,
+e.g. "worker-0", and keeps it across jobs,
+calling scrape(driver, job) for each job it takes and passing every row that yields back to the caller, so that
+the rows can all be written to the DB by one writer. the threads mostly wait on their browsers, so the
+throughput scales with how many browsers the machine's cores and RAM can run, not with the GIL.
+
+if a browser crashes (a WebDriverException), its worker quits it, starts a new one and retries the job,
+up to SCRAPER_MAX_ATTEMPTS (env var, default 3) times; a job that still fails is recorded in pool.failures,
+and the worker goes on to the next one. the other workers aren't affected.
+a retry starts the job over, so rows it had already passed back aren't passed back again: those with a row_key(row)
+that's already been seen for the job, or, without a row_key, as many rows as had been.
+
+    pool = BrowserPool(new_driver, scrape, row_key=lambda row: row["id"])
+    for job, row in pool.run(jobs):
+        write(job, row)
+"""
+
+import logging
+import os
+import queue
+import threading
+
+from selenium.common.exceptions import WebDriverException
+
+log = logging.getLogger("google_political_transparency_report.political_transparency_report_site.browser_pool")
+
+SCRAPER_WORKERS = 4
+SCRAPER_MAX_ATTEMPTS = 3
+RESULT_QUEUE_SIZE = 1000 # rows; workers wait for the writer beyond this
+ROW = "row"
+FAILED = "failed"
+STOPPED = "stopped"
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception as e: # it may well have crashed already
+        log.warning("quitting the browser failed: %r", e)
+
+
+class BrowserPool:
+    def __init__(self, new_driver, scrape, workers=None, max_attempts=None, row_key=None):
+        self.new_driver = new_driver
+        self.scrape = scrape
+        self.row_key = row_key
+        self.workers = workers or int(os.environ.get("SCRAPER_WORKERS", SCRAPER_WORKERS))
+        self.max_attempts = max_attempts or int(os.environ.get("SCRAPER_MAX_ATTEMPTS", SCRAPER_MAX_ATTEMPTS))
+        self.failures = [] # (job, exception)
+        self.restarts = 0
+        self.restarts_lock = threading.Lock()
+
+    def run(self, jobs):
+        """yields (job, row) for every row scrape(driver, job) yields for each of `jobs`, in the order the workers produce them"""
+        self.failures = []
+        self.restarts = 0
+        job_queue = queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        results = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+        stopping = threading.Event()
+        threads = [threading.Thread(target=self.work, args=(i, job_queue, results, stopping), name="browser-{}".format(i), daemon=True)
+                   for i in range(min(self.workers, job_queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                kind, job, value = results.get()
+                if kind == ROW:
+                    yield job, value
+                elif kind == FAILED:
+                    self.failures.append((job, value))
+                elif kind == STOPPED:
+                    running -= 1
+        finally:
+            # if the caller stops early (or the writer raises), stop the workers after their current page, and let them drain.
+            stopping.set()
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    results.get(timeout=1)
+                except queue.Empty:
+                    pass
+
+    def work(self, worker, job_queue, results, stopping):
+        driver = None
+        launched = False # whether this worker's started a browser yet, so that starting another is a restart
+        try:
+            while not stopping.is_set():
+                try:
+                    job = job_queue.get_nowait()
+                except queue.Empty:
+                    break
+                sent_keys = set() # of the rows passed back for this job, in any attempt
+                sent_count = 0
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        if driver is None:
+                            driver = self.new_driver("worker-{}".format(worker))
+                            if launched:
+                                with self.restarts_lock:
+                                    self.restarts += 1
+                            launched = True
+                        for i, row in enumerate(self.scrape(driver, job)):
+                            if self.row_key is not None:
+                                key = self.row_key(row)
+                                if key in sent_keys:
+                                    continue
+                                sent_keys.add(key)
+                            elif i < sent_count:
+                                continue
+                            sent_count += 1
+                            results.put((ROW, job, row))
+                            if stopping.is_set():
+                                return
+                        break
+                    except WebDriverException as e:
+                        log.warning("browser %d crashed on %r (attempt %d of %d): %r", worker, job, attempt, self.max_attempts, e)
+                        if driver is not None:
+                            quit_driver(driver)
+                            driver = None
+                        if attempt == self.max_attempts:
+                            results.put((FAILED, job, e))
+                    except Exception as e:
+                        log.exception("scraping %r failed", job)
+                        results.put((FAILED, job, e))
+                        break
+        finally:
+            if driver is not None:
+                quit_driver(driver)
+            results.put((STOPPED, None, None))
@@ -0,0 +1,106 @@
+"""
+the headless Chrome the site scraper runs, set up to fetch only what the scraper reads: the pages' DOM, not their media.
+
+ - images aren't loaded (imagesEnabled=false). <img> elements, and their src URLs, are still in the DOM, which is all
+   tile_extraction.py reads, so this doesn't change how tiles are classified.
+ - fonts, video, and analytics/logging requests are blocked with the DevTools protocol's Network.setBlockedURLs (BLOCKED_URLS),
+   unless env var SCRAPER_BLOCK_RESOURCES is "false". the ads' DoubleClick iframes themselves still load, since image ads are read from them;
+   site isolation is off, so they're in the page's process (one renderer, not one per ad origin) and their requests get blocked too.
+ - if env var CHROME_PROFILE_DIR is set, each named browser (i.e. each BrowserPool worker) keeps a persistent profile in a directory
+   of its own under it, so the site's scripts and styles are cached across runs. a new profile is warmed up by loading WARM_UP_URL
+   before the browser is used.
+"""
+
+import logging
+import os
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+
+log = logging.getLogger("google_political_transparency_report.political_transparency_report_site.chrome_profile")
+
+CHROME_ARGUMENTS = [
+    "--headless",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-accelerated-video-decode",
+    "--use-gl=desktop",
+    "--blink-settings=imagesEnabled=false",
+    "--disable-features=IsolateOrigins,site-per-process",
+    "--autoplay-policy=user-gesture-required",
+    "--mute-audio",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--no-first-run",
+]
+
+BLOCKED_URLS = [
+    # fonts
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*fonts.gstatic.com*",
+    # video and YouTube thumbnails
+    "*.mp4", "*.webm", "*googlevideo.com*", "*ytimg.com*",
+    # analytics and logging
+    "*google-analytics.com*", "*googletagmanager.com*", "*/gen_204*", "*/csi?*",
+]
+
+WARM_UP_URL = "https://transparencyreport.google.com/political-ads/region/US"
+WARMED_UP_MARKER = ".warmed_up"
+
+
+def blocks_resources():
+    return os.environ.get("SCRAPER_BLOCK_RESOURCES", "true").lower() != "false"
+
+
+def profile_dir(name):
+    """the persistent profile directory for the browser called `name`, or None if there's no CHROME_PROFILE_DIR (or name)"""
+    if not name or not os.environ.get("CHROME_PROFILE_DIR"):
+        return None
+    return os.path.join(os.environ["CHROME_PROFILE_DIR"], name)
+
+
+def chrome_options(user_data_dir=None):
+    options = Options()
+    for argument in CHROME_ARGUMENTS:
+        options.add_argument(argument)
+    if user_data_dir:
+        options.add_argument("--user-data-dir={}".format(user_data_dir))
+    return options
+
+
+def block_resources(driver):
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+
+
+def warm_up(driver, user_data_dir):
+    """loads WARM_UP_URL in a new profile, so the site's scripts are cached before the first advertiser"""
+    marker = os.path.join(user_data_dir, WARMED_UP_MARKER)
+    if os.path.exists(marker):
+        return
+    log.info("warming up Chrome profile {}".format(user_data_dir))
+    driver.get(WARM_UP_URL)
+    open(marker, "w").close()
+
+
+def new_chrome(name=None):
+    """
+    starts a lean headless Chrome, with the persistent profile for `name` (e.g. a pool worker's) if there's a CHROME_PROFILE_DIR.
+    two browsers can't share a profile at once, so a browser without a name gets a temporary one.
+    """
+    user_data_dir = profile_dir(name)
+    if user_data_dir:
+        os.makedirs(user_data_dir, exist_ok=True)
+    driver = webdriver.Chrome(service=Service(), options=chrome_options(user_data_dir))
+    try:
+        if blocks_resources():
+            block_resources(driver)
+        if user_data_dir:
+            warm_up(driver, user_data_dir)
+    except:
+        driver.quit()
+        raise
+    return driver
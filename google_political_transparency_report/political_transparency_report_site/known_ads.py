@@ -0,0 +1,66 @@
+"""
+the ads of an advertiser we've already scraped, so the daily run can skip them and stop paging once it's caught up.
+
+KnownAds.load(DB, advertiser_id) reads the advertiser's ad_ids from google_ad_creatives, with the only state the scraper's upsert
+can change: whether the ad is an error, and whether it's had a policy violation, packed into a small int per ad.
+
+ - a tile for a known ad whose state is the same as its row's (judging by its kind, from extract_tranche, without switching into
+   any iframe) would upsert nothing, so it isn't extracted at all; unchanged(tile) says which tiles those are.
+ - the results are sorted newest first (sort:3), so after a run of SCRAPER_KNOWN_AD_RUN (env var, default 50) known ads in a row,
+   every ad after them is known too, and the scraper can stop clicking "load more" (caught_up()). set it to 0 to page through
+   everything anyway, e.g. if the page's sort ever changes.
+"""
+
+import os
+
+ERROR = 1
+POLICY_VIOLATION = 2
+
+SCRAPER_KNOWN_AD_RUN = 50
+
+KNOWN_ADS_QUERY = """
+  SELECT ad_id, error, policy_violation_date IS NOT NULL AS policy_violation
+  FROM google_ad_creatives
+  WHERE advertiser_id = :advertiser_id"""
+
+
+def ad_state(error, policy_violation):
+    return (ERROR if error else 0) | (POLICY_VIOLATION if policy_violation else 0)
+
+
+def tile_state(tile):
+    """the state of the ad in `tile`, as the row ad_data_from_tile would make for it"""
+    error = tile["kind"] in ("other_video", "unknown") or (tile["kind"] == "youtube_video" and not tile["image_url"])
+    return ad_state(error, tile["kind"] == "policy_violation")
+
+
+class KnownAds:
+    def __init__(self, states, run_length=None):
+        self.states = states # ad_id -> ad_state
+        self.run_length = int(os.environ.get("SCRAPER_KNOWN_AD_RUN", SCRAPER_KNOWN_AD_RUN)) if run_length is None else run_length # 0 is off
+        self.run = 0 # known ads in a row, so far
+        self.skipped = 0
+
+    @classmethod
+    def load(cls, DB, advertiser_id):
+        rows = DB.query(KNOWN_ADS_QUERY, advertiser_id=advertiser_id)
+        return cls({row["ad_id"]: ad_state(row["error"], row["policy_violation"]) for row in rows})
+
+    def __len__(self):
+        return len(self.states)
+
+    def unchanged(self, tile):
+        """notes whether `tile` is a known ad, for caught_up(); returns whether it's known and in the state it's in in the DB"""
+        state = self.states.get(tile["ad_id"])
+        if state is None:
+            self.run = 0
+            return False
+        self.run += 1
+        # the upsert keeps the earliest policy_violation_date, so a tile without a policy violation doesn't change one in the DB.
+        if (tile_state(tile) | (state & POLICY_VIOLATION)) == state:
+            self.skipped += 1
+            return True
+        return False
+
+    def caught_up(self):
+        return bool(self.run_length) and self.run >= self.run_length
@@ -1,26 +1,25 @@
 import os
 import sys
 import csv
-from time import sleep
-from urllib.parse import urljoin, urlparse, parse_qs
 from datetime import date, timedelta, datetime
 import logging
 
-from selenium import webdriver
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.common.exceptions import NoSuchElementException, WebDriverException
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait as wait
 from dotenv import load_dotenv
 
-import records
-
 from ..common.post_to_slack import info_to_slack, warn_to_slack
 from ..common.formattimedelta import formattimedelta
+from ..common.database import get_db, execute
+from .browser_pool import BrowserPool
+from .chrome_profile import new_chrome
+from .known_ads import KnownAds
+from .tile_extraction import extract_tranche, ad_data_from_tile, mark_processed
+from .waits import wait_for, wait_summary, UNPROCESSED_TILES, NO_SPINNERS
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(
@@ -53,347 +52,89 @@ INSERT_QUERY = """
 
 
 def write_row_to_db(ad_data):
-    DB.query(INSERT_QUERY, **ad_data)
+    execute(get_db(), INSERT_QUERY, **ad_data)
 
 
 TRANSPARENCY_REPORT_PAGE_URL_TEMPLATE = "https://transparencyreport.google.com/political-ads/advertiser/{}?campaign_creatives=start:{};end:{};spend:;impressions:;type:;sort:3&lu=campaign_creatives"
-CHROME_OPTIONS = Options()
-CHROME_OPTIONS.add_argument("--headless")
-CHROME_OPTIONS.add_argument("--disable-dev-shm-usage")
-CHROME_OPTIONS.add_argument("--disable-gpu")
-CHROME_OPTIONS.add_argument("--disable-accelerated-video-decode")
-CHROME_OPTIONS.add_argument("--use-gl=desktop")
-
-
-def is_image_iframe_ad(ad):
-    try:
-        ad.find_element(by=By.TAG_NAME, value="iframe")
-        return True
-    except NoSuchElementException:
-        return False
-
-
-def is_image_img_ad(ad):
-    try:
-        ad.find_element(by=By.TAG_NAME, value="img")
-        return True
-    except NoSuchElementException:
-        return False
-
-
-def is_youtube_video_ad(ad):
-    try:
-        ad.find_element(by=By.CSS_SELECTOR, value="figure.video-preview")
-        return True
-    except NoSuchElementException:
-        return False
+# the longest we wait (in seconds) for the tiles after loading the page, for their spinners to go, and for more tiles after clicking "load more";
+# these were the fixed sleeps before, and are the most the learned timeouts in waits.py can grow to.
+PAGE_LOAD_MAX_WAIT = 12
+SPINNER_MAX_WAIT = 6
+LOAD_MORE_MAX_WAIT = 12
 
 
-def is_other_video_ad(ad):
-    """some ads, like from https://transparencyreport.google.com/political-ads/advertiser/AR289367614772215808/creative/CR91503350528344064 show up as "unrenderable"
-    on the search results page.
+def scrape_advertiser(driver, advertiser_id, start_date, end_date, known_ads=None):
+    """
+    scrapes to an iterator the ads from one advertiser's Google Political Transparency Report index page, in `driver` (a running browser).
+    if given known_ads (a KnownAds), it skips the ads that are already in the DB as they are on the page, and stops once it's caught up.
+    raises WebDriverException if the browser crashes.
     """
-    try:
-        ad.find_element(by=By.TAG_NAME, value="unrenderable-ad")
-        return "Video ad" in ad.find_element(by=By.TAG_NAME, value="figcaption").text
-    except NoSuchElementException:
-        return False
-
-
-def is_text_ad(ad):
-    try:
-        ad.find_element(by=By.TAG_NAME, value="text-ad")
-        return True
-    except NoSuchElementException:
-        return False
-
-
-def is_image_and_text_ad(driver):
-    """ driver is an iframe within the ad, not the ad itself """
-    try:
-        driver.find_element(by=By.TAG_NAME, value="canvas")
-        return True
-    except NoSuchElementException:
-        return False
-
-
-def is_policy_violation(ad):
-    try:
-        elem = ad.find_element(by=By.TAG_NAME, value="unrenderable-ad")
-        return "Policy violation" in elem.text
-    except NoSuchElementException:
-        return False
-
-
-def is_gmail_ad(ad):
-    return False
-
-
-def is_still_loading(ad):
-    try:
-        ad.find_element(by=By.TAG_NAME, value="mat-progress-spinner")
-        return True
-    except NoSuchElementException:
-        return False
-
-
-def remove_element(driver, element):
-    driver.execute_script(
-        """
-  var element = arguments[0];
-  element.parentNode.removeChild(element);
-  """,
-        element,
-    )
-
-
-def add_class(driver, element, newClass):
-    driver.execute_script(
-        """
-  var element = arguments[0];
-  var newClass = arguments[1];
-  element.classList.add(newClass);
-  """,
-        element,
-        newClass,
-    )
-
 
-def empty_element(driver, element):
-    driver.execute_script(
-        """
-  var element = arguments[0];
-  element.innerHTML = "";
-  """,
-        element,
+    driver.get(
+        TRANSPARENCY_REPORT_PAGE_URL_TEMPLATE.format(
+            advertiser_id,
+            int(start_date.strftime("%s")) * 1000,
+            int(end_date.strftime("%s")) * 1000,
+        )
     )
+    # the ads are loaded after the page itself is, in tranches of tiles, each shown with a spinner until it's loaded.
+    if not wait_for(driver, "page_load", UNPROCESSED_TILES, PAGE_LOAD_MAX_WAIT):
+        log.info(f"no ads for advertiser {advertiser_id} after {PAGE_LOAD_MAX_WAIT}s")
+    while True:
+        start_time = datetime.now()
+        tiles = extract_tranche(driver)
+        log.info("got {} ads".format(len(tiles)))
+        if not tiles:
+            break
+        if any(tile["loading"] for tile in tiles):
+            wait_for(driver, "spinners", NO_SPINNERS, SPINNER_MAX_WAIT)
+            tiles = extract_tranche(driver)
+        log.info(
+            f"new tranche, first creative id: {tiles[0]['ad_id']}, advertiser: {advertiser_id}"
+        )
+        for tile in tiles:
+            if known_ads is not None and known_ads.unchanged(tile):
+                continue
+            ad_data = ad_data_from_tile(driver, tile, advertiser_id)
+            if ad_data is not None:
+                yield ad_data
+        mark_processed(driver, tiles)
+        log.info(
+            "took: {}".format((datetime.now() - start_time).total_seconds())
+        )
+        if known_ads is not None and known_ads.caught_up():
+            log.info(f"caught up with advertiser {advertiser_id} after {known_ads.run} known ads in a row")
+            break
+        try:
+            load_more_btn = driver.find_element(by=By.TAG_NAME, value=
+                "button.ng-star-inserted"
+            )
+            load_more_btn.click()
+        except NoSuchElementException:
+            break
+        if not wait_for(driver, "load_more", UNPROCESSED_TILES, LOAD_MORE_MAX_WAIT):
+            log.warning(f"no more ads after clicking load more for advertiser {advertiser_id}")
 
 
 def scrape_political_transparency_report(advertiser_id, start_date, end_date):
     """
-    scrapes to an iterator the content from the Google Political Transparency Report advertiser index pages.
+    scrapes to an iterator the content from the Google Political Transparency Report advertiser index pages, in a browser of its own,
+    starting over in a new browser if it crashes. (running_update_of_all_advertisers uses a BrowserPool instead.)
     """
 
     while True:
+        driver = None
         try:
-            driver = webdriver.Chrome(
-                service=Service(),
-                options=CHROME_OPTIONS
-            )
-
-            driver.get(
-                TRANSPARENCY_REPORT_PAGE_URL_TEMPLATE.format(
-                    advertiser_id,
-                    int(start_date.strftime("%s")) * 1000,
-                    int(end_date.strftime("%s")) * 1000,
-                )
-            )
-            sleep(2)
-            while True:
-                start_time = datetime.now()
-                ads = driver.find_elements(by=By.CSS_SELECTOR, value=
-                    "creative-preview:not(.alreadyprocessed)"
-                )
-                log.info("got {} ads".format(len(ads)))
-                if not ads:
-                    sleep(10)
-                    ads = driver.find_elements(by=By.CSS_SELECTOR, value=
-                        "creative-preview:not(.alreadyprocessed)"
-                    )
-                    log.info("got {} ads (second attempt)".format(len(ads)))
-                    if not ads:
-                        break
-                for i, ad in enumerate(ads):
-                    ad_detail_url = ad.find_element(by=By.TAG_NAME, value="a").get_attribute(
-                        "href"
-                    )
-                    ad_id = ad_detail_url.split("/")[-1]
-                    if i == 0:
-                        log.info(
-                            f"new tranche, first creative id: {ad_id}, advertiser: {advertiser_id}"
-                        )
-                    log.debug(f"ad_id {ad_id}")
-                    log.debug(
-                        driver.execute_script("return arguments[0].outerHTML;", ad)
-                    )
-                    if is_still_loading(ad):
-                        sleep(1)
-                    if is_still_loading(ad):
-                        sleep(5)
-                    if is_youtube_video_ad(ad):
-                        try:
-                            img_url = ad.find_element(by=By.TAG_NAME, value="img").get_attribute(
-                                "src"
-                            )
-                        except NoSuchElementException:
-                            log.warning("no img?")
-                            log.warning(ad, ad.get_attribute("innerHTML"))
-                            yield {"ad_id": ad_id, "error": True, "ad_type": ad_type}
-                        youtube_ad_id = img_url.split("/")[4]
-                        ad_type = "video"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {
-                            "ad_id": ad_id,
-                            "youtube_ad_id": youtube_ad_id,
-                            "ad_type": ad_type,
-                            "policy_violation_date": None,
-                        }
-                    if is_other_video_ad(ad):
-                        ad_type = "video"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {
-                            "ad_id": ad_id,
-                            "ad_type": ad_type,
-                            "error": True,
-                            "policy_violation_date": None,
-                        }
-                    elif is_text_ad(ad):
-                        ad_container = ad.find_element(by=By.TAG_NAME, value="text-ad")
-                        remove_element(
-                            driver,
-                            ad_container.find_element(by=By.CSS_SELECTOR, value=".ad-icon"),
-                        )
-                        text = "\n".join(
-                            [
-                                div.text
-                                for div in ad_container.find_elements(by=By.CSS_SELECTOR, value=
-                                    "div"
-                                )
-                            ]
-                        )
-                        ad_type = "text"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {"ad_id": ad_id, "text": text, "ad_type": ad_type}
-                    elif is_image_img_ad(ad):
-                        image_urls = None
-                        image_url = ad.find_element(by=By.TAG_NAME, value="img").get_attribute(
-                            "src"
-                        )
-                        destination = ad.find_element(by=By.TAG_NAME, value="a").get_attribute(
-                            "href"
-                        )
-                        parsed_destination = parse_qs(urlparse(destination).query)
-                        if (
-                            "adurl" in parsed_destination
-                            and len(parsed_destination["adurl"]) >= 1
-                        ):
-                            destination = parsed_destination["adurl"][0]
-
-                        ad_text = None
-                        ad_type = "image"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {
-                            "ad_id": ad_id,
-                            "text": ad_text,
-                            "error": False,
-                            "image_url": image_url,
-                            "image_urls": image_urls,
-                            "destination": destination,
-                            "ad_type": ad_type,
-                            "policy_violation_date": None,
-                        }
-                    elif is_image_iframe_ad(ad):
-                        iframe = driver.find_element(by=By.TAG_NAME, value="iframe")
-                        iframe_url = iframe.get_attribute("src")
-                        driver.switch_to.frame(iframe)
-                        if is_image_and_text_ad(driver):
-                            # image and text ad
-                            image_url = driver.find_element(by=By.TAG_NAME, value=
-                                "canvas"
-                            ).value_of_css_property("background-url")
-                            image_urls = None
-                            try:
-                                destination = driver.find_element(by=By.TAG_NAME, value=
-                                    "a"
-                                ).get_attribute("href")
-                                # occasionally missing, e.g. https://transparencyreport.google.com/political-ads/advertiser/AR182710451392479232/creative/CR315072959679037440
-                            except NoSuchElementException:
-                                destination = None
-                            ad_text = driver.find_element(by=By.TAG_NAME, value="html").text
-                            ad_type = "image_and_text"
-                        else:  # then it's an image ad
-                            try:
-                                iframe = driver.find_element(by=By.TAG_NAME, value="iframe")
-                                iframe_url = iframe.get_attribute("src")
-                                driver.switch_to.frame(iframe)
-                            except NoSuchElementException:
-                                pass
-                            image_urls = [
-                                urljoin(iframe_url, img.get_attribute("src"))
-                                for img in driver.find_elements(by=By.TAG_NAME, value="img")
-                            ]
-                            image_url = None
-                            try:
-                                destination = driver.find_element(by=By.TAG_NAME, value=
-                                    "a"
-                                ).get_attribute("href")
-                            except NoSuchElementException as e:
-                                destination = None
-                                pass
-                            ad_text = None
-                            ad_type = "image"
-                        driver.switch_to.default_content()
-                        ad_type = "image"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {
-                            "ad_id": ad_id,
-                            "text": ad_text,
-                            "error": False,
-                            "image_url": image_url,
-                            "image_urls": image_urls,
-                            "destination": destination,
-                            "ad_type": ad_type,
-                            "policy_violation_date": None,
-                        }
-                    elif is_policy_violation(ad):
-                        ad_type = "unknown"
-                        log.debug(f"ad type: {ad_type}")
-                        yield {
-                            "ad_id": ad_id,
-                            "error": False,
-                            "ad_type": ad_type,
-                            "policy_violation_date": date.today(),
-                        }
-                    elif is_gmail_ad(ad):
-                        pass
-                    else:
-                        # sometimes this appears to happen sporadically, like the page isn't done loading yet?
-                        log.warning(
-                            f"unrecognized ad type {ad_id} / advertiser: {advertiser_id}"
-                        )
-                        ad_type = "unknown"
-                        log.debug(f"ad type: {ad_type}")
-                        log.debug(
-                            driver.execute_script("return arguments[0].outerHTML;", ad)
-                        )
-                        yield {
-                            "ad_id": ad_id,
-                            "error": True,
-                            "ad_type": ad_type,
-                            "policy_violation_date": None,
-                        }
-                    add_class(driver, ad, "alreadyprocessed")
-                    empty_element(
-                        driver, ad
-                    )  # iframes and stuff take up a lot of memory. we empty out elements once we've processed them. (we empty them out, instead of removing them, because removing them causes weird behavior)
-                log.info(
-                    "took: {}".format((datetime.now() - start_time).total_seconds())
-                )
-                try:
-                    load_more_btn = driver.find_element(by=By.TAG_NAME, value=
-                        "button.ng-star-inserted"
-                    )
-                    load_more_btn.click()
-                    sleep(2)
-                except NoSuchElementException:
-                    break
+            driver = new_chrome()
+            yield from scrape_advertiser(driver, advertiser_id, start_date, end_date)
         except WebDriverException as e:
             logging.warning('%r', e)
             pass  # retry
         else:
             return  # we're done if we didn't get a WebDriverException
         finally:
-            driver.quit()
+            if driver is not None:
+                driver.quit()
 
 
 def backfill_empty_advertisers(start_date, end_date):
@@ -403,16 +144,16 @@ def backfill_empty_advertisers(start_date, end_date):
 
     TODO: write about purpose of max_report_date...
     """
-    advertiser_ids = DB.query(
+    advertiser_ids = get_db().query(
         """
       select creative_stats.advertiser_id, count(*) 
         from creative_stats 
         left outer join google_ad_creatives using (ad_id) 
         join (select distinct advertiser_id from advertiser_weekly_spend where week_start_date >= :start_date  and week_start_date <= :end_date ) recent_advertisers on recent_advertisers.advertiser_id = creative_stats.advertiser_id
+        join creative_stats_history on creative_stats_history.ad_id = creative_stats.ad_id and creative_stats_history.valid_to is null
         where date_range_start >= :start_date
         and date_range_end <= :end_date
         and google_ad_creatives.ad_id is null 
-        and creative_stats.report_date = (SELECT max(report_date) FROM creative_stats)
         group by creative_stats.advertiser_id 
         order by count(*) desc;""",
         start_date=start_date,
@@ -469,7 +210,7 @@ def running_update_of_all_advertisers():
 
     # get all the spenders who have spent any money in the past week AND who have ads whose max(date_range_end) is no more than 2 days before the overall max(date_range_end)
     # then go get all their ads after that date
-    advertisers = DB.query(
+    advertisers = get_db().query(
         """
     select advertiser_id, advertiser_weekly_spend.advertiser_name, date_range_end_max - interval '1 day' one_days_before_max_ad_date from 
       (select advertiser_id, max(date_range_end) date_range_end_max 
@@ -485,41 +226,54 @@ def running_update_of_all_advertisers():
     ad_count = 0
     unrecognized_ad_count = 0
     start_time = datetime.now()
-    for advertiser in advertisers:
+    known_ads = {}  # advertiser_id -> KnownAds, from its latest attempt
+
+    def scrape_job(driver, advertiser):
         advertiser_id = advertiser["advertiser_id"]
+        known_ads[advertiser_id] = KnownAds.load(get_db(), advertiser_id)
         log.info(
-            "starting advertiser {} - {}".format(
-                advertiser["advertiser_name"], advertiser_id
+            "starting advertiser {} - {} ({} ads known)".format(
+                advertiser["advertiser_name"], advertiser_id, len(known_ads[advertiser_id])
             )
         )
-        start_date = advertiser["one_days_before_max_ad_date"]
-        for row in scrape_political_transparency_report(
-            advertiser_id, start_date, end_date
-        ):
-            ad_data = {k: None for k in AD_DATA_KEYS}
-            ad_data.update(row)
-            ad_data["advertiser_id"] = advertiser_id
-            write_row_to_db(ad_data)
-            ad_count += 1
-            if ad_data["error"] and ad_data["ad_type"] == "unknown":
-                unrecognized_ad_count += 1
+        return scrape_advertiser(
+            driver, advertiser_id, advertiser["one_days_before_max_ad_date"], end_date, known_ads[advertiser_id]
+        )
+
+    # the browsers scrape advertisers in parallel; their rows are all written here, by this thread.
+    pool = BrowserPool(new_chrome, scrape_job, row_key=lambda row: row["ad_id"])
+    for advertiser, row in pool.run(advertisers):
+        ad_data = {k: None for k in AD_DATA_KEYS}
+        ad_data.update(row)
+        ad_data["advertiser_id"] = advertiser["advertiser_id"]
+        write_row_to_db(ad_data)
+        ad_count += 1
+        if ad_data["error"] and ad_data["ad_type"] == "unknown":
+            unrecognized_ad_count += 1
     duration = datetime.now() - start_time
+    # ads skipped because they're already in the DB as they are now count as seen, for the warnings.
+    skipped_ad_count = sum(advertiser_known_ads.skipped for advertiser_known_ads in known_ads.values())
+    seen_ad_count = ad_count + skipped_ad_count
 
     AD_COUNT_WARN_THRESHOLD = 50
     ADVERTISER_COUNT_WARN_THRESHOLD = 10
     PER_AD_DURATION_WARN_THRESHOLD = 3  # seconds
     UNRECOGNIZED_AD_TYPE_COUNT_WARN_THRESHOLD = 0.1  # proportion
-    log_msg = "scraped {} ads from transparency report site from {} advertisers in {} ({} / advertiser, {}/ ad). {} ads of unrecognized type.".format(
+    log_msg = "scraped {} ads ({} more already known) from transparency report site from {} advertisers in {} ({} / advertiser, {}/ ad) with {} browsers ({} restarts). {} ads of unrecognized type. {} advertisers failed.".format(
         ad_count,
+        skipped_ad_count,
         len(advertisers),
         formattimedelta(duration),
         formattimedelta(duration / len(advertisers)),
-        formattimedelta(duration / ad_count),
+        formattimedelta(duration / max(seen_ad_count, 1)),
+        pool.workers,
+        pool.restarts,
         unrecognized_ad_count,
+        len(pool.failures),
     )
-    if AD_COUNT_WARN_THRESHOLD > ad_count:
+    if AD_COUNT_WARN_THRESHOLD > seen_ad_count:
         warn_msg = "political transparency report site scraper found fewer ads than expected (expected: {}, got: {})".format(
-            AD_COUNT_WARN_THRESHOLD, ad_count
+            AD_COUNT_WARN_THRESHOLD, seen_ad_count
         )
         log.warn(log_msg)
         log.warn(warn_msg)
@@ -531,17 +285,17 @@ def running_update_of_all_advertisers():
         log.warn(log_msg)
         log.warn(warn_msg)
         warn_to_slack("Google ads: " + log_msg + "\n" + warn_msg)
-    elif PER_AD_DURATION_WARN_THRESHOLD < (duration / ad_count).total_seconds():
+    elif PER_AD_DURATION_WARN_THRESHOLD < (duration / seen_ad_count).total_seconds():
         warn_msg = "political transparency report site scraper took longer than expected to scrape each ad (expected: {}, got: {})".format(
-            PER_AD_DURATION_WARN_THRESHOLD, (duration / ad_count).total_seconds()
+            PER_AD_DURATION_WARN_THRESHOLD, (duration / seen_ad_count).total_seconds()
         )
         log.warn(log_msg)
         log.warn(warn_msg)
         warn_to_slack("Google ads: " + log_msg + "\n" + warn_msg)
-    elif UNRECOGNIZED_AD_TYPE_COUNT_WARN_THRESHOLD < (unrecognized_ad_count / ad_count):
+    elif UNRECOGNIZED_AD_TYPE_COUNT_WARN_THRESHOLD < (unrecognized_ad_count / seen_ad_count):
         warn_msg = "political transparency report site scraper found a greater proportion of ads of unknown type (expected: < {}, got: {})".format(
             UNRECOGNIZED_AD_TYPE_COUNT_WARN_THRESHOLD,
-            (unrecognized_ad_count / ad_count),
+            (unrecognized_ad_count / seen_ad_count),
         )
         log.warn(log_msg)
         log.warn(warn_msg)
@@ -549,6 +303,15 @@ def running_update_of_all_advertisers():
     else:
         log.info(log_msg)
         info_to_slack("Google ads: " + log_msg)
+    # whether or not any of the above warned
+    if pool.failures:
+        warn_msg = "political transparency report site scraper failed to scrape {} advertisers: {}".format(
+            len(pool.failures),
+            ", ".join("{} ({!r})".format(advertiser["advertiser_id"], e) for advertiser, e in pool.failures),
+        )
+        log.warn(warn_msg)
+        warn_to_slack("Google ads: " + warn_msg)
+    log.info("waits: {}".format(wait_summary()))
 
 
 def main():
@@ -584,6 +347,4 @@ if __name__ == "__main__":
         sys.exit(1)
     load_dotenv(sys.argv[1])
     logging.info('ENV: %r', os.environ)
-    # TODO(macpd): move this out of global scope
-    DB = records.Database(os.environ['DATABASE_URL'])
     main()
@@ -0,0 +1,196 @@
+"""
+classifies the creative-preview tiles on a transparency report advertiser page, and pulls out their fields, in the browser.
+
+instead of a WebDriver round trip for every check and field of every tile (each miss costing a NoSuchElementException too),
+extract_tranche(driver) runs one script that classifies every tile not yet processed and returns what we need from each:
+
+    {"element": <the tile>, "ad_id": ..., "loading": <whether it still has a spinner>, "kind": ..., and the fields for its kind}
+
+where kind is one of TILE_KINDS. image ads drawn in an iframe are the exception: the parent page can't see into their (cross-origin)
+iframes, so ad_data_from_tile switches into the iframe, reads it with one more script, and switches back (into a nested iframe too,
+if there's one and no canvas). mark_processed(driver, tiles) then marks and empties a whole tranche in one call.
+"""
+
+import logging
+from datetime import date
+from urllib.parse import urljoin, urlparse, parse_qs
+
+log = logging.getLogger("google_political_transparency_report.political_transparency_report_site.tile_extraction")
+
+TILE_KINDS = ["youtube_video", "other_video", "text", "image_img", "image_iframe", "policy_violation", "unknown"]
+
+# the checks are in the order the scraper has always made them, since a tile can match more than one (e.g. a YouTube tile has an img.)
+TRANCHE_JS = """
+return Array.from(document.querySelectorAll("creative-preview:not(.alreadyprocessed)")).map(function (tile) {
+  var link = tile.querySelector("a");
+  var img = tile.querySelector("img");
+  var iframe = tile.querySelector("iframe");
+  var textAd = tile.querySelector("text-ad");
+  var unrenderable = tile.querySelector("unrenderable-ad");
+  var figcaption = tile.querySelector("figcaption");
+  var result = {
+    element: tile,
+    ad_id: link ? link.href.split("/").pop() : null,
+    loading: tile.querySelector("mat-progress-spinner") !== null
+  };
+  if (tile.querySelector("figure.video-preview")) {
+    result.kind = "youtube_video";
+    result.image_url = img ? img.src : null;
+  } else if (unrenderable && figcaption && figcaption.innerText.indexOf("Video ad") >= 0) {
+    result.kind = "other_video";
+  } else if (textAd) {
+    var icon = textAd.querySelector(".ad-icon");
+    if (icon) {
+      icon.parentNode.removeChild(icon);
+    }
+    result.kind = "text";
+    result.text = Array.from(textAd.querySelectorAll("div")).map(function (div) { return div.innerText.trim(); }).join("\\n");
+  } else if (img) {
+    result.kind = "image_img";
+    result.image_url = img.src;
+    result.destination = link ? link.href : null;
+  } else if (iframe) {
+    result.kind = "image_iframe";
+    result.iframe = iframe;
+    result.iframe_url = iframe.src;
+  } else if (unrenderable && unrenderable.innerText.indexOf("Policy violation") >= 0) {
+    result.kind = "policy_violation";
+  } else {
+    result.kind = "unknown";
+    result.html = tile.outerHTML;
+  }
+  return result;
+});
+"""
+
+# run inside an image ad's iframe
+IFRAME_JS = """
+var canvas = document.querySelector("canvas");
+var link = document.querySelector("a");
+var iframe = document.querySelector("iframe");
+return {
+  has_canvas: canvas !== null,
+  canvas_image_url: canvas ? window.getComputedStyle(canvas).getPropertyValue("background-url") : null,
+  destination: link ? link.href : null,
+  text: document.documentElement.innerText,
+  image_urls: Array.from(document.querySelectorAll("img")).map(function (img) { return img.src; }),
+  iframe: iframe,
+  iframe_url: iframe ? iframe.src : null
+};
+"""
+
+# iframes and stuff take up a lot of memory. we empty out elements once we've processed them.
+# (we empty them out, instead of removing them, because removing them causes weird behavior)
+MARK_PROCESSED_JS = """
+arguments[0].forEach(function (tile) {
+  tile.classList.add("alreadyprocessed");
+  tile.innerHTML = "";
+});
+"""
+
+
+def extract_tranche(driver):
+    """returns a dict (see above) for each creative-preview tile on the page that isn't marked as processed yet"""
+    return driver.execute_script(TRANCHE_JS)
+
+
+def mark_processed(driver, tiles):
+    if tiles:
+        driver.execute_script(MARK_PROCESSED_JS, [tile["element"] for tile in tiles])
+
+
+def extract_iframe(driver, tile):
+    """returns (what IFRAME_JS found, the URL of the frame it found it in) for an image_iframe tile, leaving the driver in the page's frame"""
+    driver.switch_to.frame(tile["iframe"])
+    try:
+        contents = driver.execute_script(IFRAME_JS)
+        if contents["has_canvas"] or contents["iframe"] is None:
+            return contents, tile["iframe_url"]
+        # an image ad, inside another iframe
+        nested_iframe_url = contents["iframe_url"]
+        driver.switch_to.frame(contents["iframe"])
+        return driver.execute_script(IFRAME_JS), nested_iframe_url
+    finally:
+        driver.switch_to.default_content()
+
+
+def ad_data_from_tile(driver, tile, advertiser_id):
+    """returns the row for `tile` (from extract_tranche) for google_ad_creatives, or None if it has no ad in it"""
+    ad_id = tile["ad_id"]
+    kind = tile["kind"]
+    if ad_id is None:
+        log.warning(f"tile without a link to its ad / advertiser: {advertiser_id}")
+        return None
+    log.debug(f"ad_id {ad_id}, kind {kind}")
+    if kind == "youtube_video":
+        if not tile["image_url"]:
+            log.warning(f"no img in YouTube ad {ad_id}")
+            return {"ad_id": ad_id, "error": True, "ad_type": "video"}
+        return {
+            "ad_id": ad_id,
+            "youtube_ad_id": tile["image_url"].split("/")[4],
+            "ad_type": "video",
+            "policy_violation_date": None,
+        }
+    if kind == "other_video":
+        return {
+            "ad_id": ad_id,
+            "ad_type": "video",
+            "error": True,
+            "policy_violation_date": None,
+        }
+    if kind == "text":
+        return {"ad_id": ad_id, "text": tile["text"], "ad_type": "text"}
+    if kind == "image_img":
+        destination = tile["destination"]
+        parsed_destination = parse_qs(urlparse(destination or "").query)
+        if "adurl" in parsed_destination and len(parsed_destination["adurl"]) >= 1:
+            destination = parsed_destination["adurl"][0]
+        return {
+            "ad_id": ad_id,
+            "text": None,
+            "error": False,
+            "image_url": tile["image_url"],
+            "image_urls": None,
+            "destination": destination,
+            "ad_type": "image",
+            "policy_violation_date": None,
+        }
+    if kind == "image_iframe":
+        contents, frame_url = extract_iframe(driver, tile)
+        if contents["has_canvas"]:
+            # image and text ad
+            # (the destination is occasionally missing, e.g. https://transparencyreport.google.com/political-ads/advertiser/AR182710451392479232/creative/CR315072959679037440)
+            image_url = contents["canvas_image_url"]
+            image_urls = None
+            ad_text = contents["text"]
+        else:
+            image_url = None
+            image_urls = [urljoin(frame_url, src) for src in contents["image_urls"]]
+            ad_text = None
+        return {
+            "ad_id": ad_id,
+            "text": ad_text,
+            "error": False,
+            "image_url": image_url,
+            "image_urls": image_urls,
+            "destination": contents["destination"],
+            "ad_type": "image",
+            "policy_violation_date": None,
+        }
+    if kind == "policy_violation":
+        return {
+            "ad_id": ad_id,
+            "error": False,
+            "ad_type": "unknown",
+            "policy_violation_date": date.today(),
+        }
+    # sometimes this appears to happen sporadically, like the page isn't done loading yet?
+    log.warning(f"unrecognized ad type {ad_id} / advertiser: {advertiser_id}")
+    log.debug(tile["html"])
+    return {
+        "ad_id": ad_id,
+        "error": True,
+        "ad_type": "unknown",
+        "policy_violation_date": None,
+    }
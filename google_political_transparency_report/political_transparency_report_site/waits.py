@@ -0,0 +1,159 @@
+"""
+waits for the transparency report page to change, instead of sleeping for our worst-case guess of how long it takes.
+
+wait_for(driver, name, condition) waits until `condition` (one of CONDITIONS, checked in the page) holds.
+each check is one async script that watches the page with a MutationObserver and returns as soon as the condition holds,
+or after MUTATION_SLICE; WebDriverWait repeats it until the timeout. so a wait ends within a few ms of the DOM changing,
+rather than on the next poll.
+
+the timeout for each named wait (e.g. "page_load") is learned: once there are MIN_SAMPLES waits that succeeded, it's
+TIMEOUT_FACTOR times the 95th percentile of how long they took, between MIN_TIMEOUT and the wait's max_timeout (the old fixed sleep),
+so a wait that's probably not going to succeed (e.g. an advertiser with no ads in the date range) is noticed about when a slow page
+would've been done. it's then retried once, for up to max_timeout, before wait_for gives up, so a page that's just slower than usual
+isn't taken to be empty; and its duration, learned timeout and all, is a sample too, so slower pages raise the timeout.
+after MISSES_TO_RESET waits in a row outlast the learned timeout, it's forgotten, and the waits go back to max_timeout until it's relearned.
+
+every wait's duration is recorded; wait_summary() describes them, per name, for the scraper's log.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+log = logging.getLogger("google_political_transparency_report.political_transparency_report_site.waits")
+
+MUTATION_SLICE = 0.5 # seconds
+POLL_FREQUENCY = 0.01 # seconds between slices; WebDriverWait won't take 0
+MIN_SAMPLES = 10
+SAMPLES_KEPT = 200
+TIMEOUT_FACTOR = 3
+MIN_TIMEOUT = 1 # seconds
+MISSES_TO_RESET = 3
+
+UNPROCESSED_TILES = "unprocessed_tiles"
+NO_SPINNERS = "no_spinners"
+CONDITIONS = [UNPROCESSED_TILES, NO_SPINNERS]
+
+MUTATION_WAIT_JS = """
+var condition = arguments[0];
+var sliceMs = arguments[1];
+var done = arguments[arguments.length - 1];
+var conditions = {
+  unprocessed_tiles: function () { return document.querySelector("creative-preview:not(.alreadyprocessed)") !== null; },
+  no_spinners: function () { return document.querySelector("creative-preview:not(.alreadyprocessed) mat-progress-spinner") === null; }
+};
+var check = conditions[condition];
+if (check()) {
+  done(true);
+  return;
+}
+var timer;
+var observer = new MutationObserver(function () {
+  if (check()) {
+    observer.disconnect();
+    clearTimeout(timer);
+    done(true);
+  }
+});
+observer.observe(document.body, {childList: true, subtree: true, attributes: true});
+timer = setTimeout(function () {
+  observer.disconnect();
+  done(false);
+}, sliceMs);
+"""
+
+
+class WaitTimings:
+    """how long the waits with one name took, and the timeout that implies"""
+    def __init__(self, name, max_timeout):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.durations = deque(maxlen=SAMPLES_KEPT) # of waits that succeeded
+        self.count = 0
+        self.timeouts = 0
+        self.misses = 0 # waits in a row that outlasted the learned timeout
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def timeout(self):
+        with self.lock:
+            if len(self.durations) < MIN_SAMPLES:
+                return self.max_timeout
+            durations = sorted(self.durations)
+        percentile_95 = durations[int(0.95 * (len(durations) - 1))]
+        return max(MIN_TIMEOUT, min(self.max_timeout, TIMEOUT_FACTOR * percentile_95))
+
+    def record(self, duration, succeeded, missed=False):
+        """records a wait that took `duration`, and whether it `succeeded` in the end, and `missed` the learned timeout"""
+        with self.lock:
+            self.count += 1
+            self.total += duration
+            if succeeded:
+                self.durations.append(duration)
+            else:
+                self.timeouts += 1
+            self.misses = self.misses + 1 if missed else 0
+            if self.misses >= MISSES_TO_RESET:
+                log.info("{} waits in a row outlasted the learned {} timeout; relearning it".format(self.misses, self.name))
+                self.durations.clear()
+                self.misses = 0
+
+    def __str__(self):
+        return "{}: {} waits, {:.2f}s average, {} timed out, timeout now {:.1f}s".format(
+            self.name, self.count, self.total / self.count if self.count else 0, self.timeouts, self.timeout())
+
+
+_timings = {} # name -> WaitTimings, shared by every browser in the process
+_timings_lock = threading.Lock()
+
+
+def timings(name, max_timeout):
+    with _timings_lock:
+        if name not in _timings:
+            _timings[name] = WaitTimings(name, max_timeout)
+        return _timings[name]
+
+
+class dom_condition:
+    """a WebDriverWait condition: whether `condition` holds, waiting up to MUTATION_SLICE in the page for it to"""
+    def __init__(self, condition):
+        self.condition = condition
+
+    def __call__(self, driver):
+        return driver.execute_async_script(MUTATION_WAIT_JS, self.condition, int(MUTATION_SLICE * 1000))
+
+
+def wait_until(driver, condition, timeout):
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY).until(dom_condition(condition))
+        return True
+    except TimeoutException:
+        return False
+
+
+def wait_for(driver, name, condition, max_timeout):
+    """
+    waits until `condition` holds, up to the learned timeout for `name`, and then once more for up to max_timeout;
+    returns whether it held
+    """
+    wait_timings = timings(name, max_timeout)
+    timeout = wait_timings.timeout()
+    start_time = time.monotonic()
+    succeeded = wait_until(driver, condition, timeout)
+    missed = not succeeded and timeout < max_timeout
+    if missed:
+        log.info("{} took longer than its learned timeout ({:.1f}s); waiting up to {}s more".format(name, timeout, max_timeout))
+        succeeded = wait_until(driver, condition, max_timeout)
+    duration = time.monotonic() - start_time
+    wait_timings.record(duration, succeeded, missed)
+    log.debug("waited {:.2f}s for {} ({}){}".format(duration, name, condition, "" if succeeded else ", timed out"))
+    return succeeded
+
+
+def wait_summary():
+    with _timings_lock:
+        return "; ".join(str(wait_timings) for wait_timings in _timings.values())
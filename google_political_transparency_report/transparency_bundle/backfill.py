@@ -0,0 +1,167 @@
+"""
+backfills the DB from many old bundles at once: either a directory of bundle zips, or a range of dates in the local bundle archive (see bundle_archive.py).
+
+advertiser_regional_spend, a time series across bundles, is loaded from every bundle,
+up to BACKFILL_WORKERS (env var, default 4) bundles at a time, each in its own process.
+the weekly spend CSV is cumulative (every week since 2018 is in every bundle), and a load overwrites any week whose figures changed, so
+advertiser_weekly_spend is loaded, in full, from the newest bundle only. advertiser_stats and creative_stats hold only the latest state,
+so they're only loaded from the newest bundle too. and all three are only loaded if that bundle's at least as new as what's already
+in the DB: an old bundle mustn't overwrite newer data.
+(if regional spend is stored as deltas, see load_advertiser_regional_spend.py, it has to be loaded in date order, so it's loaded
+one bundle at a time, oldest first, after the rest.)
+
+every load is recorded in the bundle_table_loads ledger (see bundle_ledger.py) and skipped if it's already there,
+so a backfill that crashed can just be run again, and it'll pick up where it stopped.
+
+usage: python -m google_political_transparency_report.transparency_bundle.backfill <env file path> <directory of bundle zips>
+       python -m google_political_transparency_report.transparency_bundle.backfill <env file path> <start date> [<end date>]
+"""
+
+import datetime
+import glob
+import logging
+import os
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from .get_transparency_bundle import Bundle, get_advertiser_weekly_spend_csv, get_advertiser_regional_spend_csv, get_advertiser_stats_csv, get_creative_stats_csv
+from .bundle_archive import archived_bundle_dates, open_archived_bundle
+from .bundle_ledger import is_table_loaded
+from .load_advertiser_weekly_spend import load_advertiser_weekly_spend_to_db
+from .load_advertiser_regional_spend import load_advertiser_regional_spend_to_db, regional_spend_storage, regional_spend_table
+from .load_advertiser_stats import load_advertiser_stats_to_db
+from .load_creative_stats import load_creative_stats_to_db
+from ..common.database import get_db
+from ..common.formattimedelta import formattimedelta
+from ..common.post_to_slack import info_to_slack, warn_to_slack
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.backfill")
+
+BACKFILL_WORKERS = 4
+
+
+def load_advertiser_weekly_spend_history_to_db(csv_filelike, bundle_date):
+    # weekly spend is a time series within each bundle, so load all of it, not just the recent weeks.
+    load_advertiser_weekly_spend_to_db(csv_filelike, bundle_date, full_history=True)
+
+TIME_SERIES_TABLES = {
+    "advertiser_regional_spend": (get_advertiser_regional_spend_csv, load_advertiser_regional_spend_to_db),
+}
+CUMULATIVE_TABLES = {
+    "advertiser_weekly_spend": (get_advertiser_weekly_spend_csv, load_advertiser_weekly_spend_history_to_db),
+}
+LATEST_STATE_TABLES = {
+    "advertiser_stats": (get_advertiser_stats_csv, load_advertiser_stats_to_db),
+    "creative_stats": (get_creative_stats_csv, load_creative_stats_to_db),
+}
+TABLES = {**TIME_SERIES_TABLES, **CUMULATIVE_TABLES, **LATEST_STATE_TABLES}
+
+
+def open_bundle(zip_fn, bundle_date):
+    """a bundle in the backfill is either a zip file or (if zip_fn is None) a date in the bundle archive"""
+    return Bundle(open(zip_fn, 'rb')) if zip_fn else open_archived_bundle(bundle_date)
+
+
+def bundles_in_directory(directory):
+    """returns a list of (bundle date, zip path) of the bundle zips in `directory`, oldest first"""
+    bundles = {}
+    for zip_fn in glob.glob(os.path.join(directory, "*.zip")):
+        with open_bundle(zip_fn, None) as bundle:
+            bundle_date = bundle.bundle_date
+        if bundle_date in bundles:
+            log.warning("skipping {}, a second bundle for {} (after {})".format(zip_fn, bundle_date, bundles[bundle_date]))
+            continue
+        bundles[bundle_date] = zip_fn
+    return sorted(bundles.items())
+
+
+def bundles_in_archive(start_date, end_date):
+    """returns a list of (bundle date, None) of the archived bundles from start_date through end_date, oldest first"""
+    return [(bundle_date, None) for bundle_date in archived_bundle_dates() if start_date <= bundle_date <= end_date]
+
+
+def ledger_table(table):
+    """the name a load of `table` is recorded under in bundle_table_loads"""
+    return regional_spend_table() if table == "advertiser_regional_spend" else table
+
+
+def unloaded_tables(DB, tables, bundle_date):
+    return [table for table in tables if not is_table_loaded(DB, ledger_table(table), bundle_date)]
+
+
+def load_tables(zip_fn, bundle_date, tables):
+    """worker: loads `tables` (names of TABLES) from one bundle"""
+    with open_bundle(zip_fn, bundle_date) as bundle:
+        for table in tables:
+            get_csv, load = TABLES[table]
+            with get_csv(bundle) as csv:
+                load(csv, bundle_date)
+
+
+def is_at_least_as_new_as_db(DB, table, bundle_date):
+    # the newest bundle loaded is in the ledger (or, from before the ledger, a latest-state table's max report_date, when a row last changed.)
+    table_max_report_date = "(SELECT max(report_date) FROM {})".format(table) if table in LATEST_STATE_TABLES else "NULL"
+    max_report_date = DB.query("""SELECT greatest({}, (SELECT max(bundle_date) FROM bundle_table_loads WHERE table_name = :table)) report_date;""".format(table_max_report_date), table=table)[0]["report_date"]
+    if max_report_date and bundle_date < max_report_date:
+        log.info("not loading {} from bundle {}: the DB already has {}".format(table, bundle_date, max_report_date))
+        return False
+    return True
+
+
+def backfill(bundles, workers=None):
+    """loads `bundles`, a list of (bundle date, zip path or None for the archive) from bundles_in_directory or bundles_in_archive"""
+    workers = workers or int(os.environ.get("BACKFILL_WORKERS", BACKFILL_WORKERS))
+    DB = get_db()
+    start_time = datetime.datetime.now()
+    in_order_tables = ["advertiser_regional_spend"] if regional_spend_storage() == "delta" else []
+    parallel_tables = [table for table in TIME_SERIES_TABLES if table not in in_order_tables]
+    pending = [(bundle_date, zip_fn) for bundle_date, zip_fn in bundles if unloaded_tables(DB, TIME_SERIES_TABLES, bundle_date)]
+    log.info("backfilling {} bundles ({} already loaded) with {} workers".format(len(pending), len(bundles) - len(pending), workers))
+    failures = []
+    # forkserver, not fork: this process may have threads (e.g. the DB's connection pool) by now.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        futures = {pool.submit(load_tables, zip_fn, bundle_date, parallel_tables): bundle_date for bundle_date, zip_fn in pending if parallel_tables}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                future.result()
+                log.info("backfilled bundle {} ({}/{})".format(futures[future], i + 1, len(futures)))
+            except Exception as e:
+                log.exception("backfilling bundle {} failed".format(futures[future]))
+                failures.append((futures[future], e))
+    for bundle_date, zip_fn in pending:
+        if failures:
+            break
+        if unloaded_tables(DB, in_order_tables, bundle_date):
+            load_tables(zip_fn, bundle_date, in_order_tables)
+    if bundles:
+        newest_bundle_date, newest_zip_fn = bundles[-1]
+        newest_bundle_tables = [table for table in unloaded_tables(DB, CUMULATIVE_TABLES, newest_bundle_date) + list(LATEST_STATE_TABLES) if is_at_least_as_new_as_db(DB, table, newest_bundle_date)]
+        if newest_bundle_tables:
+            load_tables(newest_zip_fn, newest_bundle_date, newest_bundle_tables)
+    if failures:
+        raise Exception("backfill failed for bundles {}".format(", ".join("{} ({!r})".format(bundle_date, e) for bundle_date, e in failures)))
+    log1 = "backfilled {} bundles in {}".format(len(pending), formattimedelta(datetime.datetime.now() - start_time))
+    log.info(log1)
+    info_to_slack("Google ads: " + log1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('USAGE: {} <env file path> <directory of bundle zips> | <start date> [<end date>]'.format(sys.argv[0]))
+        sys.exit(1)
+    load_dotenv(sys.argv[1])
+    logging.basicConfig(level=logging.INFO)
+    try:
+        if os.path.isdir(sys.argv[2]):
+            bundles = bundles_in_directory(sys.argv[2])
+        else:
+            end_date = datetime.date.fromisoformat(sys.argv[3]) if len(sys.argv) >= 4 else datetime.date.today()
+            bundles = bundles_in_archive(datetime.date.fromisoformat(sys.argv[2]), end_date)
+        backfill(bundles)
+    except Exception as e:
+        warn_to_slack(f"google_political_transparency_report.transparency_bundle.backfill error: {e}")
+        log.error(e)
+        raise e
@@ -0,0 +1,111 @@
+"""
+benchmark for parsing the creative stats CSV in parallel (see parallel_csv.py), without a database.
+
+times parsing + COPY-encoding a creative stats CSV serially and then with 2, 4, ... workers, up to the number of CPUs.
+(one worker is just the serial parse plus the cost of shipping every range to another process, so the loader never does that.)
+only set CREATIVE_STATS_PARSE_WORKERS on a host where this shows a real speedup over serial on a bundle-sized CSV.
+each run feeds the same stream the loader hands to COPY (CsvRowStream serially, CsvChunkStream in parallel), read
+COPY_READ_SIZE bytes at a time as psycopg2's copy_expert does, so this measures how fast we can feed the COPY, not the COPY itself.
+if you don't pass a CSV, a synthetic one (with quoted commas and newlines, like the real one) is generated.
+
+usage: python -m google_political_transparency_report.transparency_bundle.benchmark_parallel_parse [creative stats csv] [rows to generate]
+"""
+
+import csv
+import os
+import tempfile
+from datetime import date, datetime
+from functools import partial
+from sys import argv
+
+from .load_creative_stats import CREATIVE_STATS_COLUMN_TYPES, COPY_KEYS, parse_creative_stats, parse_creative_stats_range
+from .copy_rows import CsvRowStream, CsvChunkStream
+from .parallel_csv import parse_csv_in_parallel
+
+REPORT_DATE = date(2021, 1, 1)
+SYNTHETIC_ROW_COUNT = 500_000
+COPY_READ_SIZE = 8192 # what psycopg2's copy_expert asks for
+
+
+def synthetic_value(column, i):
+    if column == "Ad_ID":
+        return "CR{}".format(i)
+    elif column == "Advertiser_ID":
+        return "AR{}".format(i % 5000)
+    elif column == "Advertiser_Name":
+        return "ADVERTISER {}, INC.".format(i % 5000)
+    elif column == "Ad_Type":
+        return ["Text", "Image", "Video"][i % 3]
+    elif column == "Regions":
+        return "US"
+    elif column == "Ad_Campaigns_List":
+        return "False"
+    elif column == "Impressions":
+        return ["≤ 10k", "10k-100k", "100k-1M", "> 10M"][i % 4]
+    elif column in ("Date_Range_Start", "Date_Range_End"):
+        return "2020-10-{:02d}".format(i % 28 + 1)
+    elif column.endswith("_Timestamp"):
+        return "2020-10-{:02d} 12:00:00 UTC".format(i % 28 + 1)
+    elif column == "Geo_Targeting_Included":
+        return "Arizona,United States\nPennsylvania,United States" if i % 10 == 0 else "United States"
+    elif column == "Spend_USD":
+        return "100-1k"
+    elif column == "Num_of_Days" or column.startswith("Spend_Range"):
+        return str(i % 1000)
+    else:
+        return "Not targeted"
+
+
+def write_synthetic_csv(f, row_count):
+    columns = list(CREATIVE_STATS_COLUMN_TYPES.keys())
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for i in range(row_count):
+        writer.writerow([synthetic_value(c, i) for c in columns])
+
+
+def drain(stream):
+    """reads `stream` to the end the way copy_expert does"""
+    while stream.read(COPY_READ_SIZE):
+        pass
+
+
+def time_serial(path):
+    start = datetime.now()
+    with open(path, newline="") as f:
+        stream = CsvRowStream(parse_creative_stats(f, REPORT_DATE), COPY_KEYS)
+        drain(stream)
+    return stream.row_count, (datetime.now() - start).total_seconds()
+
+
+def time_parallel(path, workers):
+    start = datetime.now()
+    row_counts = []
+    def chunks():
+        for range_row_count, text in parse_csv_in_parallel(f, partial(parse_creative_stats_range, report_date=REPORT_DATE), workers):
+            row_counts.append(range_row_count)
+            yield text
+    with open(path, newline="") as f:
+        drain(CsvChunkStream(chunks()))
+    return sum(row_counts), (datetime.now() - start).total_seconds()
+
+
+def benchmark(path):
+    row_count, serial_seconds = time_serial(path)
+    print("{} rows, {} MB".format(row_count, os.path.getsize(path) // (1024 * 1024)))
+    print("serial:     {:7.2f}s {:9.0f} rows/s".format(serial_seconds, row_count / serial_seconds))
+    workers = 2
+    while workers <= max(os.cpu_count(), 2):
+        row_count, seconds = time_parallel(path, workers)
+        print("{:2d} workers: {:7.2f}s {:9.0f} rows/s  {:.2f}x serial".format(workers, seconds, row_count / seconds, serial_seconds / seconds))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    if len(argv) >= 2 and argv[1] != "-":
+        benchmark(argv[1])
+    else:
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="") as f:
+            write_synthetic_csv(f, int(argv[2]) if len(argv) >= 3 else SYNTHETIC_ROW_COUNT)
+            f.flush()
+            benchmark(f.name)
@@ -0,0 +1,51 @@
+"""
+benchmark for uploading CSVs (see gcs_upload.py) with each compression, one at a time and concurrently.
+
+uses GCS_LOCAL_DIR if it's set (or a temp dir if not), so it measures compression and the upload path,
+not the network; set GCS_LOCAL_DIR= (empty) and GCS_BUCKET to upload to a real bucket instead.
+if you don't pass any CSVs, the synthetic creative stats CSV from benchmark_parallel_parse is used.
+
+usage: python -m google_political_transparency_report.transparency_bundle.benchmark_upload [csv ...]
+"""
+
+import os
+import tempfile
+from datetime import datetime
+from sys import argv
+
+from . import gcs_upload
+from .benchmark_parallel_parse import write_synthetic_csv
+
+SYNTHETIC_ROW_COUNT = 100_000
+
+
+def time_uploads(paths, compression, workers):
+    start = datetime.now()
+    gcs_upload.upload_files([("benchmark/{}".format(os.path.basename(path)), path) for path in paths], workers=workers, compression=compression)
+    return (datetime.now() - start).total_seconds()
+
+
+def benchmark(paths):
+    megabytes = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+    print("{} files, {:.1f} MB".format(len(paths), megabytes))
+    for compression in gcs_upload.COMPRESSIONS:
+        if compression == "zstd" and gcs_upload.zstandard is None:
+            print("zstd: skipped, zstandard isn't installed")
+            continue
+        serial_seconds = time_uploads(paths, compression, 1)
+        concurrent_seconds = time_uploads(paths, compression, gcs_upload.UPLOAD_WORKERS)
+        print("{:5s} serial: {:7.2f}s {:7.1f} MB/s   concurrent: {:7.2f}s {:7.1f} MB/s".format(compression, serial_seconds, megabytes / serial_seconds, concurrent_seconds, megabytes / concurrent_seconds))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if "GCS_LOCAL_DIR" not in os.environ:
+            os.environ["GCS_LOCAL_DIR"] = tmpdir
+        paths = argv[1:]
+        if not paths:
+            for i in range(gcs_upload.UPLOAD_WORKERS):
+                path = os.path.join(tmpdir, "synthetic-{}.csv".format(i))
+                with open(path, "w", newline="") as f:
+                    write_synthetic_csv(f, SYNTHETIC_ROW_COUNT)
+                paths.append(path)
+        benchmark(paths)
@@ -0,0 +1,245 @@
+"""
+a local archive of transparency bundles, one per bundle date, in the directory in env var BUNDLE_ARCHIVE_DIR
+(by default, data/bundle_archive at the top of the repo.)
+
+most of each day's bundle is the same as the day before's: the small CSVs often don't change at all,
+and most of the rows of the big ones don't either. so instead of keeping a zip per day, each member of
+the bundle is split into chunks, and each chunk is stored (zlib-compressed) once, under its sha256:
+
+    chunks/ab/ab12...ef.z
+    manifests/2021-01-01.json    {"bundle_date": "2021-01-01", "members": [{"name": ..., "size": ..., "chunks": [sha256, ...]}, ...]}
+
+chunk boundaries are content-defined: a chunk ends after a line whose crc32 has CHUNK_BOUNDARY_BITS low zero bits
+(once the chunk is at least MIN_CHUNK_SIZE), so inserting or deleting a row only changes the chunk it's in,
+not every chunk after it.
+
+ - archive_bundle(bundle) stores a Bundle (see get_transparency_bundle.py)
+ - open_archived_bundle(bundle_date) returns a Bundle rebuilt from the archive, for the loaders
+ - materialize_bundle(bundle_date, dest) writes a zip just like the one we downloaded
+ - apply_retention(today) deletes manifests the retention policy doesn't keep, then the chunks nothing references:
+   every bundle from the last BUNDLE_ARCHIVE_KEEP_DAYS days (default 90), and the first bundle of each month before that
+   unless BUNDLE_ARCHIVE_KEEP_MONTHLY is "false".
+
+a chunk can be stored, or read, while a manifest that will reference it (or does) isn't written yet, or is being deleted;
+so archiving and reading bundles take a shared lock (an flock of the archive's .lock file), and retention an exclusive one,
+so that garbage collection never runs alongside them and deletes chunks they're using.
+
+usage: python -m google_political_transparency_report.transparency_bundle.bundle_archive <env file path> list|retain|materialize <date> <dest zip>
+"""
+
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import zlib
+from contextlib import contextmanager
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+from dotenv import load_dotenv
+
+from .get_transparency_bundle import Bundle
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.bundle_archive")
+
+DEFAULT_BUNDLE_ARCHIVE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'bundle_archive')
+CHUNK_BOUNDARY_BITS = 10 # a boundary every ~1024 lines
+MIN_CHUNK_SIZE = 64 * 1024 # bytes
+MAX_CHUNK_SIZE = 4 * 1024 * 1024 # bytes
+CHUNK_COMPRESSION_LEVEL = 6
+
+
+def archive_dir():
+    return os.environ.get("BUNDLE_ARCHIVE_DIR", DEFAULT_BUNDLE_ARCHIVE_DIR)
+
+def manifest_path(bundle_date):
+    return os.path.join(archive_dir(), "manifests", "{}.json".format(bundle_date))
+
+def chunk_path(digest):
+    return os.path.join(archive_dir(), "chunks", digest[:2], digest + ".z")
+
+def lock_path():
+    return os.path.join(archive_dir(), ".lock")
+
+
+@contextmanager
+def archive_lock(exclusive=False):
+    """holds a lock on the archive (shared, or exclusive) for the duration of the block"""
+    os.makedirs(archive_dir(), exist_ok=True)
+    with open(lock_path(), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_atomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp-", delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def split_into_chunks(member_filelike):
+    """yields the bytes of `member_filelike` (a binary stream) in content-defined chunks, each a whole number of lines"""
+    boundary_mask = (1 << CHUNK_BOUNDARY_BITS) - 1
+    chunk = bytearray()
+    for line in member_filelike:
+        chunk += line
+        if len(chunk) >= MAX_CHUNK_SIZE or (len(chunk) >= MIN_CHUNK_SIZE and zlib.crc32(line) & boundary_mask == 0):
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+
+def store_chunk(chunk):
+    """stores `chunk` if it isn't already in the archive; returns (its sha256, whether it was new)"""
+    digest = hashlib.sha256(chunk).hexdigest()
+    path = chunk_path(digest)
+    if os.path.exists(path):
+        return digest, False
+    write_atomically(path, zlib.compress(chunk, CHUNK_COMPRESSION_LEVEL))
+    return digest, True
+
+
+def read_chunk(digest):
+    with open(chunk_path(digest), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+def archived_bundle_dates():
+    try:
+        filenames = os.listdir(os.path.join(archive_dir(), "manifests"))
+    except FileNotFoundError:
+        return []
+    return sorted(datetime.date.fromisoformat(fn[:-len(".json")]) for fn in filenames if fn.endswith(".json"))
+
+
+def is_bundle_archived(bundle_date):
+    return os.path.exists(manifest_path(bundle_date))
+
+
+def get_manifest(bundle_date):
+    with open(manifest_path(bundle_date)) as f:
+        return json.load(f)
+
+
+def archive_bundle(bundle, bundle_date=None):
+    """stores every member of `bundle` (a Bundle) in the archive, unless a bundle for its date is already there"""
+    bundle_date = bundle_date or bundle.bundle_date
+    with archive_lock():
+        store_bundle(bundle, bundle_date)
+
+
+def store_bundle(bundle, bundle_date):
+    if is_bundle_archived(bundle_date):
+        log.info("bundle {} already archived".format(bundle_date))
+        return
+    members = []
+    total_size = new_size = 0
+    for name in bundle.zip.namelist():
+        if name.endswith("/"):
+            continue
+        digests = []
+        size = 0
+        with bundle.zip.open(name) as member:
+            for chunk in split_into_chunks(member):
+                digest, is_new = store_chunk(chunk)
+                digests.append(digest)
+                size += len(chunk)
+                if is_new:
+                    new_size += len(chunk)
+        members.append({"name": name, "size": size, "chunks": digests})
+        total_size += size
+    # the manifest goes last, so a bundle is only ever archived with all its chunks.
+    write_atomically(manifest_path(bundle_date), json.dumps({"bundle_date": str(bundle_date), "members": members}).encode("utf-8"))
+    log.info("archived bundle {}: {} bytes, {} of them new".format(bundle_date, total_size, new_size))
+
+
+def materialize_bundle(bundle_date, dest, compression=ZIP_DEFLATED):
+    """writes the archived bundle for `bundle_date` as a zip to `dest` (a path or a seekable binary file-like)"""
+    with archive_lock():
+        manifest = get_manifest(bundle_date)
+        with ZipFile(dest, 'w', compression=compression, allowZip64=True) as zf:
+            for member in manifest["members"]:
+                with zf.open(member["name"], 'w', force_zip64=member["size"] > 0x7FFFFFFF) as f:
+                    for digest in member["chunks"]:
+                        f.write(read_chunk(digest))
+
+
+def open_archived_bundle(bundle_date):
+    """returns a Bundle for the archived bundle for `bundle_date`, rebuilt (uncompressed, which is quicker) in a temp file"""
+    spool = tempfile.TemporaryFile(prefix="google-political-ads-transparency-bundle-", suffix=".zip")
+    try:
+        materialize_bundle(bundle_date, spool, compression=ZIP_STORED)
+        spool.seek(0)
+        return Bundle(spool)
+    except:
+        spool.close()
+        raise
+
+
+def retained_bundle_dates(bundle_dates, today):
+    keep_days = int(os.environ.get("BUNDLE_ARCHIVE_KEEP_DAYS", 90))
+    keep_monthly = os.environ.get("BUNDLE_ARCHIVE_KEEP_MONTHLY", "true").lower() != "false"
+    retained = set()
+    months_seen = set()
+    for bundle_date in sorted(bundle_dates):
+        if (today - bundle_date).days < keep_days:
+            retained.add(bundle_date)
+        elif keep_monthly and (bundle_date.year, bundle_date.month) not in months_seen:
+            retained.add(bundle_date)
+        months_seen.add((bundle_date.year, bundle_date.month))
+    return retained
+
+
+def collect_garbage():
+    """deletes chunks that no manifest references; returns how many. call it with the archive locked exclusively."""
+    referenced = set()
+    for bundle_date in archived_bundle_dates():
+        for member in get_manifest(bundle_date)["members"]:
+            referenced.update(member["chunks"])
+    deleted = 0
+    chunks_dir = os.path.join(archive_dir(), "chunks")
+    for dirpath, _, filenames in os.walk(chunks_dir):
+        for fn in filenames:
+            if fn.endswith(".z") and fn[:-len(".z")] not in referenced:
+                os.remove(os.path.join(dirpath, fn))
+                deleted += 1
+    return deleted
+
+
+def apply_retention(today=None):
+    today = today or datetime.date.today()
+    with archive_lock(exclusive=True):
+        bundle_dates = archived_bundle_dates()
+        retained = retained_bundle_dates(bundle_dates, today)
+        for bundle_date in bundle_dates:
+            if bundle_date not in retained:
+                log.info("deleting archived bundle {}".format(bundle_date))
+                os.remove(manifest_path(bundle_date))
+        deleted_chunks = collect_garbage()
+    log.info("retained {} of {} archived bundles; deleted {} unreferenced chunks".format(len(retained), len(bundle_dates), deleted_chunks))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('USAGE: {} <env file path> list|retain|materialize <date> <dest zip>'.format(sys.argv[0]))
+        sys.exit(1)
+    load_dotenv(sys.argv[1])
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[2] == "list":
+        for bundle_date in archived_bundle_dates():
+            print(bundle_date)
+    elif sys.argv[2] == "retain":
+        apply_retention()
+    elif sys.argv[2] == "materialize":
+        materialize_bundle(datetime.date.fromisoformat(sys.argv[3]), sys.argv[4])
+    else:
+        print('USAGE: {} <env file path> list|retain|materialize <date> <dest zip>'.format(sys.argv[0]))
+        sys.exit(1)
@@ -0,0 +1,36 @@
+"""
+bookkeeping for the transparency bundle, in the SQL db specified as env var DATABASE_URL
+
+ - bundle_fetches remembers the ETag, Last-Modified and md5 of each bundle we've loaded,
+   so the next fetch can be conditional and we can tell when Google hasn't republished the bundle.
+ - bundle_table_loads records which tables have already been loaded for a given bundle_date,
+   so a loader that gets run twice for the same bundle doesn't redo its work.
+"""
+
+import logging
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.bundle_ledger")
+
+
+def get_last_bundle_fetch(DB):
+    """returns the most recent bundle_fetches row (etag, last_modified, content_md5, bundle_date), or None"""
+    rows = DB.query("SELECT etag, last_modified, content_md5, bundle_date FROM bundle_fetches ORDER BY fetched_at DESC LIMIT 1;").all()
+    return rows[0] if rows else None
+
+
+def record_bundle_fetch(DB, bundle_fetch, bundle_date):
+    DB.query("INSERT INTO bundle_fetches (bundle_date, etag, last_modified, content_md5) VALUES (:bundle_date, :etag, :last_modified, :content_md5);",
+        bundle_date=bundle_date, etag=bundle_fetch["etag"], last_modified=bundle_fetch["last_modified"], content_md5=bundle_fetch["content_md5"])
+
+
+def is_table_loaded(DB, table_name, bundle_date):
+    rows = DB.query("SELECT 1 FROM bundle_table_loads WHERE table_name = :table_name AND bundle_date = :bundle_date;", table_name=table_name, bundle_date=bundle_date).all()
+    if rows:
+        log.info("{} already loaded for bundle {}, skipping".format(table_name, bundle_date))
+    return bool(rows)
+
+
+def record_table_load(DB, table_name, bundle_date, row_count=None):
+    DB.query("""INSERT INTO bundle_table_loads (table_name, bundle_date, row_count) VALUES (:table_name, :bundle_date, :row_count)
+                ON CONFLICT (table_name, bundle_date) DO UPDATE SET row_count = :row_count, loaded_at = now();""",
+        table_name=table_name, bundle_date=bundle_date, row_count=row_count)
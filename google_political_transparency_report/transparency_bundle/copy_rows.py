@@ -0,0 +1,120 @@
+"""
+bulk loading with PostgreSQL's COPY FROM STDIN, for the big bundle CSVs.
+
+rows are encoded as CSV lazily, as psycopg2 asks for more data, and streamed into a temporary staging table
+(e.g. creative_stats_staging, shaped like creative_stats); the loader then merges the staging table
+into the real table with one set-based INSERT ... SELECT ... ON CONFLICT, in the same transaction.
+the staging table is private to that transaction, so loads of the same table can run at once (e.g. in backfill.py.)
+"""
+
+import csv
+import io
+from collections import deque
+
+COPY_NULL = "\\N"
+
+
+def encode_rows(rows, columns):
+    """returns (row count, CSV text for COPY) of `columns` from each dict in `rows`, e.g. to encode rows in a worker process"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    row_count = 0
+    for row in rows:
+        writer.writerow([COPY_NULL if row[c] is None else row[c] for c in columns])
+        row_count += 1
+    return row_count, buffer.getvalue()
+
+
+class PendingText:
+    """text waiting to be read, kept as the chunks it arrived in, so read() copies only what it returns (not the rest of a big chunk)"""
+    def __init__(self):
+        self.chunks = deque()
+        self.offset = 0 # into chunks[0]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, text):
+        if text:
+            self.chunks.append(text)
+            self.length += len(text)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length
+        parts = []
+        while self.chunks and size > 0:
+            chunk = self.chunks[0]
+            part = chunk[self.offset:self.offset + size]
+            parts.append(part)
+            size -= len(part)
+            self.length -= len(part)
+            self.offset += len(part)
+            if self.offset == len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+        return "".join(parts)
+
+
+class CsvChunkStream:
+    """a file-like whose read() returns the text from `chunks`, an iterable of already-encoded CSV text, as it's asked for"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = PendingText()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending.append(chunk)
+        return self.pending.read(size)
+
+
+class CsvRowStream:
+    """a file-like whose read() returns CSV text of `columns` from each dict in `rows`, encoding only as much as is asked for"""
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.row_count = 0
+        self.pending = PendingText()
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) + self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow([COPY_NULL if row[c] is None else row[c] for c in self.columns])
+            self.row_count += 1
+        self.pending.append(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return self.pending.read(size)
+
+
+def staging_table_name(table):
+    return "{}_staging".format(table)
+
+
+def create_staging_table(cursor, table):
+    """creates the empty staging table for `table`, a temp table that's dropped when the transaction ends. it always matches the columns of `table`."""
+    cursor.execute("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP;".format(staging_table_name(table), table))
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPYs `columns` of each dict in `rows` into `table`; returns the number of rows copied"""
+    stream = CsvRowStream(rows, columns)
+    cursor.copy_expert(copy_query(table, columns), stream)
+    return stream.row_count
+
+
+def copy_csv_chunks(cursor, table, columns, chunks):
+    """COPYs already-encoded CSV text (e.g. from encode_rows) of `columns` into `table`"""
+    cursor.copy_expert(copy_query(table, columns), CsvChunkStream(chunks))
+
+
+def copy_query(table, columns):
+    return "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '{}')".format(table, ', '.join(columns), COPY_NULL)
@@ -1,44 +1,106 @@
 # we want to get the bundle daily
+# keep it in the local bundle archive
+# write Parquet snapshots of its CSVs
 # upload the (daily) advertiser stats CSV to Google Cloud
 # insert the  (daily) advertiser stats to the DB
 # sync the latest advertiser weekly spend to the DB
 # sync the creative stats to the DB
+#
+# these are stages of a small graph (see pipeline.py), so independent loads and uploads run concurrently.
 
 import os
-from io import TextIOWrapper, BytesIO
 import logging
+import multiprocessing
 import tempfile
 import sys
 from dotenv import load_dotenv
 
-from google_political_transparency_report.transparency_bundle.get_transparency_bundle import get_current_bundle, upload_advertiser_stats_from_bundle, get_advertiser_weekly_spend_csv, get_creative_stats_csv, get_advertiser_stats_csv, get_bundle_date, get_advertiser_regional_spend_csv, upload_advertiser_regional_stats_from_bundle
+from google_political_transparency_report.transparency_bundle.get_transparency_bundle import fetch_bundle_if_changed, Bundle, get_advertiser_weekly_spend_csv, get_creative_stats_csv, get_bundle_date, extract_advertiser_stats_from_bundle, extract_advertiser_regional_stats_from_bundle, open_extracted_advertiser_stats_csv, open_extracted_advertiser_regional_stats_csv, upload_advertiser_stats_to_gcs, upload_advertiser_regional_stats_to_gcs
 from google_political_transparency_report.transparency_bundle.load_advertiser_weekly_spend import load_advertiser_weekly_spend_to_db
 from google_political_transparency_report.transparency_bundle.load_advertiser_stats import load_advertiser_stats_to_db
 from google_political_transparency_report.transparency_bundle.load_creative_stats import load_creative_stats_to_db
 from google_political_transparency_report.transparency_bundle.load_advertiser_regional_spend import load_advertiser_regional_spend_to_db
+from google_political_transparency_report.transparency_bundle.bundle_ledger import get_last_bundle_fetch, record_bundle_fetch
+from google_political_transparency_report.transparency_bundle.bundle_archive import archive_bundle, apply_retention
+from google_political_transparency_report.transparency_bundle.parquet_snapshots import write_bundle_snapshots, teed_snapshot
+from google_political_transparency_report.transparency_bundle.pipeline import Stage, run_stages, format_timings, PipelineError
 #from ..common.post_to_slack import post_to_slack
-from google_political_transparency_report.common.post_to_slack import warn_to_slack
+from google_political_transparency_report.common.post_to_slack import info_to_slack, warn_to_slack
+from google_political_transparency_report.common.database import get_db
 
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("google_political_transparency_report.transparency_bundle.daily")
 
+
+def load_from_bundle(get_csv, load, bundle, bundle_date):
+    with get_csv(bundle) as csv:
+        load(csv, bundle_date)
+
+
+def load_from_extracted(open_csv, load, local_dest_for_bundle, bundle_date):
+    with open_csv(local_dest_for_bundle, bundle_date) as csv:
+        load(csv, bundle_date)
+
+
+def load_creative_stats_and_snapshot(bundle, bundle_date):
+    # the biggest CSV by far, so its Parquet snapshot is written from the same decompression pass as the load.
+    with teed_snapshot("creative_stats", bundle_date) as snapshot_sink:
+        with get_creative_stats_csv(bundle, tee_to=[snapshot_sink] if snapshot_sink else []) as csv:
+            load_creative_stats_to_db(csv, bundle_date)
+
+
+def daily_stages(bundle, bundle_date, local_dest_for_bundle):
+    return [
+        # keep the bundle in the local archive (see bundle_archive.py), e.g. for backfills
+        Stage("archive_bundle", lambda: archive_bundle(bundle, bundle_date)),
+        Stage("bundle_archive_retention", apply_retention, ["archive_bundle"]),
+        # and as Parquet, for analyses (see parquet_snapshots.py)
+        Stage("parquet_snapshots", lambda: write_bundle_snapshots(bundle, bundle_date, ["advertiser_stats", "advertiser_regional_spend"])),
+        # the advertiser stats and regional spend CSVs are written to disk first; the GCS upload and the DB load
+        # each read that copy, so a failed load doesn't keep the CSV from being uploaded (or vice versa.)
+        Stage("extract_advertiser_stats", lambda: extract_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date)),
+        Stage("upload_advertiser_stats", lambda: upload_advertiser_stats_to_gcs(local_dest_for_bundle, bundle_date), ["extract_advertiser_stats"]),
+        Stage("advertiser_stats", lambda: load_from_extracted(open_extracted_advertiser_stats_csv, load_advertiser_stats_to_db, local_dest_for_bundle, bundle_date), ["extract_advertiser_stats"]),
+        Stage("extract_advertiser_regional_stats", lambda: extract_advertiser_regional_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date)),
+        Stage("upload_advertiser_regional_stats", lambda: upload_advertiser_regional_stats_to_gcs(local_dest_for_bundle, bundle_date), ["extract_advertiser_regional_stats"]),
+        Stage("advertiser_regional_spend", lambda: load_from_extracted(open_extracted_advertiser_regional_stats_csv, load_advertiser_regional_spend_to_db, local_dest_for_bundle, bundle_date), ["extract_advertiser_regional_stats"]),
+        Stage("advertiser_weekly_spend", lambda: load_from_bundle(get_advertiser_weekly_spend_csv, load_advertiser_weekly_spend_to_db, bundle, bundle_date)),
+        # (and its Parquet snapshot)
+        Stage("creative_stats", lambda: load_creative_stats_and_snapshot(bundle, bundle_date)),
+    ]
+
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print('USAGE: {} <env file path>')
         sys.exit(1)
     load_dotenv(sys.argv[1])
+    # the stages run in threads, so any process pool they start mustn't fork this process.
+    multiprocessing.set_start_method("forkserver")
     try: 
+        DB = get_db()
+        last_fetch = get_last_bundle_fetch(DB)
+        zip_file, bundle_fetch = fetch_bundle_if_changed(last_fetch)
+        if zip_file is None:
+            log.info("bundle unchanged since bundle date {}, nothing to load".format(last_fetch["bundle_date"]))
+            if bundle_fetch:
+                # same content under a new ETag: remember the new one, so the next fetch can be conditional on it.
+                record_bundle_fetch(DB, bundle_fetch, last_fetch["bundle_date"])
+            sys.exit(0)
         with tempfile.TemporaryDirectory() as local_dest_for_bundle:
         # local_dest_for_bundle = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
-            with get_current_bundle() as zip_file:
-                bundle_date = get_bundle_date(zip_file)
-                upload_advertiser_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date)
-                upload_advertiser_regional_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date)
-                load_advertiser_weekly_spend_to_db(TextIOWrapper(BytesIO(get_advertiser_weekly_spend_csv(zip_file))))
-                load_advertiser_stats_to_db(TextIOWrapper(BytesIO(get_advertiser_stats_csv(zip_file))), bundle_date)
-                load_creative_stats_to_db(TextIOWrapper(BytesIO(get_creative_stats_csv(zip_file))), bundle_date)
-                load_advertiser_regional_spend_to_db(TextIOWrapper(BytesIO(get_advertiser_regional_spend_csv(zip_file))), bundle_date)
+            with Bundle(zip_file) as bundle:
+                bundle_date = get_bundle_date(bundle)
+                results = run_stages(daily_stages(bundle, bundle_date, local_dest_for_bundle), workers=int(os.environ.get("DAILY_PIPELINE_WORKERS", 4)))
+        log.info("daily stage timings: " + format_timings(results))
+        info_to_slack("Google ads: daily stage timings: " + format_timings(results))
+        # only once everything's loaded, so a failed run gets retried in full next time.
+        record_bundle_fetch(DB, bundle_fetch, bundle_date)
+    except PipelineError as e:
+        warn_to_slack(f"google_political_transparency_report.transparency_bundle.daily error: {e}\n{format_timings(e.results)}")
+        log.error(e)
+        raise e
     except Exception as e:
         warn_to_slack(f"google_political_transparency_report.transparency_bundle.daily error: {e}")
         log.error(e)
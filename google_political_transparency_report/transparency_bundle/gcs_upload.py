@@ -0,0 +1,133 @@
+"""
+uploads files (i.e. the CSVs extracted from the bundle) to the GCS bucket in env var GCS_BUCKET.
+
+ - one storage client (and bucket) per process, instead of one per upload
+ - files are compressed before they're uploaded: gzip by default, or zstd (if the zstandard package is installed)
+   if env var GCS_UPLOAD_COMPRESSION is "zstd". "none" uploads the raw file.
+   a gzipped object keeps its name and its text/csv content type, and is stored with Content-Encoding: gzip, so GCS
+   decompresses it for any reader that doesn't ask for gzip, and consumers of the CSVs don't change.
+   GCS can't do that for zstd, so a zstd object gets a .zst suffix (and readers have to decompress it): that's opt-in.
+ - uploads are resumable, sent UPLOAD_CHUNK_SIZE at a time, so a dropped connection late in a transfer
+   retries the chunk that failed, not the whole file
+ - upload_files uploads several files at once
+
+if env var GCS_LOCAL_DIR is set, "uploads" are written under that directory (as <GCS_LOCAL_DIR>/<bucket>/<object name>)
+instead of to GCS, so the whole path can be run and benchmarked offline.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.cloud import storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from ..common.formattimedelta import formattimedelta
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.gcs_upload")
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # bytes; GCS requires a multiple of 256 KB
+COPY_CHUNK_SIZE = 1024 * 1024 # bytes
+UPLOAD_WORKERS = 4
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+COMPRESSIONS = {
+    # compression: (object name suffix, content type, content encoding)
+    "gzip": ("", "text/csv", "gzip"),
+    "zstd": (".zst", "application/zstd", None),
+    "none": ("", "text/csv", None),
+}
+
+
+class GCSBackend:
+    def __init__(self, bucket_name):
+        self.bucket = storage.Client().bucket(bucket_name)
+
+    def upload(self, blob_name, filename, content_type, content_encoding=None):
+        blob = self.bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.content_encoding = content_encoding
+        # re-uploading the same file is harmless, so retry even without a generation precondition.
+        blob.upload_from_filename(filename, content_type=content_type, retry=DEFAULT_RETRY)
+
+
+class LocalDirectoryBackend:
+    """a stand-in for GCS that writes objects, as they'd be stored (i.e. still compressed), to files under `root`/`bucket_name`"""
+    def __init__(self, root, bucket_name):
+        self.root = os.path.join(root, bucket_name)
+
+    def upload(self, blob_name, filename, content_type, content_encoding=None):
+        dest = os.path.join(self.root, blob_name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # like a GCS object, it either appears whole or not at all.
+        partial = dest + ".partial"
+        with open(filename, 'rb') as src, open(partial, 'wb') as f:
+            shutil.copyfileobj(src, f, UPLOAD_CHUNK_SIZE)
+        os.replace(partial, dest)
+
+
+_backends = {} # pid -> backend, since the client's connections can't be shared across a fork
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    pid = os.getpid()
+    with _backends_lock:
+        if pid not in _backends:
+            if os.environ.get("GCS_LOCAL_DIR"):
+                _backends[pid] = LocalDirectoryBackend(os.environ["GCS_LOCAL_DIR"], os.environ.get("GCS_BUCKET", "bucket"))
+            else:
+                _backends[pid] = GCSBackend(os.environ["GCS_BUCKET"])
+        return _backends[pid]
+
+
+def upload_compression():
+    compression = os.environ.get("GCS_UPLOAD_COMPRESSION", "gzip")
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown GCS_UPLOAD_COMPRESSION {}; expected one of {}".format(compression, ", ".join(COMPRESSIONS)))
+    if compression == "zstd" and zstandard is None:
+        log.warning("GCS_UPLOAD_COMPRESSION is zstd, but the zstandard package isn't installed; using gzip")
+        return "gzip"
+    return compression
+
+
+def compress_file(filename, dest, compression):
+    """writes `filename`, compressed with `compression`, to the open binary file `dest`"""
+    with open(filename, 'rb') as src:
+        if compression == "gzip":
+            # filename="": otherwise the temp file's name goes in the gzip header.
+            with gzip.GzipFile(filename="", fileobj=dest, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as f:
+                shutil.copyfileobj(src, f, COPY_CHUNK_SIZE)
+        elif compression == "zstd":
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dest, read_size=COPY_CHUNK_SIZE)
+        else:
+            shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+    dest.flush()
+
+
+def upload_file(blob_name, filename, compression=None):
+    """compresses and uploads `filename` as `blob_name` (plus the compression's suffix, for zstd); returns the object name"""
+    compression = compression or upload_compression()
+    suffix, content_type, content_encoding = COMPRESSIONS[compression]
+    start_time = datetime.now()
+    with tempfile.NamedTemporaryFile(prefix="gcs-upload-") as compressed:
+        compress_file(filename, compressed, compression)
+        get_backend().upload(blob_name + suffix, compressed.name, content_type, content_encoding)
+        log.info("uploaded {} ({} bytes, {} bytes {}) in {}".format(blob_name + suffix, os.path.getsize(filename), os.path.getsize(compressed.name), compression, formattimedelta(datetime.now() - start_time)))
+    return blob_name + suffix
+
+
+def upload_files(uploads, workers=UPLOAD_WORKERS, compression=None):
+    """uploads each (blob_name, filename) in `uploads`, up to `workers` at once; returns the object names, in order"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda upload: upload_file(*upload, compression=compression), uploads))
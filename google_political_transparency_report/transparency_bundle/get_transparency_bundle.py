@@ -18,84 +18,245 @@
 import requests
 import datetime
 import os
+import base64
+import hashlib
+import logging
+import io
+from functools import cached_property
 from zipfile import ZipFile
-from io import BytesIO
 import tempfile
 import sys
 from dotenv import load_dotenv
 
-from google.cloud import storage
+from .gcs_upload import upload_file, upload_files
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.get_transparency_bundle")
+
+BUNDLE_URL = "https://storage.googleapis.com/transparencyreport/google-political-ads-transparency-bundle.zip"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # bytes
+
+BUNDLE_DIRECTORY = "google-political-ads-transparency-bundle"
+UPDATED_CSV = "google-political-ads-updated.csv"
+ADVERTISER_REGIONAL_SPEND_CSV = "google-political-ads-advertiser-geo-spend.csv"
+ADVERTISER_STATS_CSV = "google-political-ads-advertiser-stats.csv"
+ADVERTISER_WEEKLY_SPEND_CSV = "google-political-ads-advertiser-weekly-spend.csv"
+CREATIVE_STATS_CSV = "google-political-ads-creative-stats.csv"
+
+class BundleDownloadError(Exception): pass
 
 GCS_BUCKET_PREFIX = ""
-def upload_csv_to_gcs(destination_blob_name, file_as_string):
-  print("bucket", os.environ.get("GCS_BUCKET"))
-  storage_client = storage.Client()
-  bucket = storage_client.get_bucket(os.environ.get("GCS_BUCKET"))
-  blob = bucket.blob(os.path.join(os.environ.get("GCS_BUCKET"), GCS_BUCKET_PREFIX, destination_blob_name))
-  blob.upload_from_string(file_as_string)
+def upload_file_to_gcs(destination_blob_name, filename):
+  """uploads `filename` (compressed; see gcs_upload.py) to GCS_BUCKET_PREFIX/destination_blob_name in the GCS_BUCKET bucket"""
+  return upload_file(os.path.join(GCS_BUCKET_PREFIX, destination_blob_name), filename)
+
+
+def advertiser_stats_filename(update_date):
+    return "google-political-ads-advertiser-stats-{}.csv".format(update_date)
 
+def advertiser_regional_stats_filename(update_date):
+    return "google-political-ads-advertiser-regional-stats-{}.csv".format(update_date)
 
-def write_current_bundle_to_disk(dest, zip_file, update_date):
-    filename = "google-political-ads-transparency-bundle-{}.zip".format(update_date)
-    dest = os.path.join(dest, filename)
-    with open(dest, 'wb') as f:
-        f.write(zip_file.read())
 
-def write_advertiser_stats_to_disk(dest, csv, update_date):
-    filename = "google-political-ads-advertiser-stats-{}.csv".format(update_date)
-    dest = os.path.join(dest, filename)
-    with open(dest, 'wb') as f:
-        f.write(csv)
+def expected_md5_from_headers(headers):
+    """GCS sends `x-goog-hash: crc32c=...,md5=...` (base64). returns the md5 digest bytes, if present."""
+    for part in headers.get("x-goog-hash", "").split(","):
+        algo, _, value = part.strip().partition("=")
+        if algo == "md5" and value:
+            return base64.b64decode(value)
+    return None
 
-def write_advertiser_regional_stats_to_disk(dest, csv, update_date):
-    filename = "google-political-ads-advertiser-regional-stats-{}.csv".format(update_date)
-    dest = os.path.join(dest, filename)
-    with open(dest, 'wb') as f:
-        f.write(csv)
+
+def fetch_bundle_if_changed(last_fetch=None):
+    """ downloads the zip file from the Google Political Transpareny Report, unless it's unchanged since `last_fetch`
+
+        the zip is streamed in chunks to an anonymous temp file on disk (rather than held in memory)
+        and checked against the Content-Length and the md5 that GCS sends in x-goog-hash.
+        (the CRC of each CSV is checked by ZipFile when that member is read.)
+
+        `last_fetch` is a bundle_fetches row (see bundle_ledger.py); its ETag and Last-Modified are sent
+        as If-None-Match/If-Modified-Since, and its content_md5 catches a re-upload of identical bytes.
+
+        returns (seekable file-like positioned at the start of the zip, dict of etag/last_modified/content_md5),
+        or (None, None) if the bundle hasn't changed, or (None, dict) if it was served anew (e.g. with a new ETag) but its content
+        is the same: that dict should still be recorded, or every later fetch would send the stale ETag and download it all again.
+    """
+    headers = {}
+    if last_fetch:
+        if last_fetch["etag"]:
+            headers["If-None-Match"] = last_fetch["etag"]
+        if last_fetch["last_modified"]:
+            headers["If-Modified-Since"] = last_fetch["last_modified"]
+    spool = tempfile.TemporaryFile(prefix="google-political-ads-transparency-bundle-", suffix=".zip")
+    try:
+        with requests.get(BUNDLE_URL, headers=headers, stream=True) as resp:
+            if resp.status_code == 304:
+                log.info("bundle not modified (ETag {}, Last-Modified {})".format(last_fetch["etag"], last_fetch["last_modified"]))
+                spool.close()
+                return None, None
+            resp.raise_for_status()
+            md5 = hashlib.md5()
+            length = 0
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                spool.write(chunk)
+                md5.update(chunk)
+                length += len(chunk)
+            # if GCS served it with Content-Encoding: gzip, the length and hash are of the compressed bytes, which requests has already decoded.
+            if not resp.headers.get("Content-Encoding"):
+                expected_length = resp.headers.get("Content-Length")
+                if expected_length is not None and int(expected_length) != length:
+                    raise BundleDownloadError("bundle download truncated: got {} bytes, expected {}".format(length, expected_length))
+                expected_md5 = expected_md5_from_headers(resp.headers)
+                if expected_md5 is not None and expected_md5 != md5.digest():
+                    raise BundleDownloadError("bundle download corrupt: md5 mismatch")
+            bundle_fetch = {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"), "content_md5": md5.hexdigest()}
+        log.info("downloaded {} byte bundle".format(length))
+        if last_fetch and last_fetch["content_md5"] == bundle_fetch["content_md5"]:
+            log.info("bundle content unchanged (md5 {})".format(bundle_fetch["content_md5"]))
+            spool.close()
+            return None, bundle_fetch
+        spool.seek(0)
+        return spool, bundle_fetch
+    except:
+        spool.close()
+        raise
 
 
 def get_current_bundle():
-    """ downloads the zip file from the Google Political Transpareny Report
+    """ downloads the zip file from the Google Political Transpareny Report, unconditionally
 
-        returns a file-like
+        returns a seekable file-like
     """
-    if True:
-        BUNDLE_URL = "https://storage.googleapis.com/transparencyreport/google-political-ads-transparency-bundle.zip"
-        with requests.get(BUNDLE_URL, stream=True) as resp:
-          return BytesIO(resp.content)
-    else:
-        return open(os.path.join(os.path.dirname(__file__), '..', '..', 'youtubeadlibrary', 'google-political-ads-transparency-bundle (6).zip'), 'rb')
-
-
-def get_zip_file_by_name(bundle_filelike, filename):
-    with ZipFile(bundle_filelike, 'r') as zip:
-        return zip.read("google-political-ads-transparency-bundle/{}".format(filename))
-
-def get_bundle_date(bundle_filelike):
-    data = get_zip_file_by_name(bundle_filelike, 'google-political-ads-updated.csv')
-    updated_date = data.decode('utf-8').split("\n")[1]
-    return datetime.date(*map(int, updated_date.split("-")))
-
-def get_advertiser_regional_spend_csv(bundle_filelike):
-    return get_zip_file_by_name(bundle_filelike,  "google-political-ads-advertiser-geo-spend.csv")
-def get_advertiser_stats_csv(bundle_filelike):
-    return get_zip_file_by_name(bundle_filelike, 'google-political-ads-advertiser-stats.csv')
-def get_advertiser_weekly_spend_csv(bundle_filelike):
-    return get_zip_file_by_name(bundle_filelike,  "google-political-ads-advertiser-weekly-spend.csv")
-def get_creative_stats_csv(bundle_filelike):
-    return get_zip_file_by_name(bundle_filelike, "google-political-ads-creative-stats.csv")
-
-def upload_advertiser_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date):
-    advertiser_stats_csv = get_advertiser_stats_csv(zip_file)
-    write_current_bundle_to_disk(local_dest_for_bundle, zip_file, bundle_date)
-    write_advertiser_stats_to_disk(local_dest_for_bundle, advertiser_stats_csv, bundle_date)
-    upload_csv_to_gcs("google-political-ads-advertiser-stats-{}.csv".format(bundle_date), advertiser_stats_csv)
-
-def upload_advertiser_regional_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date):
-    advertiser_regional_stats_csv = get_advertiser_regional_spend_csv(zip_file)
-    write_current_bundle_to_disk(local_dest_for_bundle, zip_file, bundle_date)
-    write_advertiser_regional_stats_to_disk(local_dest_for_bundle, advertiser_regional_stats_csv, bundle_date)
-    upload_csv_to_gcs("google-political-ads-advertiser-regional-stats-{}.csv".format(bundle_date), advertiser_regional_stats_csv)
+    zip_file, _ = fetch_bundle_if_changed()
+    return zip_file
+
+
+class TeeReader(io.RawIOBase):
+    """
+    a readable binary stream that copies every byte read from `source` to each of `sinks` (anything with a `write`),
+    so several consumers can share one decompression pass over a zip member.
+
+    closing it reads the rest of `source` into the sinks, so they always get the whole member,
+    even if the consumer stopped early (or never started, e.g. a loader that had already loaded this bundle.)
+    """
+    def __init__(self, source, sinks=()):
+        self.source = source
+        self.sinks = list(sinks)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.source.readinto(b)
+        if n:
+            for sink in self.sinks:
+                sink.write(memoryview(b)[:n])
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.sinks:
+                while True:
+                    chunk = self.source.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    for sink in self.sinks:
+                        sink.write(chunk)
+        finally:
+            self.source.close()
+            super().close()
+
+
+class Bundle:
+    """
+    a transparency bundle zip, whose central directory is parsed once.
+
+    members are exposed as streams (decompressed as they're read), never as one big bytes object.
+    use it as a context manager; closing the Bundle closes the underlying file-like too.
+    """
+    def __init__(self, bundle_filelike):
+        self.bundle_filelike = bundle_filelike
+        self.zip = ZipFile(bundle_filelike, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+        self.bundle_filelike.close()
+
+    def open_member(self, filename, tee_to=()):
+        """returns a binary stream of `filename` within the bundle; everything read from it is also written to each of `tee_to`"""
+        return io.BufferedReader(TeeReader(self.zip.open("{}/{}".format(BUNDLE_DIRECTORY, filename), 'r'), tee_to), DOWNLOAD_CHUNK_SIZE)
+
+    def open_csv(self, filename, tee_to=()):
+        """returns a text stream of `filename` suitable for the csv module; the raw bytes are also written to each of `tee_to`"""
+        return io.TextIOWrapper(self.open_member(filename, tee_to), encoding='utf-8', newline='')
+
+    @cached_property
+    def bundle_date(self):
+        with self.open_csv(UPDATED_CSV) as f:
+            updated_date = f.read().split("\n")[1]
+        return datetime.date(*map(int, updated_date.strip().split("-")))
+
+
+def get_bundle_date(bundle):
+    return bundle.bundle_date
+
+def get_advertiser_regional_spend_csv(bundle, tee_to=()):
+    return bundle.open_csv(ADVERTISER_REGIONAL_SPEND_CSV, tee_to)
+def get_advertiser_stats_csv(bundle, tee_to=()):
+    return bundle.open_csv(ADVERTISER_STATS_CSV, tee_to)
+def get_advertiser_weekly_spend_csv(bundle, tee_to=()):
+    return bundle.open_csv(ADVERTISER_WEEKLY_SPEND_CSV, tee_to)
+def get_creative_stats_csv(bundle, tee_to=()):
+    return bundle.open_csv(CREATIVE_STATS_CSV, tee_to)
+
+def extract_csv_from_bundle(bundle, filename, local_path, load=None):
+    """
+    writes `filename` from the bundle to local_path.
+    if `load` is given, it's called with a text stream of the CSV, teed from the same decompression pass as the local copy.
+    """
+    with open(local_path, 'wb') as local_copy:
+        with bundle.open_csv(filename, tee_to=[local_copy]) as csv_filelike:
+            if load:
+                load(csv_filelike)
+
+def extract_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load=None):
+    extract_csv_from_bundle(bundle, ADVERTISER_STATS_CSV, os.path.join(local_dest_for_bundle, advertiser_stats_filename(bundle_date)), load)
+
+def extract_advertiser_regional_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load=None):
+    extract_csv_from_bundle(bundle, ADVERTISER_REGIONAL_SPEND_CSV, os.path.join(local_dest_for_bundle, advertiser_regional_stats_filename(bundle_date)), load)
+
+def open_extracted_csv(local_path):
+    """returns a text stream of a CSV that extract_csv_from_bundle wrote to local_path"""
+    return open(local_path, 'r', encoding='utf-8', newline='')
+
+def open_extracted_advertiser_stats_csv(local_dest_for_bundle, bundle_date):
+    return open_extracted_csv(os.path.join(local_dest_for_bundle, advertiser_stats_filename(bundle_date)))
+
+def open_extracted_advertiser_regional_stats_csv(local_dest_for_bundle, bundle_date):
+    return open_extracted_csv(os.path.join(local_dest_for_bundle, advertiser_regional_stats_filename(bundle_date)))
+
+def upload_advertiser_stats_to_gcs(local_dest_for_bundle, bundle_date):
+    filename = advertiser_stats_filename(bundle_date)
+    upload_file_to_gcs(filename, os.path.join(local_dest_for_bundle, filename))
+
+def upload_advertiser_regional_stats_to_gcs(local_dest_for_bundle, bundle_date):
+    filename = advertiser_regional_stats_filename(bundle_date)
+    upload_file_to_gcs(filename, os.path.join(local_dest_for_bundle, filename))
+
+def upload_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load=None):
+    extract_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load)
+    upload_advertiser_stats_to_gcs(local_dest_for_bundle, bundle_date)
+
+def upload_advertiser_regional_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load=None):
+    extract_advertiser_regional_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date, load)
+    upload_advertiser_regional_stats_to_gcs(local_dest_for_bundle, bundle_date)
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -104,7 +265,8 @@ if __name__ == "__main__":
     load_dotenv(sys.argv[1])
     with tempfile.TemporaryDirectory() as local_dest_for_bundle:
     # local_dest_for_bundle = os.path.join(os.path.dirname(__file__), '..', '..', 'data') # TODO: should use a tmpdir.
-      with get_current_bundle() as zip_file:
-          bundle_date = get_bundle_date(zip_file)
-          upload_advertiser_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date)
-          upload_advertiser_regional_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date)
+      with Bundle(get_current_bundle()) as bundle:
+          bundle_date = get_bundle_date(bundle)
+          extract_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date)
+          extract_advertiser_regional_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date)
+          upload_files([(os.path.join(GCS_BUCKET_PREFIX, filename), os.path.join(local_dest_for_bundle, filename)) for filename in (advertiser_stats_filename(bundle_date), advertiser_regional_stats_filename(bundle_date))])
@@ -11,6 +11,12 @@ options:
 1. we could keep everything... but that might take up a lot of space
 2. we could keep only the changes... but there might be flutter AND that's more complicated to deal with downstream
 3. we could only keep weekly records
+
+we do 1, unless env var REGIONAL_SPEND_STORAGE is "delta"; then we do 2: only the rows whose spend changed since the previous
+snapshot (and tombstones for the ones that disappeared) go in advertiser_regional_spend_deltas, and the SQL function
+advertiser_regional_spend_at(date) reconstructs the full snapshot for a date. (see schema.sql, which also has views that give
+the readers of advertiser_regional_spend and latest_advertiser_regional_spend the same rows, and how to put them under the old names.)
+deltas have to be loaded in date order, since each is computed against the one before.
 """
 
 # Advertiser_ID,Advertiser_Name,Country,Country_Subdivision_Primary,Spend_USD,Spend_EUR,Spend_INR,Spend_BGN,Spend_HRK,Spend_CZK,Spend_DKK,Spend_HUF,Spend_PLN,Spend_RON,Spend_SEK,Spend_GBP,Spend_ILS,Spend_NZD
@@ -19,15 +25,19 @@ options:
 
 import os
 from datetime import datetime, timedelta
-from io import TextIOWrapper, BytesIO
 
 import agate
 
-from .get_transparency_bundle import get_current_bundle, get_bundle_date, get_advertiser_regional_spend_csv
+from .get_transparency_bundle import Bundle, get_current_bundle, get_bundle_date, get_advertiser_regional_spend_csv
+from .bundle_ledger import is_table_loaded, record_table_load
+from .stream_csv import iter_rows
+from .partitions import ensure_partition
+from .schema_registry import register_schema
+from ..common.database import get_db, raw_transaction
+from .copy_rows import create_staging_table, staging_table_name, copy_rows
 from ..common.post_to_slack import info_to_slack
 from ..common.formattimedelta import formattimedelta
 
-import records
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -42,30 +52,102 @@ KEYS = [
     "report_date"
 ]
 
-## TODO
-INSERT_QUERY = "INSERT INTO advertiser_regional_spend ({}) VALUES ({}) ON CONFLICT (advertiser_id, country, region, report_date)  DO NOTHING".format(', '.join([(k) for k in KEYS]), ', '.join([":" + (k) for k in KEYS]))
-
-def load_advertiser_regional_spend_to_db(csv_filelike, bundle_date):
-    DB = records.Database(os.environ['DATABASE_URL'])
-    MAX_REPORT_DATE = DB.query("SELECT max(report_date) report_date FROM advertiser_regional_spend;")[0]["report_date"]
-    if bundle_date == MAX_REPORT_DATE:
+REGIONAL_SPEND_COLUMN_TYPES = {'Advertiser_ID': agate.Text(), 'Country': agate.Text(), 'Country_Subdivision_Primary': agate.Text(), 'Spend_USD': agate.Number()}
+register_schema("advertiser_regional_spend", "2018", REGIONAL_SPEND_COLUMN_TYPES, complete=False)
+
+def regional_spend_countries():
+    """the values of the Country column to load, comma-separated in env var REGIONAL_SPEND_COUNTRIES"""
+    return os.environ.get("REGIONAL_SPEND_COUNTRIES", "US").split(",")
+
+# rows are COPYed into advertiser_regional_spend_staging, then merged in one statement.
+MERGE_QUERY = "INSERT INTO advertiser_regional_spend ({}) SELECT DISTINCT ON (advertiser_id, country, region) {} FROM {} ORDER BY advertiser_id, country, region ON CONFLICT (advertiser_id, country, region, report_date) DO NOTHING".format(', '.join(KEYS), ', '.join(KEYS), staging_table_name("advertiser_regional_spend"))
+
+# delta storage: each day's snapshot, in advertiser_regional_spend_staging, is compared to advertiser_regional_spend_current (the one before)...
+DELTA_QUERY = """INSERT INTO advertiser_regional_spend_deltas ({keys})
+    SELECT {staging_keys} FROM (SELECT DISTINCT ON (advertiser_id, country, region) * FROM {staging} ORDER BY advertiser_id, country, region) staging
+    LEFT JOIN advertiser_regional_spend_current curr USING (advertiser_id, country, region)
+    WHERE curr.spend_usd IS DISTINCT FROM staging.spend_usd""".format(keys=', '.join(KEYS), staging_keys=', '.join("staging." + k for k in KEYS), staging=staging_table_name("advertiser_regional_spend"))
+# ... rows that have disappeared (from the countries we're loading) get a tombstone ...
+TOMBSTONE_QUERY = """INSERT INTO advertiser_regional_spend_deltas ({keys})
+    SELECT advertiser_id, country, region, NULL, %(report_date)s FROM advertiser_regional_spend_current curr
+    WHERE curr.country = ANY(%(countries)s) AND NOT EXISTS (SELECT 1 FROM {staging} staging
+        WHERE staging.advertiser_id = curr.advertiser_id AND staging.country = curr.country AND staging.region = curr.region)""".format(keys=', '.join(KEYS), staging=staging_table_name("advertiser_regional_spend"))
+# ... and then advertiser_regional_spend_current is brought up to date.
+DELETE_CURRENT_QUERY = """DELETE FROM advertiser_regional_spend_current curr
+    USING advertiser_regional_spend_deltas deltas
+    WHERE deltas.report_date = %(report_date)s AND deltas.spend_usd IS NULL
+    AND curr.advertiser_id = deltas.advertiser_id AND curr.country = deltas.country AND curr.region = deltas.region"""
+UPSERT_CURRENT_QUERY = """INSERT INTO advertiser_regional_spend_current ({keys})
+    SELECT {keys} FROM advertiser_regional_spend_deltas WHERE report_date = %(report_date)s AND spend_usd IS NOT NULL
+    ON CONFLICT (advertiser_id, country, region) DO UPDATE SET spend_usd = EXCLUDED.spend_usd, report_date = EXCLUDED.report_date""".format(keys=', '.join(KEYS))
+
+def regional_spend_storage():
+    """"full" (a whole snapshot per day in advertiser_regional_spend) or "delta" (just the changes, in advertiser_regional_spend_deltas), from env var REGIONAL_SPEND_STORAGE"""
+    storage = os.environ.get("REGIONAL_SPEND_STORAGE", "full")
+    if storage not in ("full", "delta"):
+        raise ValueError("unknown REGIONAL_SPEND_STORAGE {}; expected full or delta".format(storage))
+    return storage
+
+def regional_spend_table():
+    """the table (and bundle_table_loads name) that regional spend is loaded into, depending on regional_spend_storage()"""
+    return "advertiser_regional_spend_deltas" if regional_spend_storage() == "delta" else "advertiser_regional_spend"
+
+def parse_advertiser_regional_spend(csv_filelike, bundle_date, countries):
+    """yields a dict of KEYS for each row of the geo spend CSV in one of `countries`. (rows are filtered on the raw Country text, before they're converted.)"""
+    # there's no Country column for the EU, oddly! so then there are no rows.
+    for ad_data in iter_rows(csv_filelike, "advertiser_regional_spend", ["advertiser_id", "country", "country_subdivision_primary", "spend_usd"], where={"Country": countries}):
+        ad_data["region"] = ad_data.pop("country_subdivision_primary")
+        ad_data["spend_usd"] = ad_data["spend_usd"] or 0
+        ad_data["report_date"] = bundle_date
+        yield ad_data
+
+def load_advertiser_regional_spend_to_db(csv_filelike, bundle_date, countries=None):
+    countries = countries or regional_spend_countries()
+    if regional_spend_storage() == "delta":
+        return load_advertiser_regional_spend_deltas_to_db(csv_filelike, bundle_date, countries)
+    DB = get_db()
+    if is_table_loaded(DB, "advertiser_regional_spend", bundle_date):
+        return
+    # (for loads from before the ledger.) only this date's partition is looked at.
+    if DB.query("SELECT EXISTS (SELECT 1 FROM advertiser_regional_spend WHERE report_date = :bundle_date) AS loaded;", bundle_date=bundle_date)[0]["loaded"]:
+        log.info("advertiser_regional_spend already has {}, skipping".format(bundle_date))
         return
     # load CSV to DB
     # delete
-    total_rows = 0
     start_time = datetime.now()
-    for row in  agate.Table.from_csv(csv_filelike):
-        if "Country" not in row.keys() or row["Country"] != 'US': # this doesn't exist for the EU, oddly!
-            continue
-        ad_data = {k.lower():v for k,v in row.items() if k.lower() in KEYS}
-        ad_data["spend_usd"] = ad_data["spend_usd"] or 0
-        ad_data["region"] = row["Country_Subdivision_Primary"]
-        ad_data["report_date"] = bundle_date
-        total_rows += 1
-        DB.query(INSERT_QUERY, **ad_data)
+    with raw_transaction(DB) as cursor:
+        ensure_partition(cursor, "advertiser_regional_spend", bundle_date)
+        create_staging_table(cursor, "advertiser_regional_spend")
+        total_rows = copy_rows(cursor, staging_table_name("advertiser_regional_spend"), KEYS, parse_advertiser_regional_spend(csv_filelike, bundle_date, countries))
+        cursor.execute(MERGE_QUERY)
+    duration = (datetime.now() - start_time)
+    record_table_load(DB, "advertiser_regional_spend", bundle_date, total_rows)
+    log1 = "loaded {} advertiser regional spend records ({}) for this week in {}".format(total_rows, ", ".join(countries), formattimedelta(duration))
+    log.info(log1)
+    info_to_slack("Google ads: " + log1)
 
+
+def load_advertiser_regional_spend_deltas_to_db(csv_filelike, bundle_date, countries):
+    DB = get_db()
+    if is_table_loaded(DB, "advertiser_regional_spend_deltas", bundle_date):
+        return
+    last_loaded = DB.query("SELECT max(bundle_date) bundle_date FROM bundle_table_loads WHERE table_name = 'advertiser_regional_spend_deltas';")[0]["bundle_date"]
+    if last_loaded and bundle_date < last_loaded:
+        raise ValueError("can't load regional spend deltas for {}, since {} is already loaded; deltas have to be loaded in date order".format(bundle_date, last_loaded))
+    start_time = datetime.now()
+    with raw_transaction(DB) as cursor:
+        ensure_partition(cursor, "advertiser_regional_spend_deltas", bundle_date)
+        create_staging_table(cursor, "advertiser_regional_spend")
+        total_rows = copy_rows(cursor, staging_table_name("advertiser_regional_spend"), KEYS, parse_advertiser_regional_spend(csv_filelike, bundle_date, countries))
+        cursor.execute(DELTA_QUERY)
+        changed_rows = cursor.rowcount
+        cursor.execute(TOMBSTONE_QUERY, {"report_date": bundle_date, "countries": countries})
+        removed_rows = cursor.rowcount
+        cursor.execute(DELETE_CURRENT_QUERY, {"report_date": bundle_date})
+        cursor.execute(UPSERT_CURRENT_QUERY, {"report_date": bundle_date})
     duration = (datetime.now() - start_time)
-    log1 = "loaded {} advertiser regional spend records for this week in {}".format(total_rows , formattimedelta(duration))
+    record_table_load(DB, "advertiser_regional_spend_deltas", bundle_date, total_rows)
+    log1 = "loaded {} advertiser regional spend records ({}) as {} changes and {} removals in {}".format(total_rows, ", ".join(countries), changed_rows, removed_rows, formattimedelta(duration))
     log.info(log1)
     info_to_slack("Google ads: " + log1)
 
@@ -76,11 +158,12 @@ if __name__ == "__main__":
         # load_advertiser_weekly_spend_to_db(f)
     from sys import argv
     def get_bundle_from_zip(zip_fn):
-        return open(zip_fn, 'rb')
+        return Bundle(open(zip_fn, 'rb'))
 
     local_dest_for_bundle = os.path.join(os.path.dirname(__file__), '..', 'data')
-#    with get_current_bundle() as zip_file:
-    with get_bundle_from_zip(argv[1]) as zip_file:
-        explicit_bundle_date = datetime.date(*map(int, argv[2].split("-"))) if len(argv) >= 3 else None
-        bundle_date = explicit_bundle_date or get_bundle_date(zip_file)
-        load_advertiser_regional_spend_to_db(TextIOWrapper(BytesIO(get_advertiser_regional_spend_csv(zip_file))), bundle_date)
+#    with Bundle(get_current_bundle()) as bundle:
+    with get_bundle_from_zip(argv[1]) as bundle:
+        explicit_bundle_date = datetime.strptime(argv[2], "%Y-%m-%d").date() if len(argv) >= 3 else None
+        bundle_date = explicit_bundle_date or get_bundle_date(bundle)
+        with get_advertiser_regional_spend_csv(bundle) as csv:
+            load_advertiser_regional_spend_to_db(csv, bundle_date)
@@ -1,20 +1,28 @@
 """
 script to load from a CSV into SQL db specified as env var DATABASE_URL the advertiser stats of US spenders from the Google Political Ads bundle
 
+advertiser_stats has the latest stats of each advertiser; a row is only rewritten if its stats changed, so its report_date
+is the date of the bundle they changed in, not the latest one.
+each day's spend and ad count are also kept in advertiser_stats_daily (partitioned by month, see partitions.py), for charting over time;
+that's where to look for when an advertiser was last seen (its max(report_date)).
 """
 
 import os
-from io import TextIOWrapper, BytesIO
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 
 import agate
 
-from .get_transparency_bundle import get_current_bundle, get_bundle_date, get_advertiser_stats_csv
+from .get_transparency_bundle import Bundle, get_current_bundle, get_bundle_date, get_advertiser_stats_csv
+from .schema_registry import register_schema
+from .bundle_ledger import is_table_loaded, record_table_load
+from .stream_csv import iter_rows
+from .copy_rows import create_staging_table, staging_table_name, copy_rows
+from .partitions import ensure_partition
+from ..common.database import get_db, raw_transaction
 from ..common.post_to_slack import info_to_slack
 from ..common.formattimedelta import formattimedelta
 
-import records
-
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -31,29 +39,50 @@ KEYS = [
 ]
 EXTRA_KEYS = ['report_date']
 
+ADVERTISER_STATS_COLUMN_TYPES = {'Advertiser_ID': agate.Text(), 'Advertiser_Name': agate.Text(), 'Public_IDs_List': agate.Text(), 'Regions': agate.Text(), 'Elections': agate.Text(), 'Total_Creatives': agate.Number(), 'Spend_USD': agate.Number()}
+register_schema("advertiser_stats", "2018", ADVERTISER_STATS_COLUMN_TYPES, complete=False)
+ELECTIONS = ['US-Federal', 'EU-Parliament']
+
+# rows are COPYed into advertiser_stats_staging, then merged: new advertisers, and those whose stats changed, are written...
+MERGE_QUERY = """INSERT INTO advertiser_stats ({keys}) SELECT DISTINCT ON (advertiser_id) {keys} FROM {staging} ORDER BY advertiser_id
+    ON CONFLICT (advertiser_id) DO UPDATE SET {updates} WHERE ({stats}) IS DISTINCT FROM ({excluded_stats})""".format(
+        keys=', '.join(KEYS + EXTRA_KEYS), staging=staging_table_name("advertiser_stats"), updates=', '.join(f"{k} = EXCLUDED.{k}" for k in KEYS + EXTRA_KEYS),
+        stats=', '.join(f"advertiser_stats.{k}" for k in KEYS if k != "advertiser_id"), excluded_stats=', '.join(f"EXCLUDED.{k}" for k in KEYS if k != "advertiser_id"))
+# ... and every advertiser's spend and ad count go in the daily history.
+SNAPSHOT_QUERY = """INSERT INTO advertiser_stats_daily (advertiser_id, total_creatives, spend_usd, report_date)
+    SELECT DISTINCT ON (advertiser_id) advertiser_id, total_creatives, spend_usd, report_date FROM {} ORDER BY advertiser_id
+    ON CONFLICT (advertiser_id, report_date) DO NOTHING""".format(staging_table_name("advertiser_stats"))
 
-INSERT_QUERY = "INSERT INTO advertiser_stats ({}) VALUES ({}) ON CONFLICT (advertiser_id) DO UPDATE SET {}".format(', '.join([k for k in KEYS + EXTRA_KEYS]), ', '.join([":" + k for k in KEYS + EXTRA_KEYS]), ', '.join([f"{k} = :{k}" for k in KEYS + EXTRA_KEYS]))
+def parse_advertiser_stats(csv_filelike, date):
+    """yields a dict of KEYS + EXTRA_KEYS for each row of the advertiser stats CSV for one of ELECTIONS"""
+    for ad_data in iter_rows(csv_filelike, "advertiser_stats", KEYS, where={"Elections": ELECTIONS}):
+        # spend_usd is an integer column; round it like Postgres would cast it (half away from zero), rather than leave it to the COPY.
+        ad_data["spend_usd"] = int(Decimal(ad_data["spend_usd"] or 0).to_integral_value(rounding=ROUND_HALF_UP))
+        ad_data["report_date"] = date
+        yield ad_data
 
 def load_advertiser_stats_to_db(csvfn, date):
-    DB = records.Database(os.environ['DATABASE_URL'])
-    total_rows = 0
+    DB = get_db()
+    if is_table_loaded(DB, "advertiser_stats", date):
+        return
     start_time = datetime.now()
-    for row in  agate.Table.from_csv(csvfn):
-        if not row["Elections"] or (row["Elections"] != 'US-Federal' and row["Elections"] != 'EU-Parliament'):
-            continue
-        ad_data = {k.lower():v for k,v in row.items() if k.lower() in KEYS}
-        ad_data["spend_usd"] = ad_data["spend_usd"] or 0
-        ad_data["report_date"] = date
-        DB.query(INSERT_QUERY, **ad_data)
-        total_rows += 1
+    with raw_transaction(DB) as cursor:
+        ensure_partition(cursor, "advertiser_stats_daily", date)
+        create_staging_table(cursor, "advertiser_stats")
+        total_rows = copy_rows(cursor, staging_table_name("advertiser_stats"), KEYS + EXTRA_KEYS, parse_advertiser_stats(csvfn, date))
+        cursor.execute(MERGE_QUERY)
+        changed_rows = cursor.rowcount
+        cursor.execute(SNAPSHOT_QUERY)
     duration = datetime.now() - start_time
-    log1 = "loaded {} advertiser stats records for this week in {}".format(total_rows , formattimedelta(duration))
+    record_table_load(DB, "advertiser_stats", date, total_rows)
+    log1 = "loaded {} advertiser stats records ({} new or changed) for this week in {}".format(total_rows, changed_rows, formattimedelta(duration))
     log.info(log1)
     info_to_slack("Google ads: " + log1)
 
 
 if __name__ == "__main__":
     # csvfn = os.path.join(os.path.dirname(__file__), '..', 'data/google-political-ads-transparency-bundle/google-political-ads-creative-stats.csv')
-    with get_current_bundle() as zip_file:
-        bundle_date = get_bundle_date(zip_file)
-        load_advertiser_stats_to_db(TextIOWrapper(BytesIO(get_advertiser_stats_csv(zip_file))), bundle_date)
+    with Bundle(get_current_bundle()) as bundle:
+        bundle_date = get_bundle_date(bundle)
+        with get_advertiser_stats_csv(bundle) as csv:
+            load_advertiser_stats_to_db(csv, bundle_date)
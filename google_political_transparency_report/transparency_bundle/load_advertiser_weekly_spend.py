@@ -1,19 +1,24 @@
 """
 script to load from a CSV into SQL db specified as env var DATABASE_URL the weekly spend of US spenders from the Google Political Ads bundle
 
+the CSV is cumulative (every week since 2018 is in every bundle), so by default we only load weeks starting
+at or after the latest week already in the DB, minus env var ADVERTISER_WEEKLY_SPEND_WATERMARK_DAYS (default 28.)
 """
 
 import os
 from datetime import datetime, timedelta
-from io import TextIOWrapper, BytesIO
 
 import agate
 
-from .get_transparency_bundle import get_current_bundle, get_bundle_date, get_advertiser_weekly_spend_csv
+from .get_transparency_bundle import Bundle, get_current_bundle, get_bundle_date, get_advertiser_weekly_spend_csv
+from .bundle_ledger import is_table_loaded, record_table_load
+from .stream_csv import iter_rows
+from .schema_registry import register_schema
+from ..common.database import get_db, raw_transaction
+from .copy_rows import create_staging_table, staging_table_name, copy_rows
 from ..common.post_to_slack import info_to_slack
 from ..common.formattimedelta import formattimedelta
 
-import records
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -27,20 +32,51 @@ KEYS = [
     'spend_usd'
 ]
 
-INSERT_QUERY = "INSERT INTO advertiser_weekly_spend ({}) VALUES ({}) ON CONFLICT (advertiser_id, week_start_date)  DO NOTHING".format(', '.join([k for k in KEYS]), ', '.join([":" + k for k in KEYS]))
+WEEKLY_SPEND_COLUMN_TYPES = {'Advertiser_ID': agate.Text(), 'Advertiser_Name': agate.Text(), 'Election_Cycle': agate.Text(), 'Week_Start_Date': agate.Date(), 'Spend_USD': agate.Number()}
+register_schema("advertiser_weekly_spend", "2018", WEEKLY_SPEND_COLUMN_TYPES, complete=False)
 
-def load_advertiser_weekly_spend_to_db(csv_filelike):
-    DB = records.Database(os.environ['DATABASE_URL'])
-    total_rows = 0
-    start_time = datetime.now()
-    for row in  agate.Table.from_csv(csv_filelike):
-        ad_data = {k.lower():v for k,v in row.items() if k.lower() in KEYS}
+
+# rows are COPYed into advertiser_weekly_spend_staging, then merged in one statement: new weeks are inserted,
+# and a week that's already there is only rewritten if Google's changed it (e.g. filled it in late.)
+UPDATED_KEYS = [k for k in KEYS if k not in ('advertiser_id', 'week_start_date')]
+MERGE_QUERY = """INSERT INTO advertiser_weekly_spend ({}) SELECT DISTINCT ON (advertiser_id, week_start_date) {} FROM {} ORDER BY advertiser_id, week_start_date
+    ON CONFLICT (advertiser_id, week_start_date) DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})""".format(
+        ', '.join(KEYS), ', '.join(KEYS), staging_table_name("advertiser_weekly_spend"),
+        ', '.join(f"{k} = EXCLUDED.{k}" for k in UPDATED_KEYS), ', '.join(f"advertiser_weekly_spend.{k}" for k in UPDATED_KEYS), ', '.join(f"EXCLUDED.{k}" for k in UPDATED_KEYS))
+
+def parse_advertiser_weekly_spend(csv_filelike, watermark=None):
+    """yields a dict of KEYS for each row of the weekly spend CSV for a week starting on or after `watermark`"""
+    for ad_data in iter_rows(csv_filelike, "advertiser_weekly_spend", KEYS):
+        if watermark and ad_data["week_start_date"] < watermark:
+            continue
         ad_data["spend_usd"] = ad_data["spend_usd"] or 0
-        total_rows += 1
-        print(ad_data)
-        DB.query(INSERT_QUERY, **ad_data)
+        yield ad_data
+
+def get_watermark(DB):
+    """weeks this far before the latest week in the DB get re-sent, in case Google fills them in late."""
+    watermark_window = timedelta(days=int(os.environ.get("ADVERTISER_WEEKLY_SPEND_WATERMARK_DAYS", 28)))
+    max_week_start_date = DB.query("SELECT max(week_start_date) week_start_date FROM advertiser_weekly_spend;")[0]["week_start_date"]
+    return max_week_start_date - watermark_window if max_week_start_date else None
+
+def load_advertiser_weekly_spend_to_db(csv_filelike, bundle_date=None, full_history=False):
+    """
+    bundle_date is optional (the CSV is its own time series); if given, the load is recorded in (and skipped if already in) the bundle_table_loads ledger.
+    pass full_history=True to load every week in the CSV (e.g. for an old bundle.)
+    """
+    DB = get_db()
+    if bundle_date and is_table_loaded(DB, "advertiser_weekly_spend", bundle_date):
+        return
+    start_time = datetime.now()
+    watermark = None if full_history else get_watermark(DB)
+    with raw_transaction(DB) as cursor:
+        create_staging_table(cursor, "advertiser_weekly_spend")
+        total_rows = copy_rows(cursor, staging_table_name("advertiser_weekly_spend"), KEYS, parse_advertiser_weekly_spend(csv_filelike, watermark))
+        cursor.execute(MERGE_QUERY)
+        changed_rows = cursor.rowcount
     duration = (datetime.now() - start_time)
-    log1 = "loaded {} advertiser weekly spend records for this week in {}".format(total_rows , formattimedelta(duration))
+    if bundle_date:
+        record_table_load(DB, "advertiser_weekly_spend", bundle_date, total_rows)
+    log1 = "loaded {} advertiser weekly spend records for weeks since {} ({} new or changed) in {}".format(total_rows, watermark or "the beginning", changed_rows, formattimedelta(duration))
     log.info(log1)
     info_to_slack("Google ads: " + log1)
 
@@ -49,6 +85,7 @@ if __name__ == "__main__":
     # with open(csvfn, 'r') as f:
         # load_advertiser_weekly_spend_to_db(f)
     local_dest_for_bundle = os.path.join(os.path.dirname(__file__), '..', 'data')
-    with get_current_bundle() as zip_file:
-        bundle_date = get_bundle_date(zip_file)
-        load_advertiser_weekly_spend_to_db(TextIOWrapper(BytesIO(get_advertiser_weekly_spend_csv(zip_file))))
+    with Bundle(get_current_bundle()) as bundle:
+        bundle_date = get_bundle_date(bundle)
+        with get_advertiser_weekly_spend_csv(bundle) as csv:
+            load_advertiser_weekly_spend_to_db(csv, bundle_date)
@@ -3,15 +3,15 @@
 # insert the  (daily) advertiser stats to the DB
 # sync the latest advertiser weekly spend to the DB
 # sync the creative stats to the DB
+# (to load many bundles, see backfill.py)
 
 import os
-from io import TextIOWrapper, BytesIO
 import logging
 import tempfile
 from sys import argv
 import datetime
 
-from google_political_transparency_report.transparency_bundle.get_transparency_bundle import get_current_bundle, upload_advertiser_stats_from_bundle, get_advertiser_weekly_spend_csv, get_creative_stats_csv, get_advertiser_stats_csv, get_bundle_date
+from google_political_transparency_report.transparency_bundle.get_transparency_bundle import Bundle, upload_advertiser_stats_from_bundle, get_advertiser_weekly_spend_csv, get_creative_stats_csv, get_advertiser_stats_csv, get_advertiser_regional_spend_csv, get_bundle_date
 from google_political_transparency_report.transparency_bundle.load_advertiser_weekly_spend import load_advertiser_weekly_spend_to_db
 from google_political_transparency_report.transparency_bundle.load_advertiser_stats import load_advertiser_stats_to_db
 from google_political_transparency_report.transparency_bundle.load_creative_stats import load_creative_stats_to_db
@@ -20,7 +20,7 @@ from google_political_transparency_report.common.post_to_slack import warn_to_sl
 
 
 def get_bundle_from_zip(zip_fn):
-    return open(zip_fn, 'rb')
+    return Bundle(open(zip_fn, 'rb'))
 
 
 logging.basicConfig(level=logging.INFO)
@@ -30,15 +30,17 @@ if __name__ == "__main__":
     try: 
         with tempfile.TemporaryDirectory() as local_dest_for_bundle:
         # local_dest_for_bundle = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
-            with get_bundle_from_zip(argv[1]) as zip_file:
+            with get_bundle_from_zip(argv[1]) as bundle:
                 explicit_bundle_date = datetime.date(*map(int, argv[2].split("-"))) if len(argv) >= 3 else None
-                bundle_date = explicit_bundle_date or get_bundle_date(zip_file)
+                bundle_date = explicit_bundle_date or get_bundle_date(bundle)
                 # NOTE: we're not loading advertiser_stats b/c old data (what we're loading here) would squash newer data already in the DB.
-                #                 assert False upload_advertiser_stats_from_bundle(zip_file, local_dest_for_bundle, bundle_date)
-                #                 assert False  load_advertiser_stats_to_db(TextIOWrapper(BytesIO(get_advertiser_stats_csv(zip_file))), bundle_date)
-                load_advertiser_weekly_spend_to_db(TextIOWrapper(BytesIO(get_advertiser_weekly_spend_csv(zip_file))))
-                # NOTE: we're not doing creative_stats, since it overwrites stuff, which is a problem if you're loading an old bundle                 load_creative_stats_to_db(TextIOWrapper(BytesIO(get_creative_stats_csv(zip_file))), bundle_date)
-                load_advertiser_regional_spend_to_db(TextIOWrapper(BytesIO(get_creative_stats_csv(zip_file))), bundle_date)
+                #                 assert False upload_advertiser_stats_from_bundle(bundle, local_dest_for_bundle, bundle_date)
+                #                 assert False  load_advertiser_stats_to_db(get_advertiser_stats_csv(bundle), bundle_date)
+                with get_advertiser_weekly_spend_csv(bundle) as csv:
+                    load_advertiser_weekly_spend_to_db(csv, bundle_date, full_history=True)
+                # NOTE: we're not doing creative_stats, since it overwrites stuff, which is a problem if you're loading an old bundle                 load_creative_stats_to_db(get_creative_stats_csv(bundle), bundle_date)
+                with get_advertiser_regional_spend_csv(bundle) as csv:
+                    load_advertiser_regional_spend_to_db(csv, bundle_date)
     except Exception as e:
         warn_to_slack(f"google_political_transparency_report.transparency_bundle.daily error: {e}")
         log.error(e)
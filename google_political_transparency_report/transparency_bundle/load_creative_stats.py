@@ -3,18 +3,27 @@ script to load from a CSV into SQL db specified as env var DATABASE_URL the ad c
 
 the goal is to *sync* the DB with the CSV, rather than to maintain diffs. that's because the CSV is humongous and much of the data will never change.
 
+but ads do disappear from the CSV and come back, so creative_stats_history keeps when each version (row_hash) of each ad was in it,
+as intervals that are diffed against each day's CSV in a couple of set-based statements. (see schema.sql for how to query it.)
+
 """
 
 import agate
 
 import os
-from io import TextIOWrapper, BytesIO
-from datetime import datetime, timedelta, date
+import hashlib
+from functools import partial
+from datetime import datetime
 import logging
 
-import records
 
-from google_political_transparency_report.transparency_bundle.get_transparency_bundle import get_current_bundle, get_zip_file_by_name, get_bundle_date, get_creative_stats_csv
+from google_political_transparency_report.transparency_bundle.get_transparency_bundle import Bundle, get_current_bundle, get_bundle_date, get_creative_stats_csv
+from .bundle_ledger import is_table_loaded, record_table_load
+from .stream_csv import iter_rows, iter_reader_rows
+from .schema_registry import register_schema, check_header
+from ..common.database import get_db, raw_transaction
+from .copy_rows import create_staging_table, staging_table_name, copy_rows, copy_csv_chunks, encode_rows
+from .parallel_csv import parse_csv_in_parallel
 from ..common.post_to_slack import info_to_slack
 from ..common.formattimedelta import formattimedelta
 
@@ -60,15 +69,21 @@ def parse_impressions_string(impressions):
         return None, None
 
 
-INSERT_QUERY = "INSERT INTO creative_stats ({}) VALUES ({}) ON CONFLICT (ad_id) DO UPDATE SET {}".format(', '.join([k for k in KEYS]), ', '.join([":" + k for k in KEYS]), ', '.join([f"{k} = :{k}" for k in KEYS]))
-
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+# everything but report_date; a row whose hash of these is unchanged isn't touched at all, so report_date is the report it last changed in.
+# (whether an ad is in the latest report is in creative_stats_history: its interval with valid_to NULL.)
+HASHED_KEYS = [k for k in KEYS if k != "report_date"]
+COPY_KEYS = KEYS + ["row_hash"]
 
+# rows are COPYed into creative_stats_staging, then merged: only new or changed rows are written (DISTINCT ON because ON CONFLICT can't touch the same ad_id twice)
+MERGE_QUERY = """INSERT INTO creative_stats ({}) SELECT DISTINCT ON (ad_id) {} FROM {} ORDER BY ad_id
+    ON CONFLICT (ad_id) DO UPDATE SET {} WHERE creative_stats.row_hash IS DISTINCT FROM EXCLUDED.row_hash""".format(
+        ', '.join(COPY_KEYS), ', '.join(COPY_KEYS), staging_table_name("creative_stats"), ', '.join([f"{k} = EXCLUDED.{k}" for k in COPY_KEYS]))
+def row_hash(ad_data):
+    """a stable hash of the business columns of a creative stats row"""
+    return hashlib.md5("\x1f".join("" if ad_data[k] is None else str(ad_data[k]) for k in HASHED_KEYS).encode("utf-8")).hexdigest()
 
-# specifying column types saves 50% of time in loading the CSV! (30min w/o, 15min w/)
+# these are used to pick a converter for each column we load (see stream_csv.py);
+# with agate.Table.from_csv, specifying them saved 50% of the time in loading the CSV (30min w/o, 15min w/), but it was still slow.
 CREATIVE_STATS_COLUMN_TYPES = {'Ad_ID': agate.Text(), 'Ad_URL': agate.Text(), 'Ad_Type': agate.Text(), 
                     'Regions': agate.Text(), 'Advertiser_ID': agate.Text(), 'Advertiser_Name': agate.Text(), 
                     'Ad_Campaigns_List': agate.Boolean(), 'Date_Range_Start': agate.Date(), 'Date_Range_End': agate.Date(), 
@@ -84,47 +99,95 @@ OLD_CREATIVE_STATS_COLUMN_TYPES = {'Ad_ID': agate.Text(), 'Ad_URL': agate.Text()
                     'Num_of_Days': agate.Number(), 'Impressions': agate.Text(), 'Spend_USD': agate.Text(), 
                     }
 
-
-CREATIVE_STATS_SCHEMA_CHANGE_DATE = date(2020, 7, 1) # it's sometime around here, I don't know for sure, that the schema changes
-
-def load_creative_stats_to_db(csvfn, report_date):
-    DB = records.Database(os.environ['DATABASE_URL'])
-
-    # should log: duration, total rows; New today; here yesterday, gone today.
-    total_rows_today = 0
-
-    # start_time_pre_counting = datetime.now()
-    rows_in_yesterdays_report = DB.query("""SELECT count(*) as count FROM creative_stats WHERE report_date = (SELECT max(report_date) from creative_stats where report_date != :report_date);""", report_date=report_date)[0]["count"]
-    # duration_pre_counting = (datetime.now() - start_time_pre_counting)
+# which of these a CSV is gets worked out from its header (see schema_registry.py). the old one was sometime before mid-2020;
+# we only know the columns we typed, not its whole header.
+register_schema("creative_stats", "pre-2020-07", OLD_CREATIVE_STATS_COLUMN_TYPES, complete=False)
+register_schema("creative_stats", "2020-07", CREATIVE_STATS_COLUMN_TYPES)
+
+
+# the history: an interval seeded from before creative_stats had a row_hash (see schema.sql) takes the hash of today's row,
+# if the ad's still there, unchanged. this compares against creative_stats as it was before the merge, so it runs first.
+REKEY_HISTORY_QUERY = """UPDATE creative_stats_history history SET row_hash = staging.row_hash FROM {} staging, creative_stats
+    WHERE history.valid_to IS NULL AND history.row_hash IS NULL AND staging.ad_id = history.ad_id AND creative_stats.ad_id = history.ad_id
+    AND ({}) IS NOT DISTINCT FROM ({})""".format(staging_table_name("creative_stats"), ', '.join(f"creative_stats.{k}" for k in HASHED_KEYS), ', '.join(f"staging.{k}" for k in HASHED_KEYS))
+# then close the intervals of ads that aren't in today's CSV, or are there with a different row_hash...
+CLOSE_HISTORY_QUERY = """UPDATE creative_stats_history history SET valid_to = %(report_date)s
+    WHERE history.valid_to IS NULL AND NOT EXISTS (SELECT 1 FROM {} staging WHERE staging.ad_id = history.ad_id AND staging.row_hash = history.row_hash)""".format(staging_table_name("creative_stats"))
+# ... and open an interval for each ad in it that doesn't have one (i.e. a new, changed or returning ad.)
+OPEN_HISTORY_QUERY = """INSERT INTO creative_stats_history (ad_id, row_hash, valid_from)
+    SELECT DISTINCT ON (ad_id) ad_id, row_hash, %(report_date)s FROM {} staging
+    WHERE NOT EXISTS (SELECT 1 FROM creative_stats_history history WHERE history.ad_id = staging.ad_id AND history.valid_to IS NULL)
+    ORDER BY ad_id""".format(staging_table_name("creative_stats"))
+CHURN_QUERY = """SELECT (SELECT count(*) FROM creative_stats_appeared(%(report_date)s)) AS appeared, (SELECT count(*) FROM creative_stats_disappeared(%(report_date)s)) AS disappeared"""
+
+
+def normalize_creative_stats(rows, report_date):
+    for ad_data in rows:
+        ad_data["impressions_min"], ad_data["impressions_max"] = parse_impressions_string(ad_data.pop("impressions"))
+        ad_data["spend_usd"] = ad_data["spend_usd"] or 0
+        ad_data["report_date"] = report_date
+        ad_data["row_hash"] = row_hash(ad_data)
+        yield ad_data
+
+def parse_creative_stats(csv_filelike, report_date):
+    """yields a dict of KEYS for each row of the creative stats CSV, ready to insert"""
+    return normalize_creative_stats(iter_rows(csv_filelike, "creative_stats", KEYS + ["impressions"]), report_date)
+
+def parse_creative_stats_range(header, reader, report_date):
+    """parallel_csv worker: returns (row count, COPY text) for one range of the creative stats CSV"""
+    return encode_rows(normalize_creative_stats(iter_reader_rows(header, reader, "creative_stats", KEYS + ["impressions"]), report_date), COPY_KEYS)
+
+def copy_creative_stats_to_staging(cursor, csvfn, report_date, workers):
+    """returns the number of rows copied"""
+    if workers > 1:
+        total_rows = 0
+        def chunks():
+            nonlocal total_rows
+            for row_count, text in parse_csv_in_parallel(csvfn, partial(parse_creative_stats_range, report_date=report_date), workers, check_header=partial(check_header, "creative_stats")):
+                total_rows += row_count
+                yield text
+        copy_csv_chunks(cursor, staging_table_name("creative_stats"), COPY_KEYS, chunks())
+        return total_rows
+    return copy_rows(cursor, staging_table_name("creative_stats"), COPY_KEYS, parse_creative_stats(csvfn, report_date))
+
+def load_creative_stats_to_db(csvfn, report_date, workers=None):
+    """
+    workers >1 parses the CSV in that many processes (see parallel_csv.py); defaults to env var CREATIVE_STATS_PARSE_WORKERS, or 1,
+    i.e. parsed in-process. only set it where benchmark_parallel_parse.py shows the parallel parse is faster.
+    """
+    workers = workers or int(os.environ.get("CREATIVE_STATS_PARSE_WORKERS", 1))
+    DB = get_db()
+    if is_table_loaded(DB, "creative_stats", report_date):
+        return
+
+    # the history's intervals only make sense if CSVs are diffed in date order.
+    last_report_date = DB.query("SELECT max(bundle_date) bundle_date FROM bundle_table_loads WHERE table_name = 'creative_stats';")[0]["bundle_date"]
+    if last_report_date and report_date < last_report_date:
+        raise ValueError("can't load creative stats for {}, since {} is already loaded".format(report_date, last_report_date))
 
     start_time_data_loading = datetime.now()
-    for batch in  chunks(agate.Table.from_csv(csvfn, column_types=(CREATIVE_STATS_COLUMN_TYPES if report_date > CREATIVE_STATS_SCHEMA_CHANGE_DATE else OLD_CREATIVE_STATS_COLUMN_TYPES)), 100):
-        ads_data = []
-        for row in batch:
-            total_rows_today += 1
-            ad_data = {k.lower():v for k,v in row.items() if k.lower() in KEYS}
-            for k in KEYS: 
-                ad_data[k] = ad_data.get(k, None)
-            ad_data["impressions_min"], ad_data["impressions_max"] = parse_impressions_string(row["Impressions"])
-            ad_data["spend_usd"] = ad_data["spend_usd"] or 0
-            ad_data["report_date"] = report_date
-            ads_data.append(ad_data)
-        DB.bulk_query(INSERT_QUERY, ads_data)
+    with raw_transaction(DB) as cursor:
+        create_staging_table(cursor, "creative_stats")
+        total_rows_today = copy_creative_stats_to_staging(cursor, csvfn, report_date, workers)
+        cursor.execute(REKEY_HISTORY_QUERY)
+        cursor.execute(MERGE_QUERY)
+        changed_rows_today = cursor.rowcount
+        cursor.execute(CLOSE_HISTORY_QUERY, {"report_date": report_date})
+        cursor.execute(OPEN_HISTORY_QUERY, {"report_date": report_date})
+        cursor.execute(CHURN_QUERY, {"report_date": report_date})
+        appeared_today, disappeared_today = cursor.fetchone()
     duration_data_loading = (datetime.now() - start_time_data_loading)
+    record_table_load(DB, "creative_stats", report_date, total_rows_today)
 
-    # start_time_post_counting = datetime.now()
-    rows_present_yesterday_but_missing_today = DB.query("""SELECT count(*) as count FROM creative_stats WHERE report_date = :report_date;""", report_date = report_date - timedelta(days=1))[0]["count"]
-    new_rows_today = total_rows_today - (rows_in_yesterdays_report - rows_present_yesterday_but_missing_today) 
-    # duration_post_counting = (datetime.now() - start_time_post_counting)
-
-    log1 = "loading creative_stats report took {} to load {} total rows".format(formattimedelta(duration_data_loading), total_rows_today)
-    log2 = "creative stats: {} new rows; {} missing that were present yesterday".format(new_rows_today, rows_present_yesterday_but_missing_today)
+    log1 = "loading creative_stats report took {} to load {} total rows ({} new or changed)".format(formattimedelta(duration_data_loading), total_rows_today, changed_rows_today)
+    log2 = "creative stats: {} new rows (or back again); {} missing that were present in the previous report".format(appeared_today, disappeared_today)
     log.info(log1)
     log.info(log2)
     info_to_slack("Google ads: " + log1 + "\n" + log2)
 
 
 if __name__ == "__main__":
-    with get_current_bundle() as zip_file:
-        bundle_date = get_bundle_date(zip_file)
-        load_creative_stats_to_db(TextIOWrapper(BytesIO(get_creative_stats_csv(zip_file))), bundle_date)
+    with Bundle(get_current_bundle()) as bundle:
+        bundle_date = get_bundle_date(bundle)
+        with get_creative_stats_csv(bundle) as csv:
+            load_creative_stats_to_db(csv, bundle_date)
@@ -0,0 +1,120 @@
+"""
+parallel parsing of one big CSV (i.e. creative stats) with a process pool.
+
+the decompressed CSV is read a chunk at a time and cut into ranges of whole records, each ending on a record boundary:
+a newline that isn't inside a quoted field (quoted fields, like ad text, can contain newlines.)
+each range is handed to a worker process as soon as it's been read, so parsing overlaps with decompressing the rest,
+and the results come back in order, a bounded number at a time, so a single writer (e.g. a COPY) can consume them as a stream.
+
+it's off by default (see load_creative_stats.py): shipping each range to a worker and its COPY text back costs more than
+parsing it in-process, so it only pays off with several idle CPUs. check with benchmark_parallel_parse.py on the host first.
+"""
+
+import csv
+import io
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+RANGE_SIZE = 16 * 1024 * 1024 # bytes of CSV per worker task
+SCAN_CHUNK_SIZE = 1024 * 1024 # bytes
+
+
+class EncodingReader:
+    """a binary read() over a text stream without a .buffer (Bundle.open_csv's streams have one, so they're read directly)"""
+    def __init__(self, text_filelike):
+        self.text_filelike = text_filelike
+
+    def read(self, size):
+        return self.text_filelike.read(size).encode("utf-8")
+
+
+def csv_bytes(csv_filelike):
+    """the bytes of `csv_filelike`, a text stream from Bundle.open_csv or any text file-like, as a binary file-like"""
+    return csv_filelike.buffer if hasattr(csv_filelike, "buffer") else EncodingReader(csv_filelike)
+
+
+def iter_record_ranges(f, range_size=RANGE_SIZE):
+    """
+    yields the bytes of the binary file-like `f` as consecutive ranges: the header, then ranges of whole records,
+    each ending at the first record boundary at least `range_size` bytes in (so each but the last is at least that long.)
+
+    a newline ends a record if an even number of quote characters precede it (an escaped quote, "", counts twice, so that still works.)
+    every range ends on a record boundary, so that's the same as an even number of quotes before it within its range.
+    """
+    pending = [] # the current range's bytes from earlier chunks
+    pending_length = 0
+    pending_quotes = 0
+    min_length = 0 # the header ends at the first record boundary
+    while True:
+        chunk = f.read(SCAN_CHUNK_SIZE)
+        if not chunk:
+            break
+        start = 0 # where the current range starts in this chunk
+        while True:
+            i = chunk.find(b"\n", start + max(min_length - pending_length, 0))
+            while i != -1 and (pending_quotes + chunk.count(b'"', start, i)) % 2:
+                i = chunk.find(b"\n", i + 1)
+            if i == -1:
+                # no record boundary in the rest of this chunk; keep looking in the next one.
+                break
+            pending.append(chunk[start:i + 1])
+            yield b"".join(pending)
+            pending, pending_length, pending_quotes = [], 0, 0
+            start = i + 1
+            min_length = range_size
+        pending.append(chunk[start:])
+        pending_length += len(chunk) - start
+        pending_quotes += chunk.count(b'"', start)
+    if pending_length:
+        yield b"".join(pending)
+
+
+def record_boundaries(f, range_size=RANGE_SIZE):
+    """
+    returns byte offsets into the binary file `f` of the ranges iter_record_ranges would yield: the end of the header,
+    then the end of each range after it, and lastly (always) the file size.
+    """
+    f.seek(0)
+    boundaries = []
+    offset = 0
+    for record_range in iter_record_ranges(f, range_size):
+        offset += len(record_range)
+        boundaries.append(offset)
+    return boundaries or [0]
+
+
+def read_header(header_bytes):
+    return next(csv.reader(io.StringIO(header_bytes.decode("utf-8"))))
+
+
+def parse_range(record_range, header, parse):
+    """worker: parses `record_range`, the bytes of some whole records of the CSV, with parse(header, csv.reader)"""
+    return parse(header, csv.reader(io.StringIO(record_range.decode("utf-8"), newline="")))
+
+
+def parse_csv_in_parallel(csv_filelike, parse, workers, range_size=RANGE_SIZE, check_header=None):
+    """
+    yields parse(header, csv.reader) for each range of the CSV, in order, parsing up to `workers` ranges at once.
+    if given, check_header(header) is called here, before any range is parsed (e.g. to report schema drift once, not once per worker.)
+
+    `parse` runs in a worker process, so it must be picklable (a module-level function, or a functools.partial of one)
+    and should return something compact, like the COPY text of its rows (see copy_rows.encode_rows.)
+    """
+    record_ranges = iter_record_ranges(csv_bytes(csv_filelike), range_size)
+    header_bytes = next(record_ranges, None)
+    if header_bytes is None:
+        return
+    header = read_header(header_bytes)
+    if check_header:
+        check_header(header)
+    # forkserver, not fork: we're often called from a thread (e.g. a daily.py stage), and forking a threaded process can deadlock the child.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        pending = deque()
+        for record_range in record_ranges:
+            pending.append(pool.submit(parse_range, record_range, header, parse))
+            # keep the pool busy, but don't let read ranges (or finished ones) pile up faster than the writer takes them.
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
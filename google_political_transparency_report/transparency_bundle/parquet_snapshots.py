@@ -0,0 +1,223 @@
+"""
+typed, compressed Parquet snapshots of the bundle CSVs, for analyses over their history without touching the DB.
+
+each bundle's creative stats, advertiser stats and advertiser regional spend CSVs are written, every column
+and every row (not just the ones the loaders keep), to
+
+    <PARQUET_SNAPSHOT_DIR>/<table>/report_date=<bundle date>/part-0.parquet
+
+(PARQUET_SNAPSHOT_DIR is an env var; by default, data/parquet at the top of the repo.)
+column names are lowercased, and columns are typed by the schema the loaders register for that CSV's header
+(see schema_registry.py), e.g. CREATIVE_STATS_COLUMN_TYPES; columns without a type are strings.
+
+to snapshot a CSV that's being read anyway (e.g. by a loader) without decompressing it a second time, tee it to
+teed_snapshot(table, report_date)'s sink, as in daily.py, and the snapshot is written from the same read, in a thread of its own.
+
+read_snapshots(table, columns, filter, start_date, end_date) reads them back with pyarrow.dataset,
+so only the requested columns and the partitions (and row groups) that can match the filter are read, e.g.
+
+    read_snapshots("advertiser_regional_spend", columns=["advertiser_id", "spend_usd", "report_date"],
+                   filter=pyarrow.dataset.field("country_subdivision_primary") == "Arizona", start_date=date(2020, 1, 1))
+
+pyarrow is optional: without it, snapshots are skipped (with a warning) and read_snapshots raises.
+
+usage: python -m google_political_transparency_report.transparency_bundle.parquet_snapshots <env file path> <bundle zip> [<bundle zip> ...]
+"""
+
+import datetime
+import io
+import logging
+import os
+import sys
+import csv
+import threading
+from contextlib import contextmanager
+
+import agate
+from dotenv import load_dotenv
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .get_transparency_bundle import Bundle, get_creative_stats_csv, get_advertiser_stats_csv, get_advertiser_regional_spend_csv
+from .stream_csv import to_text, to_number, to_date, to_datetime, to_boolean, batches
+from .schema_registry import check_header
+# imported so that they register their schemas
+from . import load_creative_stats, load_advertiser_stats, load_advertiser_regional_spend
+from ..common.formattimedelta import formattimedelta
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.parquet_snapshots")
+
+DEFAULT_PARQUET_SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'parquet')
+ROW_GROUP_SIZE = 100_000 # rows
+PARQUET_COMPRESSION = "zstd"
+
+# table: function that opens its CSV in a Bundle
+SNAPSHOT_TABLES = {
+    "creative_stats": get_creative_stats_csv,
+    "advertiser_stats": get_advertiser_stats_csv,
+    "advertiser_regional_spend": get_advertiser_regional_spend_csv,
+}
+
+
+def to_float(value):
+    number = to_number(value)
+    return None if number is None else float(number)
+
+if pyarrow:
+    # agate type: (converter, arrow type)
+    ARROW_TYPES = {
+        agate.Text: (to_text, pyarrow.string()),
+        agate.Number: (to_float, pyarrow.float64()),
+        agate.Date: (to_date, pyarrow.date32()),
+        agate.DateTime: (to_datetime, pyarrow.timestamp("s")),
+        agate.Boolean: (to_boolean, pyarrow.bool_()),
+    }
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Parquet snapshots need pyarrow (pip install pyarrow)")
+
+
+def snapshot_dir():
+    return os.environ.get("PARQUET_SNAPSHOT_DIR", DEFAULT_PARQUET_SNAPSHOT_DIR)
+
+def table_dir(table):
+    return os.path.join(snapshot_dir(), table)
+
+def snapshot_path(table, report_date):
+    return os.path.join(table_dir(table), "report_date={}".format(report_date), "part-0.parquet")
+
+
+def arrow_plan(header, column_types):
+    """returns (arrow schema, list of converters) for the columns in `header`"""
+    converters = []
+    fields = []
+    for column in header:
+        column_type = column_types.get(column)
+        convert, arrow_type = ARROW_TYPES[type(column_type)] if column_type is not None else ARROW_TYPES[agate.Text]
+        converters.append(convert)
+        fields.append(pyarrow.field(column.lower(), arrow_type))
+    return pyarrow.schema(fields), converters
+
+
+def write_snapshot(csv_filelike, table, report_date):
+    """writes the CSV `csv_filelike` as the `table` snapshot for `report_date`; returns the number of rows"""
+    reader = csv.reader(csv_filelike)
+    header = next(reader)
+    schema, converters = arrow_plan(header, check_header(table, header).column_types)
+    dest = snapshot_path(table, report_date)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    partial = os.path.join(os.path.dirname(dest), "_" + os.path.basename(dest)) # pyarrow.dataset ignores files starting with _
+    row_count = 0
+    with pyarrow.parquet.ParquetWriter(partial, schema, compression=PARQUET_COMPRESSION) as writer:
+        for batch in batches(reader, ROW_GROUP_SIZE):
+            columns = [pyarrow.array([convert(row[i]) if i < len(row) else None for row in batch], type=field.type) for i, (convert, field) in enumerate(zip(converters, schema))]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            row_count += len(batch)
+    os.replace(partial, dest)
+    return row_count
+
+
+@contextmanager
+def teed_snapshot(table, report_date):
+    """
+    yields a sink for Bundle.open_csv's tee_to: the bytes of `table`'s CSV written to it are written as its snapshot for `report_date`,
+    by a thread that reads them from a pipe. the snapshot's done when the block exits. yields None if there's nothing to do
+    (i.e. there's already a snapshot, or no pyarrow.)
+    """
+    if pyarrow is None:
+        log.warning("pyarrow isn't installed; skipping the {} Parquet snapshot".format(table))
+        yield None
+        return
+    if os.path.exists(snapshot_path(table, report_date)):
+        log.info("{} snapshot for {} already written".format(table, report_date))
+        yield None
+        return
+    read_fd, write_fd = os.pipe()
+    errors = []
+    def write():
+        start_time = datetime.datetime.now()
+        with io.TextIOWrapper(os.fdopen(read_fd, 'rb'), encoding='utf-8', newline='') as csv_filelike:
+            try:
+                row_count = write_snapshot(csv_filelike, table, report_date)
+                log.info("wrote {} snapshot for {} ({} rows) in {}".format(table, report_date, row_count, formattimedelta(datetime.datetime.now() - start_time)))
+            except Exception as e:
+                errors.append(e)
+                # keep reading, so the writer's never left blocked on a full pipe
+                while csv_filelike.buffer.read(io.DEFAULT_BUFFER_SIZE):
+                    pass
+    thread = threading.Thread(target=write, name="{}-snapshot".format(table))
+    thread.start()
+    try:
+        with os.fdopen(write_fd, 'wb') as sink:
+            yield sink
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def write_bundle_snapshots(bundle, bundle_date, tables=None):
+    """writes a snapshot of each of `tables` (by default, SNAPSHOT_TABLES) from `bundle`, unless there already is one for `bundle_date`"""
+    if pyarrow is None:
+        log.warning("pyarrow isn't installed; skipping Parquet snapshots")
+        return
+    for table in tables or SNAPSHOT_TABLES:
+        get_csv = SNAPSHOT_TABLES[table]
+        if os.path.exists(snapshot_path(table, bundle_date)):
+            log.info("{} snapshot for {} already written".format(table, bundle_date))
+            continue
+        start_time = datetime.datetime.now()
+        with get_csv(bundle) as csv_filelike:
+            row_count = write_snapshot(csv_filelike, table, bundle_date)
+        log.info("wrote {} snapshot for {} ({} rows) in {}".format(table, bundle_date, row_count, formattimedelta(datetime.datetime.now() - start_time)))
+
+
+def union_schema(schemas):
+    """the union of the columns of `schemas`; a column whose type has changed (e.g. Ad_Campaigns_List, text and then boolean) is read as a string"""
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in fields:
+                fields[field.name] = field
+            elif fields[field.name].type != field.type:
+                fields[field.name] = pyarrow.field(field.name, pyarrow.string())
+    return pyarrow.schema(list(fields.values()))
+
+
+def snapshot_dataset(table):
+    """returns a pyarrow Dataset of every snapshot of `table`, with report_date as a (partition) column"""
+    require_pyarrow()
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([("report_date", pyarrow.date32())]), flavor="hive")
+    dataset = pyarrow.dataset.dataset(table_dir(table), format="parquet", partitioning=partitioning)
+    # the CSVs' columns have changed over the years, so read every snapshot as the union of their columns.
+    schema = union_schema([fragment.physical_schema for fragment in dataset.get_fragments()] + [dataset.schema])
+    return pyarrow.dataset.dataset(table_dir(table), format="parquet", partitioning=partitioning, schema=schema)
+
+
+def read_snapshots(table, columns=None, filter=None, start_date=None, end_date=None):
+    """
+    returns a pyarrow Table of the snapshots of `table` for report dates between start_date and end_date (inclusive, if given),
+    with just `columns` (if given) and the rows that match `filter` (a pyarrow.dataset expression, if given)
+    """
+    dataset = snapshot_dataset(table)
+    for condition in ([pyarrow.dataset.field("report_date") >= start_date] if start_date else []) + ([pyarrow.dataset.field("report_date") <= end_date] if end_date else []):
+        filter = condition if filter is None else filter & condition
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('USAGE: {} <env file path> <bundle zip> [<bundle zip> ...]'.format(sys.argv[0]))
+        sys.exit(1)
+    load_dotenv(sys.argv[1])
+    logging.basicConfig(level=logging.INFO)
+    for zip_fn in sys.argv[2:]:
+        with Bundle(open(zip_fn, 'rb')) as bundle:
+            write_bundle_snapshots(bundle, bundle.bundle_date)
@@ -0,0 +1,104 @@
+"""
+monthly range partitions for the tables that get a full snapshot every bundle day (e.g. advertiser_regional_spend),
+which are declared in schema.sql as PARTITION BY RANGE (report_date).
+
+ - ensure_partition(cursor, table, day) creates the partition for the month of `day`, if it doesn't exist yet; the loaders call it before they insert.
+ - partition_existing_table(DB, table) converts a table created before it was partitioned in schema.sql.
+ - detach_partitions_before(DB, table, cutoff) detaches the partitions of months before `cutoff` and moves them into the `archive` schema
+   (or drops them), which only touches the catalog, not the rows; an archived partition can be queried as is, or re-attached.
+
+usage: python -m google_political_transparency_report.transparency_bundle.partitions <env file path> list <table>
+       python -m google_political_transparency_report.transparency_bundle.partitions <env file path> migrate <table>
+       python -m google_political_transparency_report.transparency_bundle.partitions <env file path> detach <table> <cutoff date> [drop]
+"""
+
+import datetime
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+from ..common.database import get_db, raw_transaction
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.partitions")
+
+ARCHIVE_SCHEMA = "archive"
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+def next_month_start(day):
+    return (month_start(day) + datetime.timedelta(days=32)).replace(day=1)
+
+def partition_name(table, day):
+    return "{}_{}".format(table, month_start(day).strftime("%Y_%m"))
+
+
+def ensure_partition(cursor, table, day):
+    """creates the partition of `table` for the month of `day` if there isn't one, in the cursor's transaction"""
+    name = partition_name(table, day)
+    # concurrent loads (e.g. a backfill) could otherwise both try to create it.
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (name,))
+    cursor.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);".format(name, table), (month_start(day), next_month_start(day)))
+
+
+def list_partitions(DB, table):
+    """returns the names of the partitions attached to `table`, oldest first"""
+    rows = DB.query("""SELECT child.relname AS name FROM pg_inherits
+                       JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                       JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                       WHERE parent.relname = :table ORDER BY child.relname;""", table=table).all()
+    return [row["name"] for row in rows]
+
+
+def partition_existing_table(DB, table, column="report_date"):
+    """
+    replaces the unpartitioned `table` with one partitioned by month of `column`, in one transaction.
+    its constraints, defaults and indexes are copied; add the BRIN index from schema.sql afterwards.
+    """
+    unpartitioned = "{}_unpartitioned".format(table)
+    with raw_transaction(DB) as cursor:
+        cursor.execute("ALTER TABLE {} RENAME TO {};".format(table, unpartitioned))
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING ALL) PARTITION BY RANGE ({});".format(table, unpartitioned, column))
+        cursor.execute("SELECT DISTINCT date_trunc('month', {})::date FROM {} WHERE {} IS NOT NULL;".format(column, unpartitioned, column))
+        for (month,) in cursor.fetchall():
+            ensure_partition(cursor, table, month)
+        cursor.execute("INSERT INTO {} SELECT * FROM {};".format(table, unpartitioned))
+        log.info("partitioned {} ({} rows)".format(table, cursor.rowcount))
+        cursor.execute("DROP TABLE {};".format(unpartitioned))
+
+
+def detach_partitions_before(DB, table, cutoff, drop=False):
+    """detaches the partitions of `table` for months wholly before `cutoff`, moving them to the archive schema, or dropping them if `drop`"""
+    cutoff_partition = partition_name(table, cutoff)
+    old_partitions = [name for name in list_partitions(DB, table) if name < cutoff_partition]
+    with raw_transaction(DB) as cursor:
+        if not drop:
+            cursor.execute("CREATE SCHEMA IF NOT EXISTS {};".format(ARCHIVE_SCHEMA))
+        for name in old_partitions:
+            cursor.execute("ALTER TABLE {} DETACH PARTITION {};".format(table, name))
+            if drop:
+                cursor.execute("DROP TABLE {};".format(name))
+            else:
+                cursor.execute("ALTER TABLE {} SET SCHEMA {};".format(name, ARCHIVE_SCHEMA))
+            log.info("{} partition {}".format("dropped" if drop else "archived", name))
+    return old_partitions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print('USAGE: {} <env file path> list <table> | migrate <table> | detach <table> <cutoff date> [drop]'.format(sys.argv[0]))
+        sys.exit(1)
+    load_dotenv(sys.argv[1])
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[2] == "list":
+        for name in list_partitions(get_db(), sys.argv[3]):
+            print(name)
+    elif sys.argv[2] == "migrate":
+        partition_existing_table(get_db(), sys.argv[3])
+    elif sys.argv[2] == "detach":
+        detach_partitions_before(get_db(), sys.argv[3], datetime.date.fromisoformat(sys.argv[4]), drop=len(sys.argv) >= 6 and sys.argv[5] == "drop")
+    else:
+        print('USAGE: {} <env file path> list <table> | migrate <table> | detach <table> <cutoff date> [drop]'.format(sys.argv[0]))
+        sys.exit(1)
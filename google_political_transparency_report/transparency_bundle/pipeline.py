@@ -0,0 +1,88 @@
+"""
+runs a pipeline (i.e. daily.py) as a small graph of stages on a thread pool.
+
+each Stage has a name, a function (called with no arguments) and the names of the stages it depends on.
+a stage starts as soon as everything it depends on has succeeded, so independent stages -- loads into
+different tables, GCS uploads -- overlap. if a stage fails, the stages that depend on it are skipped,
+but every other stage still runs to completion, so one bad table doesn't throw away the others' work.
+"""
+
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from ..common.formattimedelta import formattimedelta
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.pipeline")
+
+PIPELINE_WORKERS = 4
+
+Stage = namedtuple("Stage", ["name", "fn", "depends_on"], defaults=[()])
+StageResult = namedtuple("StageResult", ["status", "duration", "error"])
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class PipelineError(Exception):
+    def __init__(self, results):
+        self.results = results
+        failures = {name: result.error for name, result in results.items() if result.status == FAILED}
+        super().__init__("stages failed: {}".format(", ".join("{} ({!r})".format(name, error) for name, error in failures.items())))
+
+
+def timed(stage):
+    start_time = datetime.now()
+    stage.fn()
+    return datetime.now() - start_time
+
+
+def run_stages(stages, workers=PIPELINE_WORKERS):
+    """
+    runs `stages` (a list of Stage), returning a dict of stage name to StageResult.
+    raises PipelineError (with the results) after everything that could run has, if any stage failed.
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in stages_by_name:
+                raise ValueError("stage {} depends on unknown stage {}".format(stage.name, dependency))
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(results) < len(stages):
+            skipped_any = False
+            for stage in stages:
+                if stage.name in results or stage.name in running.values():
+                    continue
+                dependency_statuses = [results[d].status if d in results else None for d in stage.depends_on]
+                if any(status in (FAILED, SKIPPED) for status in dependency_statuses):
+                    log.warning("skipping stage {}, since a stage it depends on didn't succeed".format(stage.name))
+                    results[stage.name] = StageResult(SKIPPED, None, None)
+                    skipped_any = True
+                elif all(status == SUCCEEDED for status in dependency_statuses):
+                    log.info("starting stage {}".format(stage.name))
+                    running[pool.submit(timed, stage)] = stage.name
+            if not running:
+                if skipped_any:
+                    continue # a skip may have made more stages skippable
+                raise ValueError("stages {} depend on each other".format(", ".join(s.name for s in stages if s.name not in results)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    duration = future.result()
+                    results[name] = StageResult(SUCCEEDED, duration, None)
+                    log.info("stage {} took {}".format(name, formattimedelta(duration)))
+                except Exception as e:
+                    results[name] = StageResult(FAILED, None, e)
+                    log.exception("stage {} failed".format(name))
+    if any(result.status == FAILED for result in results.values()):
+        raise PipelineError(results)
+    return results
+
+
+def format_timings(results):
+    return ", ".join("{}: {}".format(name, formattimedelta(result.duration) if result.duration is not None else result.status) for name, result in results.items())
@@ -0,0 +1,131 @@
+"""
+the known schemas of the bundle CSVs, and which one a given CSV header is.
+
+each loader registers the versions of its CSV's schema it knows about (oldest first), as the agate column types
+it already declares, e.g. register_schema("creative_stats", "2020-07", CREATIVE_STATS_COLUMN_TYPES).
+if those are just the columns the loader uses, not the whole header, it registers them with complete=False.
+resolve_schema(table, header) then identifies a CSV by its header, rather than by guessing from its date:
+
+ - a header that's exactly a (complete) registered version's columns is that version.
+ - a header that has every column of some version is the newest such version plus the other columns,
+   which are typed like the same column in another version, or by DRIFT_COLUMN_TYPES (e.g. a new currency's
+   Spend_Range_Min_XYZ is a number), or else as text. if that version is complete, this is schema drift.
+   so is a header that matches an older version but has columns only newer versions have, since it's more likely
+   a newer CSV that's lost a column than an old one.
+ - a header that's missing columns of every version is schema drift too, and SchemaDriftError is raised, rather than loading it wrong.
+
+resolve_schema doesn't report drift itself, since it's also called in parallel_csv's worker processes; instead check_header,
+called where the CSV is opened (e.g. stream_csv.iter_rows, or by parse_csv_in_parallel before it starts the workers),
+reports it (logged, and posted to slack) once per header per process.
+
+resolved schemas are cached by header, so each CSV's header is only looked at once (see stream_csv.compiled_plan.)
+"""
+
+import hashlib
+import logging
+import re
+from functools import lru_cache
+
+import agate
+
+from ..common.post_to_slack import warn_to_slack
+
+log = logging.getLogger("google_political_transparency_report.transparency_bundle.schema_registry")
+
+# (regex for a column name, agate type) for columns no registered version has
+DRIFT_COLUMN_TYPES = [
+    (re.compile(r"^Spend_Range_(Min|Max)_[A-Z]{3}$"), agate.Number()),
+    (re.compile(r"^Spend_[A-Z]{3}$"), agate.Number()),
+]
+
+
+class SchemaDriftError(Exception): pass
+
+
+class SchemaVersion:
+    def __init__(self, table, name, column_types, complete=True, drift=None):
+        self.table = table
+        self.name = name
+        self.column_types = column_types
+        self.complete = complete
+        self.drift = drift # a description of how the header differs from the registered version, if it's drifted
+        self.fingerprint = header_fingerprint(column_types.keys())
+
+    def __repr__(self):
+        return "SchemaVersion({}, {})".format(self.table, self.name)
+
+
+_schemas = {} # table -> list of SchemaVersion, oldest first
+_reported_headers = set() # (table, header) whose drift check_header has already reported
+
+
+def header_fingerprint(header):
+    return hashlib.md5("\x1f".join(header).encode("utf-8")).hexdigest()
+
+
+def register_schema(table, name, column_types, complete=True):
+    """
+    registers a version of `table`'s CSV, whose header is the keys of `column_types` (in order), or (if not `complete`) includes them.
+    register them oldest first.
+    """
+    _schemas.setdefault(table, []).append(SchemaVersion(table, name, column_types, complete))
+
+
+def drift_column_type(table, column):
+    for version in reversed(_schemas[table]):
+        if column in version.column_types:
+            return version.column_types[column]
+    for pattern, column_type in DRIFT_COLUMN_TYPES:
+        if pattern.match(column):
+            return column_type
+    return agate.Text()
+
+
+def missing_columns(version, header):
+    return [column for column in version.column_types if column not in header]
+
+
+@lru_cache(maxsize=None)
+def resolve_schema(table, header):
+    """returns the SchemaVersion for `header` (a tuple of column names) of `table`'s CSV; raises SchemaDriftError if it's unlike any known version"""
+    if table not in _schemas:
+        raise SchemaDriftError("no schemas registered for {}".format(table))
+    fingerprint = header_fingerprint(header)
+    for version in _schemas[table]:
+        if version.complete and version.fingerprint == fingerprint:
+            return version
+    newest = _schemas[table][-1]
+    for i, version in reversed(list(enumerate(_schemas[table]))):
+        if missing_columns(version, header):
+            continue
+        drift = None
+        newer_columns = [column for newer_version in _schemas[table][i + 1:] for column in newer_version.column_types
+                         if column in header and column not in version.column_types]
+        if newer_columns:
+            drift = "schema drift in {} CSV: header {} has {} (from newer schemas), but is missing {} (from {} schema); loading it as {}".format(
+                table, fingerprint, ", ".join(dict.fromkeys(newer_columns)), ", ".join(missing_columns(newest, header)), newest.name, version.name)
+        elif version.complete:
+            added_columns = [column for column in header if column not in version.column_types]
+            drift = "schema drift in {} CSV: {} header {} has new columns {}".format(table, version.name, fingerprint, ", ".join(added_columns) or "(just reordered)")
+        column_types = {column: version.column_types[column] if column in version.column_types else drift_column_type(table, column) for column in header}
+        return SchemaVersion(table, "{}+{}".format(version.name, fingerprint[:8]), column_types, drift=drift)
+    raise SchemaDriftError("schema drift in {} CSV: header {} is missing {} (from {} schema), and is unlike any older schema".format(
+        table, fingerprint, ", ".join(missing_columns(newest, header)), newest.name))
+
+
+def check_header(table, header):
+    """
+    resolve_schema, reporting (once per header per process) any schema drift; call it once per CSV, in the process that opened it.
+    """
+    header = tuple(header)
+    try:
+        version = resolve_schema(table, header)
+    except SchemaDriftError as e:
+        log.error(e)
+        warn_to_slack(str(e))
+        raise
+    if version.drift and (table, header) not in _reported_headers:
+        _reported_headers.add((table, header))
+        log.warning(version.drift)
+        warn_to_slack(version.drift)
+    return version
@@ -0,0 +1,126 @@
+"""
+streaming, typed parsing of the bundle CSVs, with the stdlib csv module.
+
+agate.Table.from_csv holds the whole CSV in memory and casts (or infers) every column of every row.
+here, the header is read once, identified as a known schema (see schema_registry.py) and turned into a plan of
+(key, column index, converter) for just the columns a loader wants, using the same agate column type definitions
+the loaders already declare; plans are cached by header, so e.g. each range of a CSV parsed in parallel reuses one.
+rows are converted one at a time and can be grouped into insert-sized batches.
+"""
+
+import csv
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from itertools import islice
+
+import agate
+
+from .schema_registry import resolve_schema, check_header
+
+# same as agate's default null values
+NULL_VALUES = frozenset(['', 'na', 'n/a', 'none', 'null', '.'])
+TRUE_VALUES = frozenset(['yes', 'y', 'true', 't', '1'])
+FALSE_VALUES = frozenset(['no', 'n', 'false', 'f', '0'])
+
+
+def is_null(value):
+    return value.strip().lower() in NULL_VALUES
+
+def to_text(value):
+    return None if is_null(value) else value
+
+def to_number(value):
+    return None if is_null(value) else Decimal(value.replace(",", ""))
+
+def to_date(value):
+    return None if is_null(value) else date.fromisoformat(value.strip()[:10])
+
+def to_datetime(value):
+    """timestamps in the bundle are UTC, e.g. `2020-10-19 16:00:00 UTC`; they're returned naive, like the DB columns."""
+    if is_null(value):
+        return None
+    value = value.strip()
+    for suffix in (" UTC", "Z"):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+    return datetime.fromisoformat(value.replace("T", " "))
+
+def to_boolean(value):
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    elif value in FALSE_VALUES:
+        return False
+    return None
+
+AGATE_TYPE_CONVERTERS = {
+    agate.Text: to_text,
+    agate.Number: to_number,
+    agate.Date: to_date,
+    agate.DateTime: to_datetime,
+    agate.Boolean: to_boolean,
+}
+
+
+def converter_plan(header, column_types, keys):
+    """
+    returns a list of (key, column index, converter) for each column in `header` whose lowercased name is in `keys`.
+
+    column_types maps CSV column names to agate types (e.g. CREATIVE_STATS_COLUMN_TYPES); columns not in it are kept as text.
+    """
+    plan = []
+    for i, column in enumerate(header):
+        key = column.lower()
+        if key not in keys:
+            continue
+        column_type = column_types.get(column)
+        plan.append((key, i, AGATE_TYPE_CONVERTERS[type(column_type)] if column_type is not None else to_text))
+    return plan
+
+
+@lru_cache(maxsize=None)
+def compiled_plan(table, header, keys):
+    """returns (converter plan, keys the CSV lacks) for `header` (a tuple) of `table`'s CSV, as registered in schema_registry"""
+    plan = converter_plan(header, resolve_schema(table, header).column_types, keys)
+    return plan, [k for k in keys if k not in {key for key, _, _ in plan}]
+
+
+def iter_rows(csv_filelike, table, keys, where=None):
+    """
+    yields a dict per row of `table`'s CSV, with every key in `keys` (None if the CSV doesn't have that column)
+
+    `where` optionally maps CSV column names to collections of allowed values; rows are checked against it
+    as raw text, before anything's converted. (if the CSV lacks one of those columns, no rows are yielded.)
+    """
+    reader = csv.reader(csv_filelike)
+    header = next(reader)
+    check_header(table, header)
+    return iter_reader_rows(header, reader, table, keys, where)
+
+
+def iter_reader_rows(header, reader, table, keys, where=None):
+    """like iter_rows, for a csv.reader that's past the header (or that's reading part of a CSV, see parallel_csv.py)"""
+    plan, missing_keys = compiled_plan(table, tuple(header), tuple(keys))
+    filters = []
+    for column, allowed_values in (where or {}).items():
+        if column not in header:
+            return
+        filters.append((header.index(column), frozenset(allowed_values)))
+    for row in reader:
+        if filters and not all(row[i] in allowed_values for i, allowed_values in filters):
+            continue
+        row_data = {key: convert(row[i]) for key, i, convert in plan}
+        for k in missing_keys:
+            row_data[k] = None
+        yield row_data
+
+
+def batches(iterable, n):
+    """yields successive lists of up to n items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
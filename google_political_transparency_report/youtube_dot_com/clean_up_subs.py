@@ -4,9 +4,9 @@
 from dotenv import load_dotenv
 
 load_dotenv()
-import records
+from google_political_transparency_report.common.database import get_db
 
-DB = records.Database()
+DB = get_db()
 
 
 for row in DB.query("SELECT * FROM youtube_videos WHERE subs is not null;"):
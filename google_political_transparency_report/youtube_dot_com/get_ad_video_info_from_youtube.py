@@ -11,10 +11,10 @@ import requests
 import webvtt
 import youtube_dl
 from dotenv import load_dotenv
-import records
 
 from ..common.post_to_slack import info_to_slack, warn_to_slack
 from ..common.formattimedelta import formattimedelta
+from ..common.database import get_db, execute
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("google_political_transparency_report.youtube_dot_com.get_ad_video_info")
@@ -70,7 +70,7 @@ COUNT_TO_SCRAPE_PER_SCRAPER= 20
 class RateLimitedOrBlockedException(Exception): pass
 
 def get_database_connection(): 
-    return records.Database(environ['DATABASE_URL'])
+    return get_db()
 
 
 class YouTubeVideoScraperFactory():
@@ -225,20 +225,20 @@ class YouTubeVideoScraper:
 
                 if 'video unavailable' in repr(e).lower() or 'The uploader has not made this video available in your country.' in repr(e) or 'This video is not available in your country.' in repr(e) or 'copyright grounds' in repr(e):
                     video_data = {"video_unavailable": True, "video_private": False, "error": False}
-                    self.db.query(INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
+                    execute(self.db, INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
                     log.info("video unavailable")
                     return (video_data["error"], video_data["video_unavailable"], video_data["video_private"])
 
                 elif 'no conn, hlsvp, hlsManifestUrl or url_encoded_fmt_stream_map information found in video info' in repr(e) or 'Private video' in repr(e):
                     video_data = {"video_unavailable": True, "video_private": True, "error": False}
-                    self.db.query(INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
+                    execute(self.db, INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
                     log.info("video unavailable, private")
                     return (video_data["error"], video_data["video_unavailable"], video_data["video_private"])
 
                 else:
                     if retried:
                         video_data = {"error": True, "video_unavailable": False, "video_private": False}
-                        self.db.query(INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
+                        execute(self.db, INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
                         # This video is not available in your country
                         # The uploader has not made this video available in your country
                         log.warn("unknown video fetching error, will retry: " +  repr(e))
@@ -301,7 +301,7 @@ class YouTubeVideoScraper:
         elif non_retryable_error:
             video_data = {"error": True, "video_unavailable": False, "video_private": False}
             log.info("non-retryable error for {}".format(youtube_ad_id))
-            self.db.query(INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
+            execute(self.db, INSERT_QUERY, **{**{k: None for k in KEYS}, **{"id": youtube_ad_id}, **video_data})
             return (video_data["error"], video_data["video_unavailable"], video_data["video_private"])
         else:
             if has_any_subs:
@@ -318,14 +318,14 @@ class YouTubeVideoScraper:
                 video_data["upload_date"] = str(video_data["upload_date"])
 
             try:
-                self.db.query(INSERT_QUERY, **video_data)
+                execute(self.db, INSERT_QUERY, **video_data)
             except ValueError as e:
                 logging.error('%r trying to insert video_data: %r', e, video_data)
                 raise
             return (video_data["error"], video_data["video_unavailable"], video_data["video_private"])
 
     def handle_subtitle_data(self, youtube_ad_id, subs, subtitle_lang, asr):
-        self.db.query(INSERT_SUBS_QUERY, **{"id": youtube_ad_id, "subs": subs, "subtitle_lang": subtitle_lang, "asr": asr})
+        execute(self.db, INSERT_SUBS_QUERY, **{"id": youtube_ad_id, "subs": subs, "subtitle_lang": subtitle_lang, "asr": asr})
 
 def scrape_new_ads():
     ydl_args = {
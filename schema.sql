@@ -19,6 +19,40 @@ CREATE TABLE creative_stats (
     impressions_max numeric,
     report_date date;
 );
+-- md5 of the business columns (everything but report_date), so the loader only rewrites rows that changed; report_date is then the report a row last changed in. see load_creative_stats.py
+ALTER TABLE creative_stats ADD COLUMN row_hash character varying;
+
+-- the loader COPYs each bundle's creative stats into a temporary creative_stats_staging table, then merges them into creative_stats. see copy_rows.py
+
+-- every version of every ad in the creative stats CSV, and when it was in the CSV: from valid_from until (not including) valid_to,
+-- the first report_date it was missing or different. valid_to is NULL for what's in the latest CSV. see load_creative_stats.py
+CREATE TABLE creative_stats_history (
+    ad_id character varying NOT NULL,
+    row_hash character varying, -- NULL only for an interval seeded below, until the next load fills it in
+    valid_from date NOT NULL,
+    valid_to date,
+    PRIMARY KEY (ad_id, valid_from)
+);
+CREATE UNIQUE INDEX idx_creative_stats_history_current ON creative_stats_history (ad_id) WHERE valid_to IS NULL;
+CREATE INDEX idx_creative_stats_history_valid_from ON creative_stats_history (valid_from);
+CREATE INDEX idx_creative_stats_history_valid_to ON creative_stats_history (valid_to);
+-- seed it with what's already in creative_stats, so the first load after this doesn't open an interval for every ad (and count them all as appeared).
+-- run it along with the row_hash column above, before the first load that uses them: until then, the loader set every ad in the CSV to the
+-- latest report_date, so those are the ads in the latest CSV (and that's as far back as we know they were there.)
+-- their row_hash is NULL: the first load gives each the hash of its row if the ad's unchanged, or closes it and opens a new interval if not.
+INSERT INTO creative_stats_history (ad_id, row_hash, valid_from)
+    SELECT ad_id, NULL, report_date FROM creative_stats
+    WHERE report_date = (SELECT max(report_date) FROM creative_stats);
+-- ads that are in the CSV for `day` but weren't in the one before (new ads, and ones that came back)
+CREATE FUNCTION creative_stats_appeared(day date) RETURNS SETOF character varying AS $$
+    SELECT ad_id FROM creative_stats_history started
+    WHERE valid_from = day AND NOT EXISTS (SELECT 1 FROM creative_stats_history ended WHERE ended.ad_id = started.ad_id AND ended.valid_to = day);
+$$ LANGUAGE sql STABLE;
+-- ads that were in the CSV before `day`, but aren't in the one for `day`
+CREATE FUNCTION creative_stats_disappeared(day date) RETURNS SETOF character varying AS $$
+    SELECT ad_id FROM creative_stats_history ended
+    WHERE valid_to = day AND NOT EXISTS (SELECT 1 FROM creative_stats_history started WHERE started.ad_id = ended.ad_id AND started.valid_from = day);
+$$ LANGUAGE sql STABLE;
 
 CREATE TABLE advertiser_weekly_spend (
     advertiser_id character varying NOT NULL,
@@ -35,8 +69,52 @@ CREATE TABLE advertiser_regional_spend (
     region text NOT NULL,
     spend_usd integer NOT NULL,
     report_date date NOT NULL
-);
+) PARTITION BY RANGE (report_date);
 ALTER TABLE ONLY advertiser_regional_spend ADD CONSTRAINT "ADV_REGIONAL_SPEND_PKEY" PRIMARY KEY (advertiser_id, country, region, report_date);
+-- one partition per month, e.g. advertiser_regional_spend_2021_01, created by the loader as needed; old ones can be detached. see partitions.py
+CREATE INDEX idx_advertiser_regional_spend_report_date ON advertiser_regional_spend USING brin (report_date);
+
+-- with REGIONAL_SPEND_STORAGE=delta, the loader writes only each day's changes here instead (see load_advertiser_regional_spend.py):
+-- a row whenever an advertiser/region's spend is new or different from the previous day's, and a NULL spend (a tombstone) when it disappears.
+CREATE TABLE advertiser_regional_spend_deltas (
+    advertiser_id character varying NOT NULL,
+    country text NOT NULL,
+    region text NOT NULL,
+    spend_usd integer,
+    report_date date NOT NULL,
+    PRIMARY KEY (advertiser_id, country, region, report_date)
+) PARTITION BY RANGE (report_date);
+CREATE INDEX idx_advertiser_regional_spend_deltas_report_date ON advertiser_regional_spend_deltas USING brin (report_date);
+-- the latest spend of each advertiser/region (and the date it last changed), which each day's snapshot is compared to.
+CREATE TABLE advertiser_regional_spend_current (
+    advertiser_id character varying NOT NULL,
+    country text NOT NULL,
+    region text NOT NULL,
+    spend_usd integer NOT NULL,
+    report_date date NOT NULL,
+    PRIMARY KEY (advertiser_id, country, region)
+);
+-- the full snapshot as of a date, the same rows advertiser_regional_spend would have for it, e.g. SELECT * FROM advertiser_regional_spend_at('2021-01-01').
+-- it doesn't scan the whole history: an advertiser/region whose current row last changed on or before as_of still has that spend.
+-- the rest are those with a delta after as_of (just the partitions after it are read), and for each of them the latest delta
+-- on or before as_of is one backwards step on the primary key (advertiser_id, country, region, report_date <= as_of).
+CREATE FUNCTION advertiser_regional_spend_at(as_of date)
+RETURNS TABLE (advertiser_id character varying, country text, region text, spend_usd integer, report_date date) AS $$
+    SELECT curr.advertiser_id, curr.country, curr.region, curr.spend_usd, as_of
+    FROM advertiser_regional_spend_current curr
+    WHERE curr.report_date <= as_of
+    UNION ALL
+    SELECT changed.advertiser_id, changed.country, changed.region, latest.spend_usd, as_of
+    FROM (SELECT DISTINCT advertiser_id, country, region FROM advertiser_regional_spend_deltas WHERE report_date > as_of) changed
+    CROSS JOIN LATERAL (
+        SELECT deltas.spend_usd FROM advertiser_regional_spend_deltas deltas
+        WHERE deltas.advertiser_id = changed.advertiser_id AND deltas.country = changed.country AND deltas.region = changed.region
+        AND deltas.report_date <= as_of
+        ORDER BY deltas.report_date DESC
+        LIMIT 1
+    ) latest
+    WHERE latest.spend_usd IS NOT NULL;
+$$ LANGUAGE sql STABLE;
 
 CREATE TABLE google_ad_creatives (
     advertiser_id character varying NOT NULL,
@@ -52,8 +130,11 @@ CREATE TABLE google_ad_creatives (
 );
 ALTER TABLE ONLY google_ad_creatives ADD CONSTRAINT "CREATIVES_ID_PKEY" PRIMARY KEY (ad_id);
 CREATE INDEX idx_creatives_youtube_ad_id ON google_ad_creatives (youtube_ad_id);
+-- for the site scraper's known ads per advertiser (see known_ads.py), read from the index alone
+CREATE INDEX idx_creatives_advertiser_id ON google_ad_creatives (advertiser_id) INCLUDE (error, policy_violation_date);
 CREATE INDEX idx_creatives_youtube_ad_id_null ON google_ad_creatives WHERE youtube_ad_id is null;
 
+-- each advertiser's latest stats. report_date is the bundle they last changed in; when it was last seen is in advertiser_stats_daily.
 CREATE TABLE advertiser_stats (
     advertiser_id character varying NOT NULL PRIMARY KEY,
     advertiser_name text NOT NULL,
@@ -64,6 +145,61 @@ CREATE TABLE advertiser_stats (
     spend_usd integer NOT NULL,
     report_date date not null
 );
+-- each day's advertiser_stats, just the numbers, e.g. for total spend per day. one partition per month, created by the loader. see partitions.py
+CREATE TABLE advertiser_stats_daily (
+    advertiser_id character varying NOT NULL,
+    total_creatives integer NOT NULL,
+    spend_usd integer NOT NULL,
+    report_date date NOT NULL,
+    PRIMARY KEY (advertiser_id, report_date)
+) PARTITION BY RANGE (report_date);
+CREATE INDEX idx_advertiser_stats_daily_report_date ON advertiser_stats_daily USING brin (report_date);
+
+-- bookkeeping for the transparency bundle loaders (see transparency_bundle/bundle_ledger.py)
+CREATE TABLE bundle_fetches (
+    fetched_at timestamptz NOT NULL DEFAULT now(),
+    bundle_date date NOT NULL,
+    etag character varying,
+    last_modified character varying,
+    content_md5 character varying NOT NULL
+);
+CREATE INDEX idx_bundle_fetches_fetched_at ON bundle_fetches (fetched_at);
+
+CREATE TABLE bundle_table_loads (
+    table_name character varying NOT NULL,
+    bundle_date date NOT NULL,
+    row_count integer,
+    loaded_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, bundle_date)
+);
+
+-- the latest bundle's regional spend, without scanning for max(report_date): only the latest partition is read.
+CREATE VIEW latest_advertiser_regional_spend AS
+    SELECT * FROM advertiser_regional_spend
+    WHERE report_date = (SELECT max(bundle_date) FROM bundle_table_loads WHERE table_name = 'advertiser_regional_spend');
+
+-- with REGIONAL_SPEND_STORAGE=delta nothing's written to advertiser_regional_spend, so these give its readers the same rows from the deltas:
+-- every loaded day's snapshot (filter it on report_date: each day is an advertiser_regional_spend_at call) ...
+CREATE VIEW advertiser_regional_spend_from_deltas AS
+    SELECT spend.* FROM bundle_table_loads loads
+    CROSS JOIN LATERAL advertiser_regional_spend_at(loads.bundle_date) spend
+    WHERE loads.table_name = 'advertiser_regional_spend_deltas';
+-- ... and the latest one, which is advertiser_regional_spend_current.
+CREATE VIEW latest_advertiser_regional_spend_from_deltas AS
+    SELECT advertiser_id, country, region, spend_usd,
+        (SELECT max(bundle_date) FROM bundle_table_loads WHERE table_name = 'advertiser_regional_spend_deltas') AS report_date
+    FROM advertiser_regional_spend_current;
+-- when switching a DB to REGIONAL_SPEND_STORAGE=delta, run this just once, so the old names keep working: advertiser_regional_spend
+-- becomes a view of the full snapshots loaded before the switch, followed by the ones rebuilt from the deltas.
+-- BEGIN;
+-- ALTER TABLE advertiser_regional_spend RENAME TO advertiser_regional_spend_full;
+-- CREATE VIEW advertiser_regional_spend AS
+--     SELECT * FROM advertiser_regional_spend_full
+--     WHERE report_date < (SELECT coalesce(min(bundle_date), 'infinity') FROM bundle_table_loads WHERE table_name = 'advertiser_regional_spend_deltas')
+--     UNION ALL
+--     SELECT * FROM advertiser_regional_spend_from_deltas;
+-- CREATE OR REPLACE VIEW latest_advertiser_regional_spend AS SELECT * FROM latest_advertiser_regional_spend_from_deltas;
+-- COMMIT;
 
 
 CREATE TABLE youtube_videos (
@@ -0,0 +1,47 @@
+import io
+import random
+
+from google_political_transparency_report.transparency_bundle import bundle_archive
+from google_political_transparency_report.transparency_bundle.bundle_archive import split_into_chunks, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+def csv_lines(n, seed=0):
+    rng = random.Random(seed)
+    return [b"CR%d,%d,%s\n" % (i, rng.randrange(10_000), b"x" * rng.randrange(20, 80)) for i in range(n)]
+
+
+def chunks_of(lines):
+    return list(split_into_chunks(io.BytesIO(b"".join(lines))))
+
+
+def test_split_into_chunks_is_lossless_and_ends_on_lines():
+    lines = csv_lines(50_000)
+    chunks = chunks_of(lines)
+    assert b"".join(chunks) == b"".join(lines)
+    assert len(chunks) > 1
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+
+
+def test_split_into_chunks_respects_the_size_limits():
+    chunks = chunks_of(csv_lines(50_000))
+    assert all(MIN_CHUNK_SIZE <= len(chunk) <= MAX_CHUNK_SIZE + 100 for chunk in chunks[:-1])
+
+
+def test_split_into_chunks_caps_chunks_without_a_boundary(monkeypatch):
+    # a boundary never matches, so every chunk ends at MAX_CHUNK_SIZE
+    monkeypatch.setattr(bundle_archive, "CHUNK_BOUNDARY_BITS", 32)
+    monkeypatch.setattr(bundle_archive, "MAX_CHUNK_SIZE", 10_000)
+    chunks = chunks_of(csv_lines(5_000))
+    assert all(10_000 <= len(chunk) < 10_100 for chunk in chunks[:-1])
+
+
+def test_split_into_chunks_only_changes_the_chunk_with_an_inserted_line():
+    lines = csv_lines(50_000)
+    before = chunks_of(lines)
+    after = chunks_of(lines[:25_000] + [b"CR-new,1,inserted\n"] + lines[25_000:])
+    assert len(set(after) - set(before)) == 1
+    assert len(set(before) - set(after)) == 1
+
+
+def test_split_into_chunks_of_an_empty_member():
+    assert chunks_of([]) == []
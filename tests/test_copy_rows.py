@@ -0,0 +1,63 @@
+import csv
+import io
+
+from google_political_transparency_report.transparency_bundle.copy_rows import CsvRowStream, CsvChunkStream, COPY_NULL
+
+COLUMNS = ["ad_id", "text", "spend_usd"]
+ROWS = [
+    {"ad_id": "CR1", "text": "plain", "spend_usd": 100},
+    {"ad_id": "CR2", "text": "with, a comma\nand a newline", "spend_usd": 0},
+    {"ad_id": "CR3", "text": None, "spend_usd": 5},
+]
+
+
+def read_all(stream, size):
+    parts = []
+    while True:
+        part = stream.read(size)
+        if not part:
+            return "".join(parts)
+        assert size < 0 or len(part) <= size
+        parts.append(part)
+
+
+def test_csv_row_stream_encodes_rows_for_copy():
+    stream = CsvRowStream(ROWS, COLUMNS)
+    text = stream.read()
+    assert list(csv.reader(io.StringIO(text))) == [
+        ["CR1", "plain", "100"],
+        ["CR2", "with, a comma\nand a newline", "0"],
+        ["CR3", COPY_NULL, "5"],
+    ]
+    assert stream.row_count == 3
+    assert stream.read() == ""
+
+
+def test_csv_row_stream_reads_the_same_text_in_any_size():
+    expected = CsvRowStream(ROWS, COLUMNS).read()
+    for size in [1, 2, 7, 8192]:
+        assert read_all(CsvRowStream(ROWS, COLUMNS), size) == expected
+
+
+def test_csv_row_stream_encodes_only_what_is_asked_for():
+    stream = CsvRowStream(iter(ROWS), COLUMNS)
+    stream.read(3)
+    assert stream.row_count == 1
+
+
+def test_csv_chunk_stream_reads_chunks_in_any_size():
+    chunks = ["CR1,a\n", "", "CR2,\"b\nc\"\n" * 1000, "CR3,d\n"]
+    expected = "".join(chunks)
+    for size in [-1, 1, 5, 8192, 100_000]:
+        assert read_all(CsvChunkStream(chunks), size) == expected
+
+
+def test_csv_chunk_stream_pulls_chunks_only_as_needed():
+    pulled = []
+    def chunks():
+        for chunk in ["abc", "def", "ghi"]:
+            pulled.append(chunk)
+            yield chunk
+    stream = CsvChunkStream(chunks())
+    assert stream.read(4) == "abcd"
+    assert pulled == ["abc", "def"]
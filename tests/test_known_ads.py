@@ -0,0 +1,63 @@
+from google_political_transparency_report.political_transparency_report_site.known_ads import KnownAds, ad_state, tile_state, ERROR, POLICY_VIOLATION, SCRAPER_KNOWN_AD_RUN
+
+
+def tile(ad_id, kind, **fields):
+    return {"ad_id": ad_id, "kind": kind, "image_url": None, **fields}
+
+
+def test_tile_state_matches_the_rows_ad_data_from_tile_makes():
+    assert tile_state(tile("CR1", "text")) == 0
+    assert tile_state(tile("CR1", "youtube_video", image_url="https://i.ytimg.com/vi/ID/0.jpg")) == 0
+    assert tile_state(tile("CR1", "youtube_video")) == ERROR
+    assert tile_state(tile("CR1", "other_video")) == ERROR
+    assert tile_state(tile("CR1", "unknown")) == ERROR
+    assert tile_state(tile("CR1", "policy_violation")) == POLICY_VIOLATION
+
+
+def test_unchanged_skips_known_ads_in_the_same_state():
+    known_ads = KnownAds({"CR1": ad_state(False, False), "CR2": ad_state(True, False)})
+    assert known_ads.unchanged(tile("CR1", "text"))
+    assert known_ads.unchanged(tile("CR2", "other_video"))
+    assert known_ads.skipped == 2
+
+
+def test_unchanged_scrapes_new_and_changed_ads():
+    known_ads = KnownAds({"CR1": ad_state(False, False)})
+    assert not known_ads.unchanged(tile("CR2", "text"))
+    assert not known_ads.unchanged(tile("CR1", "policy_violation"))
+    assert known_ads.skipped == 0
+
+
+def test_unchanged_keeps_a_policy_violation_the_db_already_has():
+    # the upsert keeps the earliest policy_violation_date, so a tile without one changes nothing
+    known_ads = KnownAds({"CR1": ad_state(False, True)})
+    assert known_ads.unchanged(tile("CR1", "text"))
+    assert known_ads.unchanged(tile("CR1", "policy_violation"))
+
+
+def test_caught_up_after_the_default_run(monkeypatch):
+    monkeypatch.delenv("SCRAPER_KNOWN_AD_RUN", raising=False)
+    known_ads = KnownAds({"CR{}".format(i): 0 for i in range(SCRAPER_KNOWN_AD_RUN)})
+    for i in range(SCRAPER_KNOWN_AD_RUN - 1):
+        known_ads.unchanged(tile("CR{}".format(i), "text"))
+    assert not known_ads.caught_up()
+    known_ads.unchanged(tile("CR{}".format(SCRAPER_KNOWN_AD_RUN - 1), "text"))
+    assert known_ads.caught_up()
+
+
+def test_caught_up_is_off_with_a_run_length_of_zero(monkeypatch):
+    monkeypatch.setenv("SCRAPER_KNOWN_AD_RUN", "2")
+    known_ads = KnownAds({"CR{}".format(i): 0 for i in range(100)}, run_length=0)
+    for i in range(100):
+        known_ads.unchanged(tile("CR{}".format(i), "text"))
+    assert not known_ads.caught_up()
+
+
+def test_caught_up_after_a_run_of_known_ads():
+    known_ads = KnownAds({"CR1": 0, "CR2": 0, "CR3": 0}, run_length=2)
+    known_ads.unchanged(tile("CR1", "text"))
+    known_ads.unchanged(tile("new", "text"))
+    known_ads.unchanged(tile("CR2", "text"))
+    assert not known_ads.caught_up()
+    known_ads.unchanged(tile("CR3", "text"))
+    assert known_ads.caught_up()
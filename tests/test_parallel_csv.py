@@ -0,0 +1,62 @@
+import csv
+import io
+
+from google_political_transparency_report.transparency_bundle import parallel_csv
+from google_political_transparency_report.transparency_bundle.parallel_csv import record_boundaries
+
+CSV = (
+    b'Ad_ID,Text\n'
+    b'CR1,plain\n'
+    b'CR2,"a newline\nin quotes"\n'
+    b'CR3,"an ""escaped"" quote, and\nanother newline"\n'
+    b'CR4,last\n'
+)
+
+
+def records(data, boundaries):
+    return [data[start:end] for start, end in zip(boundaries, boundaries[1:])]
+
+
+def test_record_boundaries_start_after_the_header_and_end_at_the_file_size():
+    boundaries = record_boundaries(io.BytesIO(CSV), range_size=1)
+    assert boundaries[0] == len(b'Ad_ID,Text\n')
+    assert boundaries[-1] == len(CSV)
+
+
+def test_record_boundaries_skip_newlines_in_quoted_fields():
+    # a range_size of 1 puts a boundary after every record
+    ranges = records(CSV, record_boundaries(io.BytesIO(CSV), range_size=1))
+    assert [next(csv.reader(io.StringIO(r.decode(), newline="")))[0] for r in ranges] == ["CR1", "CR2", "CR3", "CR4"]
+
+
+def test_record_boundaries_make_ranges_of_at_least_range_size():
+    data = b"id,text\n" + b"".join(b'%d,"x\ny"\n' % i for i in range(10_000))
+    boundaries = record_boundaries(io.BytesIO(data), range_size=4096)
+    ranges = records(data, boundaries)
+    assert all(len(r) >= 4096 for r in ranges[:-1])
+    assert sum(len(list(csv.reader(io.StringIO(r.decode(), newline="")))) for r in ranges) == 10_000
+
+
+def test_record_boundaries_find_records_across_scan_chunks(monkeypatch):
+    monkeypatch.setattr(parallel_csv, "SCAN_CHUNK_SIZE", 7)
+    ranges = records(CSV, record_boundaries(io.BytesIO(CSV), range_size=1))
+    assert [r.split(b",")[0] for r in ranges] == [b"CR1", b"CR2", b"CR3", b"CR4"]
+
+
+def test_iter_record_ranges_reads_a_text_stream_without_seeking():
+    ranges = list(parallel_csv.iter_record_ranges(parallel_csv.csv_bytes(io.StringIO(CSV.decode(), newline="")), range_size=1))
+    assert b"".join(ranges) == CSV
+    assert [r.split(b",")[0] for r in ranges] == [b"Ad_ID", b"CR1", b"CR2", b"CR3", b"CR4"]
+
+
+def first_fields(header, reader):
+    return [header[0]] + [row[0] for row in reader]
+
+
+def test_parse_csv_in_parallel_yields_the_ranges_in_order():
+    data = b"id,text\n" + b"".join(b'%d,"x\ny"\n' % i for i in range(2_000))
+    headers = []
+    results = list(parallel_csv.parse_csv_in_parallel(io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", newline=""), first_fields, workers=2, range_size=1024, check_header=headers.append))
+    assert headers == [["id", "text"]]
+    assert len(results) > 2
+    assert [i for result in results for i in result[1:]] == [str(i) for i in range(2_000)]
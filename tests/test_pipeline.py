@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from google_political_transparency_report.transparency_bundle.pipeline import Stage, run_stages, PipelineError, SUCCEEDED, FAILED, SKIPPED
+
+
+def test_run_stages_runs_dependencies_first():
+    order = []
+    stages = [
+        Stage("upload", lambda: order.append("upload"), ["extract"]),
+        Stage("extract", lambda: order.append("extract")),
+    ]
+    results = run_stages(stages, workers=2)
+    assert order == ["extract", "upload"]
+    assert {name: result.status for name, result in results.items()} == {"extract": SUCCEEDED, "upload": SUCCEEDED}
+
+
+def test_run_stages_overlaps_independent_stages():
+    both_started = threading.Barrier(2, timeout=5)
+    stages = [Stage("a", both_started.wait), Stage("b", both_started.wait)]
+    results = run_stages(stages, workers=2)
+    assert all(result.status == SUCCEEDED for result in results.values())
+
+
+def test_run_stages_skips_dependents_of_a_failed_stage_but_runs_the_rest():
+    ran = []
+    def fail():
+        raise ValueError("bad CSV")
+    stages = [
+        Stage("load", fail),
+        Stage("upload", lambda: ran.append("upload"), ["load"]),
+        Stage("report", lambda: ran.append("report"), ["upload"]),
+        Stage("other", lambda: ran.append("other")),
+    ]
+    with pytest.raises(PipelineError) as e:
+        run_stages(stages, workers=2)
+    statuses = {name: result.status for name, result in e.value.results.items()}
+    assert statuses == {"load": FAILED, "upload": SKIPPED, "report": SKIPPED, "other": SUCCEEDED}
+    assert ran == ["other"]
+    assert isinstance(e.value.results["load"].error, ValueError)
+
+
+def test_run_stages_rejects_unknown_dependencies():
+    with pytest.raises(ValueError):
+        run_stages([Stage("a", lambda: None, ["b"])])
+
+
+def test_run_stages_rejects_cycles():
+    with pytest.raises(ValueError):
+        run_stages([Stage("a", lambda: None, ["b"]), Stage("b", lambda: None, ["a"])])
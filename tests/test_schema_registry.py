@@ -0,0 +1,73 @@
+import agate
+import pytest
+
+from google_political_transparency_report.transparency_bundle import schema_registry
+from google_political_transparency_report.transparency_bundle.schema_registry import register_schema, resolve_schema, check_header, SchemaDriftError
+
+OLD = {"Ad_ID": agate.Text(), "Spend_USD": agate.Text()}
+NEW = {"Ad_ID": agate.Text(), "Spend_USD": agate.Text(), "First_Served_Timestamp": agate.DateTime(), "Spend_Range_Min_USD": agate.Number()}
+
+
+@pytest.fixture
+def table(request):
+    """a table with an incomplete old schema and a complete new one, named for the test so the registry's caches don't carry over"""
+    name = "test_{}".format(request.node.name)
+    register_schema(name, "old", OLD, complete=False)
+    register_schema(name, "new", NEW)
+    return name
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    messages = []
+    monkeypatch.setattr(schema_registry, "warn_to_slack", messages.append)
+    return messages
+
+
+def test_resolve_schema_knows_an_exact_header(table):
+    version = resolve_schema(table, tuple(NEW))
+    assert version.name == "new"
+    assert version.drift is None
+
+
+def test_resolve_schema_types_new_columns(table):
+    version = resolve_schema(table, tuple(NEW) + ("Spend_Range_Min_EUR", "Notes"))
+    assert isinstance(version.column_types["Spend_Range_Min_EUR"], agate.Number)
+    assert isinstance(version.column_types["Notes"], agate.Text)
+    assert "Spend_Range_Min_EUR" in version.drift
+
+
+def test_resolve_schema_takes_an_old_header_as_the_old_version(table):
+    version = resolve_schema(table, ("Ad_ID", "Regions", "Spend_USD"))
+    assert version.name.startswith("old+")
+    assert version.drift is None
+
+
+def test_resolve_schema_calls_a_new_header_missing_a_column_drift(table):
+    version = resolve_schema(table, ("Ad_ID", "Spend_USD", "First_Served_Timestamp"))
+    assert version.name.startswith("old+")
+    assert "Spend_Range_Min_USD" in version.drift
+    assert isinstance(version.column_types["First_Served_Timestamp"], agate.DateTime)
+
+
+def test_resolve_schema_raises_for_an_unknown_header(table):
+    with pytest.raises(SchemaDriftError):
+        resolve_schema(table, ("Something", "Else"))
+
+
+def test_resolve_schema_raises_for_an_unknown_table():
+    with pytest.raises(SchemaDriftError):
+        resolve_schema("test_no_such_table", ("Ad_ID",))
+
+
+def test_check_header_reports_drift_once(table, slack):
+    header = list(NEW) + ["Notes"]
+    check_header(table, header)
+    check_header(table, header)
+    assert len(slack) == 1
+
+
+def test_check_header_reports_an_unknown_header(table, slack):
+    with pytest.raises(SchemaDriftError):
+        check_header(table, ["Something"])
+    assert len(slack) == 1
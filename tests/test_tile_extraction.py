@@ -0,0 +1,93 @@
+from datetime import date
+
+from google_political_transparency_report.political_transparency_report_site.tile_extraction import ad_data_from_tile
+
+
+class FakeSwitchTo:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def frame(self, frame):
+        self.driver.frames.append(frame)
+
+    def default_content(self):
+        self.driver.frames = []
+
+
+class FakeDriver:
+    """answers IFRAME_JS with `contents`, a dict of frame -> what the script finds in it"""
+    def __init__(self, contents):
+        self.contents = contents
+        self.frames = []
+        self.switch_to = FakeSwitchTo(self)
+
+    def execute_script(self, script, *args):
+        return self.contents[self.frames[-1]]
+
+
+def tile(kind, **fields):
+    return {"element": None, "ad_id": "CR1", "loading": False, "kind": kind, **fields}
+
+
+def iframe_contents(**fields):
+    return {"has_canvas": False, "canvas_image_url": None, "destination": None, "text": "", "image_urls": [], "iframe": None, "iframe_url": None, **fields}
+
+
+def test_ad_data_from_tile_without_an_ad_id():
+    assert ad_data_from_tile(None, {**tile("text", text="hi"), "ad_id": None}, "AR1") is None
+
+
+def test_ad_data_from_tile_youtube():
+    row = ad_data_from_tile(None, tile("youtube_video", image_url="https://i.ytimg.com/vi/VIDEO_ID/hqdefault.jpg"), "AR1")
+    assert row == {"ad_id": "CR1", "youtube_ad_id": "VIDEO_ID", "ad_type": "video", "policy_violation_date": None}
+
+
+def test_ad_data_from_tile_youtube_without_an_image():
+    assert ad_data_from_tile(None, tile("youtube_video", image_url=None), "AR1") == {"ad_id": "CR1", "error": True, "ad_type": "video"}
+
+
+def test_ad_data_from_tile_text():
+    assert ad_data_from_tile(None, tile("text", text="Vote\nNovember 3"), "AR1") == {"ad_id": "CR1", "text": "Vote\nNovember 3", "ad_type": "text"}
+
+
+def test_ad_data_from_tile_image_unwraps_the_destination():
+    row = ad_data_from_tile(None, tile("image_img", image_url="https://tpc.googlesyndication.com/img.png",
+                                       destination="https://www.googleadservices.com/pagead/aclk?sa=L&adurl=https://example.com/donate"), "AR1")
+    assert row["destination"] == "https://example.com/donate"
+    assert row["image_url"] == "https://tpc.googlesyndication.com/img.png"
+    assert row["ad_type"] == "image" and row["error"] is False
+
+
+def test_ad_data_from_tile_image_with_a_plain_destination():
+    row = ad_data_from_tile(None, tile("image_img", image_url="https://example.com/img.png", destination="https://example.com/"), "AR1")
+    assert row["destination"] == "https://example.com/"
+
+
+def test_ad_data_from_tile_image_and_text_iframe():
+    driver = FakeDriver({"frame": iframe_contents(has_canvas=True, canvas_image_url="url(x)", destination="https://example.com/", text="Vote")})
+    row = ad_data_from_tile(driver, tile("image_iframe", iframe="frame", iframe_url="https://ads.example.com/frame"), "AR1")
+    assert (row["image_url"], row["image_urls"], row["text"], row["destination"]) == ("url(x)", None, "Vote", "https://example.com/")
+    assert driver.frames == []
+
+
+def test_ad_data_from_tile_image_in_a_nested_iframe():
+    driver = FakeDriver({
+        "frame": iframe_contents(iframe="nested", iframe_url="https://ads.example.com/nested/index.html"),
+        "nested": iframe_contents(image_urls=["img.png", "https://cdn.example.com/other.png"]),
+    })
+    row = ad_data_from_tile(driver, tile("image_iframe", iframe="frame", iframe_url="https://ads.example.com/frame"), "AR1")
+    # relative image URLs are relative to the frame they're in
+    assert row["image_urls"] == ["https://ads.example.com/nested/img.png", "https://cdn.example.com/other.png"]
+    assert row["image_url"] is None and row["text"] is None
+    assert driver.frames == []
+
+
+def test_ad_data_from_tile_policy_violation():
+    row = ad_data_from_tile(None, tile("policy_violation"), "AR1")
+    assert row == {"ad_id": "CR1", "error": False, "ad_type": "unknown", "policy_violation_date": date.today()}
+
+
+def test_ad_data_from_tile_other_video_and_unknown_are_errors():
+    assert ad_data_from_tile(None, tile("other_video"), "AR1")["error"] is True
+    row = ad_data_from_tile(None, tile("unknown", html="<creative-preview></creative-preview>"), "AR1")
+    assert row["error"] is True and row["ad_type"] == "unknown"
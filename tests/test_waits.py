@@ -0,0 +1,58 @@
+import pytest
+
+from google_political_transparency_report.political_transparency_report_site.waits import WaitTimings, MIN_SAMPLES, MIN_TIMEOUT, TIMEOUT_FACTOR, MISSES_TO_RESET
+
+
+def learned(durations, max_timeout=12):
+    wait_timings = WaitTimings("page_load", max_timeout)
+    for duration in durations:
+        wait_timings.record(duration, True)
+    return wait_timings
+
+
+def test_timeout_is_the_max_until_there_are_enough_samples():
+    assert learned([0.2] * (MIN_SAMPLES - 1)).timeout() == 12
+
+
+def test_timeout_is_a_multiple_of_the_95th_percentile():
+    durations = [0.2] * 90 + [2.0] * 10
+    assert learned(durations).timeout() == pytest.approx(TIMEOUT_FACTOR * 2.0)
+
+
+def test_timeout_is_clamped():
+    assert learned([0.01] * MIN_SAMPLES).timeout() == MIN_TIMEOUT
+    assert learned([10] * MIN_SAMPLES).timeout() == 12
+
+
+def test_timeouts_are_not_samples():
+    wait_timings = learned([0.2] * MIN_SAMPLES)
+    for _ in range(MIN_SAMPLES):
+        wait_timings.record(12, False)
+    assert wait_timings.timeout() == MIN_TIMEOUT
+    assert wait_timings.timeouts == MIN_SAMPLES
+
+
+def test_slow_waits_that_succeed_raise_the_timeout():
+    wait_timings = learned([0.2] * MIN_SAMPLES)
+    # waits that outlasted the learned timeout, and succeeded on the retry
+    wait_timings.record(3.0, True, missed=True)
+    wait_timings.record(3.0, True, missed=True)
+    assert wait_timings.timeout() == pytest.approx(TIMEOUT_FACTOR * 3.0)
+
+
+def test_misses_in_a_row_reset_the_timeout():
+    wait_timings = learned([0.2] * MIN_SAMPLES)
+    for _ in range(MISSES_TO_RESET - 1):
+        wait_timings.record(12, False, missed=True)
+    assert wait_timings.timeout() == MIN_TIMEOUT
+    wait_timings.record(12, False, missed=True)
+    assert wait_timings.timeout() == 12
+
+
+def test_a_wait_that_makes_it_breaks_a_run_of_misses():
+    wait_timings = learned([0.2] * MIN_SAMPLES)
+    for _ in range(MISSES_TO_RESET - 1):
+        wait_timings.record(12, False, missed=True)
+    wait_timings.record(0.2, True)
+    wait_timings.record(12, False, missed=True)
+    assert wait_timings.timeout() == MIN_TIMEOUT